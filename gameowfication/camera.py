@@ -66,47 +66,35 @@ class Camera:
 
         cam_pos =self._pos.getPosition()
         look_at = self._target._position
-        dv = cam_pos - look_at
 
+        # the sight line is kept this far over the terrain so the camera can see
+        offset = N.array((0,0,0.4),dtype="f")
 
-        dist = T.vector_norm(dv[0:2]) # distance across floor
+        origin = look_at - offset
+        target = cam_pos - offset
 
-        n = math.ceil(dist / 0.2)
-
-        z0 = look_at[2]
-        dray = dv / n
-        m = self._map
+        flat_dist = T.vector_norm((target - origin)[0:2]) # distance across floor
 
         hit = False
 
-        # ray-march
-        #z_list = []
-        ray_pos = look_at + dray # advance once
-        for i in xrange(1,int(n)+3): # start at i=1 to avoid division by zero
-            z = m(ray_pos[0], ray_pos[1], False)+0.4 # is an offset so the camera can see
-            #z_list.append(int(z*10))
-            if z > ray_pos[2]:
-                slope = (z-z0) / float(i)
-                #if slope > 0.1:
-                #   ray_pos -= dray # go back one step
-                #   break
-                dray[2] = slope
-                ray_pos[2] = z
-                hit = True
-
-            ray_pos += dray
+        # if the sight line hits the terrain, lift the camera so the line passes
+        # over the hit point, and try again (there may be more ridges further)
+        for i in xrange(4):
+            dv = target - origin
+            h = self._map.raycast(origin, dv, T.vector_norm(dv))
+            if h is None:
+                break
 
-        ray_pos -= dray*3
+            hit_pos = h[0]
+            frac = T.vector_norm((hit_pos - origin)[0:2]) / flat_dist if flat_dist > 0 else 1.0
+            if frac < 0.001:
+                break
 
-        #print z_list
-        #print "%s -> %s   %s" % (self._pos.getPosition(), ray_pos, "HIT" if hit else "")
+            target[2] = origin[2] + (hit_pos[2] + 0.01 - origin[2]) / frac
+            hit = True
 
         if hit:
-            self._pos.moveTo(ray_pos)
-
-
-
-
+            self._pos.moveTo(target + offset)
 
 
 
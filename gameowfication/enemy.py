@@ -24,12 +24,10 @@ SOFTWARE.
 
 
 from entities import Entity
-from particles import ParticleGenerator
 import libs.transformations as T
 from mathtools import *
 import resources as R
 import routing as routing
-import random
 
 
 class Enemy(Entity):
@@ -90,31 +88,15 @@ class Enemy(Entity):
         Entity.destroy(self)
 
     def explode(self):
-
-        def emitter(t):
-            while True:
-                dx = 2.*random.random()-1.
-                dy = 2.*random.random()-1.
-                dz = 2.*random.random()-1.
-
-                r = dx*dx+dy*dy+dz*dz
-
-                if r < 1.0 and r>0.5:
-
-                    d = (dx,dy,dz)
-
-                    return self._pos - (dx*3,dy*3,dz*3), d
-
-
-
-        p = ParticleGenerator("billboard","particle4.png")
-        p.setEmitter(emitter)
+        pm = self._scene.getParticleManager()
+        p = pm.getGenerator("billboard","particle4.png")
+        p.setShapeEmitter(self._pos, inner=0.5, spread=-3.0)
         p.setEvolveTime(1)
         p.setAcceleration(0)
         p.setSpawnSpeed(100)
         p.setEasing(0.5,0.8,0,0.5,0.5)
         p.setMode("ONCE")
-        self._scene.getParticleManager().manageGenerator(p)
+        pm.manageGenerator(p)
         self.close(self.DESTROYED)
 
 
@@ -56,6 +56,11 @@ class Entity:
         return self._pos
 
 
+    # bounding box in world coordinates, grown by margin on every side
+    def getWorldBounds(self, margin=0.0):
+        return (self._pos + self._bounds[0] - margin, self._pos + self._bounds[1] + margin)
+
+
     def moveTo(self, pos):
         gx = int(pos[0]/16)
         gy = int(pos[1]/16)
@@ -25,6 +25,7 @@ SOFTWARE.
 
 from OpenGL.arrays import vbo
 import pygame
+import numpy as N
 #from OpenGL.GL import *
 from glcompat import *
 import resources as R
@@ -192,6 +193,43 @@ class Texture:
         glBindTexture(GL_TEXTURE_2D,0)
 
 
+    # float texture, for data read by the shaders (e.g. heights). data is
+    # (h,w) for a single channel or (h,w,4) for RGBA
+    def setFromArray(self, data):
+        data = N.ascontiguousarray(data, dtype="f")
+
+        self._height, self._width = h,w = data.shape[0:2]
+        rgba = data.ndim == 3
+
+        if not self._id:
+            id = self._id = glGenTextures(1)
+        else:
+            id = self._id
+
+        glBindTexture(GL_TEXTURE_2D,id)
+        if self._smoothing:
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        else:
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        if rgba:
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA32F, w, h, 0, GL_RGBA, GL_FLOAT, data)
+        else:
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_R32F, w, h, 0, GL_RED, GL_FLOAT, data)
+        glBindTexture(GL_TEXTURE_2D,0)
+
+
+    # replaces the rows [y0, y0+len(data)) of a texture made with setFromArray
+    def updateFromArray(self, data, y0=0):
+        data = N.ascontiguousarray(data, dtype="f")
+        fmt = GL_RGBA if data.ndim == 3 else GL_RED
+
+        glBindTexture(GL_TEXTURE_2D,self._id)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, y0, self._width, data.shape[0], fmt, GL_FLOAT, data)
+        glBindTexture(GL_TEXTURE_2D,0)
+
+
     def update(self, surf):
         glBindTexture(GL_TEXTURE_2D,self._id)
         data = pygame.image.tostring(surf, "RGBA", 1)
@@ -199,6 +237,17 @@ class Texture:
         glBindTexture(GL_TEXTURE_2D,0)
 
 
+    # uploads the rectangle (x,y,w,h) of surf (in surface coordinates, y down)
+    # Returns the bytes sent
+    def updateRect(self, surf, rect):
+        x,y,w,h = rect
+        data = pygame.image.tostring(surf.subsurface(rect), "RGBA", 1)
+        glBindTexture(GL_TEXTURE_2D,self._id)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, x, self._height - y - h, w, h, GL_RGBA, GL_UNSIGNED_BYTE, data )
+        glBindTexture(GL_TEXTURE_2D,0)
+        return len(data)
+
+
     def width(self):
         return self._width
 
@@ -229,3 +278,62 @@ class Texture:
             def binder(sampler_num=sampler_num, uniform_location=uniform_location):
                 self.bind(sampler_num, uniform_location)
             return binder
+
+
+
+# places rectangles of the given sizes [(w,h),...] in rows (shelves) of the
+# given width, the tallest first. Returns their positions [(x,y),...] and
+# the total height used
+def packShelves(sizes, width, padding=0):
+    order = sorted(range(len(sizes)), key=lambda i: -sizes[i][1])
+    positions = [None] * len(sizes)
+
+    x = y = shelf_h = 0
+    for i in order:
+        w,h = sizes[i]
+        w += 2*padding
+        h += 2*padding
+        if w > width:
+            raise ValueError("Image too wide for the atlas: %s"%(sizes[i],))
+        if x + w > width: # next shelf
+            y += shelf_h
+            x = shelf_h = 0
+        positions[i] = (x+padding, y+padding)
+        x += w
+        shelf_h = max(shelf_h, h)
+
+    return positions, y + shelf_h
+
+
+# several images in one texture. getRect gives the texture coordinates of
+# each one (u0,v0,u1,v1)
+class TextureAtlas(Texture):
+    def __init__(self, filenames, width=2048, padding=2):
+        Texture.__init__(self)
+        surfs = [R.loadSurface(f, False) for f in filenames]
+
+        positions, height = packShelves([s.get_size() for s in surfs], width, padding)
+
+        h = 1
+        while h < height: h *= 2
+
+        atlas = pygame.Surface((width, h), pygame.SRCALPHA, 32)
+        atlas.fill((0,0,0,0))
+
+        self._rects = {}
+        for f, s, (x,y) in zip(filenames, surfs, positions):
+            atlas.blit(s, (x,y))
+            sw, sh = s.get_size()
+            # the texture is flipped vertically when uploaded. Half a texel
+            # in, so the neighbours don't bleed in
+            self._rects[f] = ((x+0.5)/width, 1.0-(y+sh-0.5)/h, (x+sw-0.5)/width, 1.0-(y+0.5)/h)
+
+        self.setFromSurface(atlas)
+
+
+    def hasTexture(self, filename):
+        return filename in self._rects
+
+
+    def getRect(self, filename):
+        return self._rects[filename]
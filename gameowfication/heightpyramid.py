@@ -0,0 +1,232 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+# Min/max mip pyramid of a height map, for fast ray casting.
+#
+# Level 0 holds the lowest and highest heights of every cell (the square
+# between 4 vertices), and every level above keeps the lowest and highest of
+# 2x2 nodes of the level below. A ray that passes above the maximum of a node
+# can skip the whole node, so long rays only visit a few nodes.
+#
+# The heights may be quantized (e.g. uint16): the real height is
+# offset + scale * heights. The levels are kept quantized too.
+
+import math
+import numpy as N
+
+
+def _reduce2x2(a, fn):
+    h,w = a.shape
+    # pad to an even size repeating the last row/column (doesn't alter min/max)
+    a = N.pad(a, ((0, h%2), (0, w%2)), "edge")
+    a = a.reshape(a.shape[0]//2, 2, a.shape[1]//2, 2)
+    return fn(fn(a, axis=3), axis=1)
+
+
+class HeightPyramid:
+    def __init__(self, heights, scale=1.0, offset=0.0):
+        m = N.asarray(heights)
+        self._heights = m
+        self._scale = scale
+        self._offset = offset
+
+        h,w = m.shape
+        self._size = w-1, h-1 # in cells
+
+        cmin = N.minimum(N.minimum(m[:-1,:-1], m[1:,:-1]), N.minimum(m[:-1,1:], m[1:,1:]))
+        cmax = N.maximum(N.maximum(m[:-1,:-1], m[1:,:-1]), N.maximum(m[:-1,1:], m[1:,1:]))
+
+        self._min = [cmin]
+        self._max = [cmax]
+
+        while max(cmax.shape) > 1:
+            cmin = _reduce2x2(cmin, N.min)
+            cmax = _reduce2x2(cmax, N.max)
+            self._min.append(cmin)
+            self._max.append(cmax)
+
+        self._top = len(self._max)-1
+
+
+    def getLevels(self):
+        return len(self._max)
+
+
+    # (min, max) arrays of a level (quantized like the heights)
+    def getLevel(self, level):
+        return self._min[level], self._max[level]
+
+
+    # bounding boxes (n,2,3) of all the nodes of a level, with real heights
+    def getNodeBoxes(self, level):
+        cmin, cmax = self._min[level], self._max[level]
+        rows, cols = cmax.shape
+        size = 1 << level
+
+        y, x = N.mgrid[0:rows, 0:cols]
+        boxes = N.empty((rows*cols, 2, 3), dtype="f")
+        boxes[:,0,0] = x.ravel() * size
+        boxes[:,0,1] = y.ravel() * size
+        boxes[:,0,2] = cmin.ravel() * self._scale + self._offset
+        boxes[:,1,0] = N.minimum((x.ravel()+1) * size, self._size[0])
+        boxes[:,1,1] = N.minimum((y.ravel()+1) * size, self._size[1])
+        boxes[:,1,2] = cmax.ravel() * self._scale + self._offset
+        return boxes
+
+
+    # returns the distance along the (normalized) direction of the first
+    # intersection of the ray with the height map, or None if there's
+    # none within max_dist
+    def raycast(self, origin, direction, max_dist):
+        ox, oy, oz = [float(v) for v in origin]
+        dx, dy, dz = [float(v) for v in direction]
+
+        l = math.sqrt(dx*dx + dy*dy + dz*dz)
+        if l == 0:
+            return None
+        dx /= l; dy /= l; dz /= l
+
+        inv_dx = 1.0/dx if dx != 0 else float("inf")
+        inv_dy = 1.0/dy if dy != 0 else float("inf")
+
+        # clip the ray to the map
+        t0, t1 = 0.0, float(max_dist)
+        for o, d, inv, size in ((ox, dx, inv_dx, self._size[0]), (oy, dy, inv_dy, self._size[1])):
+            if d == 0:
+                if o < 0 or o > size:
+                    return None
+                continue
+            ta = -o * inv
+            tb = (size - o) * inv
+            if ta > tb:
+                ta, tb = tb, ta
+            t0 = max(t0, ta)
+            t1 = min(t1, tb)
+        if t0 > t1:
+            return None
+
+        eps = 1e-5
+        t = t0
+        level = self._top
+        last_x, last_y = self._size[0]-1, self._size[1]-1
+
+        while t <= t1:
+            size = 1 << level
+            x = ox + dx*t
+            y = oy + dy*t
+
+            cx = min(int(x), last_x) >> level
+            cy = min(int(y), last_y) >> level
+
+            # where the ray leaves the node
+            if dx > 0:
+                tx = ((cx+1) * size - ox) * inv_dx
+            elif dx < 0:
+                tx = (cx * size - ox) * inv_dx
+            else:
+                tx = t1
+            if dy > 0:
+                ty = ((cy+1) * size - oy) * inv_dy
+            elif dy < 0:
+                ty = (cy * size - oy) * inv_dy
+            else:
+                ty = t1
+            t_exit = min(tx, ty, t1)
+
+            z0 = oz + dz*t
+            z1 = oz + dz*t_exit
+
+            if min(z0, z1) > self._max[level][cy, cx] * self._scale + self._offset:
+                # the ray passes over the whole node
+                t = t_exit + eps
+                if level < self._top:
+                    level += 1
+                continue
+
+            if level > 0:
+                level -= 1
+                continue
+
+            # single cell. If the ray is already below it, it's a hit
+            if max(z0, z1) < self._min[0][cy, cx] * self._scale + self._offset:
+                return t
+
+            hit = self._intersectCell(cx, cy, (ox,oy,oz), (dx,dy,dz), t, t_exit)
+            if hit is not None:
+                return hit
+
+            t = t_exit + eps
+
+        return None
+
+
+    # intersects the ray with the two triangles of a cell, within [t0,t1]
+    def _intersectCell(self, cx, cy, origin, direction, t0, t1):
+        m = self._heights
+        s = self._scale
+        o = self._offset
+        p00 = (cx, cy, m[cy,cx] * s + o)
+        p10 = (cx+1, cy, m[cy,cx+1] * s + o)
+        p01 = (cx, cy+1, m[cy+1,cx] * s + o)
+        p11 = (cx+1, cy+1, m[cy+1,cx+1] * s + o)
+
+        best = None
+        for tri in ((p00, p10, p01), (p11, p10, p01)):
+            t = _rayTriangle(origin, direction, *tri)
+            if t is not None and t >= t0 - 1e-4 and t <= t1 + 1e-4:
+                if best is None or t < best:
+                    best = t
+        return best
+
+
+
+# Moller-Trumbore ray/triangle intersection. Returns the ray distance or None
+def _rayTriangle(o, d, a, b, c):
+    e1 = (b[0]-a[0], b[1]-a[1], b[2]-a[2])
+    e2 = (c[0]-a[0], c[1]-a[1], c[2]-a[2])
+
+    px = d[1]*e2[2] - d[2]*e2[1]
+    py = d[2]*e2[0] - d[0]*e2[2]
+    pz = d[0]*e2[1] - d[1]*e2[0]
+
+    det = e1[0]*px + e1[1]*py + e1[2]*pz
+    if -1e-9 < det < 1e-9:
+        return None
+    inv = 1.0/det
+
+    sx, sy, sz = o[0]-a[0], o[1]-a[1], o[2]-a[2]
+    u = (sx*px + sy*py + sz*pz) * inv
+    if u < -1e-6 or u > 1+1e-6:
+        return None
+
+    qx = sy*e1[2] - sz*e1[1]
+    qy = sz*e1[0] - sx*e1[2]
+    qz = sx*e1[1] - sy*e1[0]
+
+    v = (d[0]*qx + d[1]*qy + d[2]*qz) * inv
+    if v < -1e-6 or u+v > 1+1e-6:
+        return None
+
+    return (e2[0]*qx + e2[1]*qy + e2[2]*qz) * inv
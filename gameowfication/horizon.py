@@ -0,0 +1,168 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# Horizon occlusion culling for the terrain.
+#
+# The terrain is a height field: everything under the lowest point of a
+# region of the map is solid. The top of that solid part (a flat box at the
+# minimum height of the region) is projected to the screen and raises a 1D
+# horizon buffer (one maximum height per screen column). A box that is
+# further away than the occluders and projects completely under the horizon
+# can't be seen.
+#
+# The occluders are swept front-to-back (by their furthest distance to the
+# camera) and the horizon after every occluder is kept, so a box is only
+# tested against the occluders that are completely in front of it.
+
+import numpy as N
+from terrainlod import distanceToBoxes
+
+# the 8 corners of a box, as indices into bounds[i] (min/max for x, y, z)
+_corner_sel = N.array([(i&1, (i>>1)&1, (i>>2)&1) for i in xrange(8)])
+
+_min_w = 1e-3 # boxes closer than this to the camera plane are never culled
+
+
+# projects the corners of the boxes (n,2,3) at the given heights z (n,).
+# if z is None all 8 corners are projected, otherwise only the 4 top ones
+# at height z. Returns the screen x, y (in NDC) and w of every corner
+def projectBoxCorners(view_proj_m, bounds, z=None):
+    bounds = N.asarray(bounds, dtype="f")
+    n = len(bounds)
+
+    if z is None:
+        sel = _corner_sel
+    else:
+        sel = _corner_sel[:4]
+
+    pts = N.ones((n, len(sel), 4), dtype="f")
+    pts[:,:,0] = bounds[:,sel[:,0],0]
+    pts[:,:,1] = bounds[:,sel[:,1],1]
+    if z is None:
+        pts[:,:,2] = bounds[:,sel[:,2],2]
+    else:
+        pts[:,:,2] = N.asarray(z, dtype="f")[:,None]
+
+    clip = N.dot(pts, N.asarray(view_proj_m, dtype="f").T)
+    w = clip[:,:,3]
+    safe_w = N.where(w > _min_w, w, 1.0)
+
+    return clip[:,:,0] / safe_w, clip[:,:,1] / safe_w, w
+
+
+class HorizonBuffer:
+    # occluders: (n,2,3) boxes, only their minimum height (the top of the
+    # solid part) and their x,y extents are used
+    def __init__(self, view_proj_m, eye, occluders, columns=256):
+        self._view_proj_m = view_proj_m
+        self._eye = N.asarray(eye, dtype="f")
+        self._columns = columns
+
+        occluders = N.asarray(occluders, dtype="f").reshape(-1,2,3)
+
+        x, y, w = projectBoxCorners(view_proj_m, occluders, occluders[:,0,2])
+        keep = (w > _min_w).all(axis=1)
+
+        x = x[keep]
+        y = y[keep]
+        far = self.farDistances(occluders[keep])
+        order = N.argsort(far)
+        self._far = far[order]
+
+        top = self.topEdges((x[order] + 1) * (0.5 * columns), y[order])
+
+        # layers[k] is the horizon after the k nearest occluders
+        layers = N.empty((len(top)+1, columns), dtype="f")
+        layers[0] = -N.inf
+        layers[1:] = top
+        self._layers = N.maximum.accumulate(layers, axis=0)
+
+
+    # top edge of the projected tops of the occluders, for every column.
+    # s, y: (n,4) screen columns and heights of the 4 corners (in the order
+    # of _corner_sel). -inf where a column isn't completely covered
+    def topEdges(self, s, y):
+        columns = self._columns
+
+        # the 4 sides of every top rectangle
+        a = N.array((0, 1, 3, 2))
+        b = N.array((1, 3, 2, 0))
+        s0 = s[:,a,None]
+        s1 = s[:,b,None]
+        y0 = y[:,a,None]
+        y1 = y[:,b,None]
+
+        # height of every side at the borders between columns. The top edge of
+        # a convex polygon is the highest of its sides
+        e = N.arange(columns+1, dtype="f")[None,None,:]
+        lo = N.minimum(s0, s1)
+        hi = N.maximum(s0, s1)
+        t = (e - s0) / N.where(s1 != s0, s1 - s0, 1)
+        side_y = N.where((e >= lo) & (e <= hi), y0 + t * (y1 - y0), -N.inf)
+        edge_y = side_y.max(axis=1)
+
+        # the top edge is concave, within a column it never goes under the
+        # lowest of its borders
+        return N.minimum(edge_y[:,:-1], edge_y[:,1:])
+
+
+    # distance from the eye to the furthest corner of every box
+    def farDistances(self, bounds):
+        d = N.maximum(N.abs(bounds[:,0,:] - self._eye), N.abs(bounds[:,1,:] - self._eye))
+        return N.sqrt((d*d).sum(axis=1))
+
+
+    def getOccludersCount(self):
+        return len(self._far)
+
+
+    # the horizon in NDC y for every column, after all the occluders
+    def getHorizon(self):
+        return self._layers[-1]
+
+
+    # boolean array, True for every box (n,2,3) hidden behind the horizon
+    def occluded(self, bounds):
+        bounds = N.asarray(bounds, dtype="f").reshape(-1,2,3)
+        columns = self._columns
+
+        x, y, w = projectBoxCorners(self._view_proj_m, bounds)
+        s = (x + 1) * (0.5 * columns)
+
+        c0 = N.floor(s.min(axis=1)).astype(int)
+        c1 = N.floor(s.max(axis=1)).astype(int)
+
+        valid = (w > _min_w).all(axis=1) & (c1 >= 0) & (c0 < columns)
+        c0 = N.clip(c0, 0, columns-1)
+        c1 = N.clip(c1, 0, columns-1)
+
+        # horizon made only by the occluders completely in front of each box
+        k = N.searchsorted(self._far, distanceToBoxes(self._eye, bounds))
+        layers = self._layers[k]
+
+        cols = N.arange(columns)
+        span = (cols[None,:] >= c0[:,None]) & (cols[None,:] <= c1[:,None])
+        horizon = N.where(span, layers, N.inf).min(axis=1)
+
+        return valid & (y.max(axis=1) < horizon)
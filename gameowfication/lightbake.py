@@ -0,0 +1,126 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# Baked terrain lighting. The light doesn't move, so the diffuse lighting,
+# the shadows and the ambient occlusion of the terrain are computed once
+# when the map loads and sampled by the "_lit" terrain shaders.
+#
+# Both the shadows and the ambient occlusion come from the horizon of every
+# point of the map: the steepest slope to the points found at increasing
+# distances along a direction. All the points of the map are done at once.
+
+import hashlib
+import math
+import numpy as N
+
+
+# a[y+dy, x+dx] for every point, clamped to the edges of the map
+def _shifted(a, dx, dy):
+    h,w = a.shape
+    rows = N.clip(N.arange(h) + dy, 0, h-1)
+    cols = N.clip(N.arange(w) + dx, 0, w-1)
+    return a.take(rows, axis=0).take(cols, axis=1)
+
+
+# distances 1, 2, 4... up to max_dist
+def _distances(max_dist):
+    return [1 << i for i in xrange(int(math.log(max(max_dist,1), 2)) + 1)]
+
+
+# tangent of the elevation angle of the horizon of every point, looking
+# along the direction of the given azimuth (radians). Never under 0
+def horizonTangents(heights, azimuth, max_dist=32):
+    heights = N.asarray(heights, dtype="f")
+    ca = math.cos(azimuth)
+    sa = math.sin(azimuth)
+
+    tangents = N.zeros_like(heights)
+    for d in _distances(max_dist):
+        dx = int(round(ca * d))
+        dy = int(round(sa * d))
+        if dx == 0 and dy == 0:
+            continue
+        dist = math.sqrt(dx*dx + dy*dy)
+        N.maximum(tangents, (_shifted(heights, dx, dy) - heights) / dist, tangents)
+
+    return tangents
+
+
+# fraction of the sky seen by every point (1 on a flat plain)
+def ambientOcclusion(heights, directions=16, max_dist=32):
+    ao = N.zeros(N.shape(heights), dtype="f")
+    for i in xrange(directions):
+        t = horizonTangents(heights, 2 * math.pi * i / directions, max_dist)
+        ao += t / N.sqrt(1 + t*t) # sine of the horizon angle
+
+    return 1 - ao / directions
+
+
+# 1 where the light reaches the ground, 0 in the shadows, with a soft edge
+# of about penumbra (in tangent units) between them
+def shadowMask(heights, light_dir, max_dist=64, penumbra=0.05):
+    lx, ly, lz = light_dir
+    lh = math.sqrt(lx*lx + ly*ly)
+    if lh == 0: # light from straight above
+        return N.ones(N.shape(heights), dtype="f")
+
+    t = horizonTangents(heights, math.atan2(ly, lx), max_dist)
+    return N.clip(0.5 + (lz / lh - t) / (2 * penumbra), 0, 1)
+
+
+# light of every point of the map, between 0 and 1.
+# light_dir points towards the light (needn't be normalized)
+def bakeLightMap(heights, normals, light_dir, ambient=0.35, directions=16, max_dist=32):
+    l = N.asarray(light_dir, dtype="f")
+    l = l / N.sqrt((l*l).sum())
+
+    diffuse = N.maximum(N.dot(normals, l), 0) * shadowMask(heights, l, 2 * max_dist)
+    ao = ambientOcclusion(heights, directions, max_dist)
+
+    return N.array(ambient * ao + (1 - ambient) * diffuse * ao, dtype="f")
+
+
+# bakeLightMap, reusing the one saved in filename if it was baked from the
+# same heights and parameters. The new bake is saved if possible
+def loadOrBakeLightMap(filename, heights, normals, light_dir, ambient=0.35, directions=16, max_dist=32):
+    heights = N.ascontiguousarray(heights, dtype="f")
+    key = hashlib.md5(heights.tostring()).hexdigest() + repr((tuple(light_dir), ambient, directions, max_dist))
+
+    try:
+        cached = N.load(filename)
+        if str(cached["key"]) == key:
+            return cached["light"]
+    except:
+        pass
+
+    print "Baking light map..."
+    light = bakeLightMap(heights, normals, light_dir, ambient, directions, max_dist)
+
+    try:
+        with open(filename, "wb") as f:
+            N.savez(f, key=N.array(key), light=light)
+    except:
+        print "Couldn't save the light map to", filename
+
+    return light
@@ -23,11 +23,13 @@ SOFTWARE.
 """
 
 
+import numpy as N
 from scene import Scene
 from map import Map
 from player import Player
 from camera import Camera
 from particles import *
+from trails import TrailRenderer
 from base import Base
 from targetpoint import TargetPoint
 from routing import *
@@ -46,6 +48,8 @@ class MainScene(Scene):
         Scene.init(self)
         self._game_over = False
         self._router = None
+        self._map = None
+        self._occluded_entities = 0
         self._total_tp = 0
         self._total_tp_reached = 0
         self._data_collected = 0
@@ -78,7 +82,9 @@ class MainScene(Scene):
 
         self._camera = Camera(self._player, self._map)
 
-        self._particles = ParticleController()
+        self._particles = ParticleController(self._map.getMaxParticles(), single_draw=self._map.usesParticleAtlas())
+
+        self._trails = TrailRenderer()
 
         self._router = RouterBatchProcessor(Router(self._map, pos, 65))
 
@@ -209,6 +215,10 @@ class MainScene(Scene):
         return self._particles
 
 
+    def getTrailRenderer(self):
+        return self._trails
+
+
     def placeInitialLocations(self):
         self._total_tp = 0
 
@@ -233,7 +243,8 @@ class MainScene(Scene):
     def placeBase(self, pos):
 
 
-        pg = ParticleGenerator("billboard","particle5.png")
+        # the base keeps it to destroy it
+        pg = self._particles.getGenerator("billboard","particle5.png", keep=True)
         pg.setEasing(0.2,0.2,0.0,0.5,2.0)
         pg.setBrightness(0.5)
         pg.setMode("LOOP")
@@ -311,6 +322,23 @@ class MainScene(Scene):
 
 
 
+    # draws the entities that aren't hidden behind the terrain
+    def drawUnoccluded(self, *entity_lists):
+        entities = [e for l in entity_lists for e in l]
+        if not entities:
+            return
+
+        # some entities have no bounds, so grow them a bit
+        bounds = N.array([e.getWorldBounds(2.0) for e in entities], dtype="f")
+        hidden = self._map.getOccluded(bounds)
+
+        for e, h in zip(entities, hidden):
+            if not h:
+                e.draw(self)
+
+        self._occluded_entities = int(hidden.sum())
+
+
     def advance(self, screen, time, inp):
         if self._time_z == 0:
             self._time_z = time
@@ -332,7 +360,11 @@ class MainScene(Scene):
 
         self._camera.update(time)
 
+        self._map.update(self._player.getPosition())
+
+        self._particles.setCamera(self.getEyePosition(), self.getPixelScale())
         self._particles.update(time)
+        self._trails.update(time)
 
         for e in self._bases: e.update(time)
 
@@ -381,16 +413,14 @@ class MainScene(Scene):
         self._map.draw(self)
         self._player.draw(self)
 
-        for e in self._bases: e.draw(self)
-        for e in self._target_points: e.draw(self)
-        for e in self._projectiles: e.draw(self)
-        for e in self._enemies: e.draw(self)
+        self.drawUnoccluded(self._bases, self._target_points, self._projectiles, self._enemies)
 
 
         glDepthMask(False)
         glBlendFunc(GL_SRC_ALPHA, GL_ONE)
         glEnable(GL_BLEND)
 
+        self._trails.draw(self)
         self._particles.draw(self) # very last thing to draw
         for e in self._target_points: e.drawBeacon(self)
 
@@ -451,6 +481,8 @@ class MainScene(Scene):
         if self._router:
             self._router.finish()
         self._router = None
+        if self._map:
+            self._map.destroy()
 
 
     def __del__(self):
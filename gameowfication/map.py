@@ -36,6 +36,11 @@ import numpy as N
 import resources as R
 from gltools import *
 from mathtools import *
+from terrainlod import *
+from tiledmap import *
+from heightpyramid import HeightPyramid
+from horizon import HorizonBuffer
+from lightbake import loadOrBakeLightMap
 #from OpenGL.arrays import vbo
 #from OpenGL.GL import *
 
@@ -59,9 +64,31 @@ class Map:
 
         self._indices_vbo = None
         self._map_positions_vbo = None
-        self._patch_index_offsets = []
+        self._patch_index_offsets = None
+        self._patch_counts = None
         self._total_patches = 0
+        self._visible_patches = 0
+        self._occluded_patches = 0
+        self._occluders = None
+        self._horizon = None
+        self._drawn_triangles = 0
+        self._lod_errors = None
+        self._lod_counts = None
+        self._lod_offsets = None
+        self._grid_indices_count = 0
+        self._patch_origins = None
+        self._origins_vbo = None
+        self._height_texture = None
+        self._light_map = None
+        self._light_texture = None
+        self._tiles = None
+        self._tile_size = 0
+        self._tile_textures = {}
+        self._pyramid = None
+        self._height_scale = 1.0
+        self._height_offset = 0.0
         self._vao = 0
+        self._strip_templates = {}
 
         self.loadConfig(mapfile)
 
@@ -69,12 +96,18 @@ class Map:
 
         if not no_gl:
             if self._shader_name:
+                if self._instanced_grid or self._tiled_map:
+                    self._shader_name += "_inst"
+                if self._baked_light:
+                    self._shader_name += "_lit"
                 self._shader = R.getShaderProgram(self._shader_name)
                 self._map_world_scale_loc = self._shader.getUniformPos("world_scale")
             else:
                 self._map_world_scale_loc = -1
 
-        if self._height_map is not None:
+        if self._tiled_map is not None:
+            self.loadTiledMap()
+        elif self._height_map is not None:
             self.loadMap()
 
 
@@ -110,6 +143,48 @@ class Map:
         self._texture_map = get("texture_map")
         self._detail_map = get("detail_map")
 
+        # levels of detail of the terrain patches (0 disables them) and the
+        # maximum error allowed on screen, in pixels
+        self._lod_levels = int(get("lod_levels", 0))
+        self._lod_max_error = float(get("lod_max_error", 2.0))
+
+        # draw the patches as instances of a shared grid, with the heights in a
+        # texture, instead of using a vertex buffer for the whole map.
+        # Uses the "_inst" variant of the shader. Levels of detail don't apply
+        self._instanced_grid = bool(int(get("instanced_grid", 0)))
+
+        # tiled map file (see tiledmap), used instead of height_map. The tiles
+        # within tile_radius tiles of the player are loaded in the background,
+        # keeping at most resident_tiles in memory
+        self._tiled_map = get("tiled_map")
+        self._resident_tiles = int(get("resident_tiles", 64))
+        self._tile_radius = int(get("tile_radius", 2))
+
+        # keep the heights as uint16 and the normals as two int8 (octahedral
+        # encoding) once the map is loaded: 4 bytes per point instead of 16.
+        # Not used with tiled maps
+        self._compact = bool(int(get("compact", 0))) and self._tiled_map is None
+
+        # hide the patches (and entities, see getOccluded) that are behind
+        # nearer hills. The occluders are regions of about occluder_size
+        # points (see horizon)
+        self._horizon_culling = bool(int(get("horizon_culling", 0)))
+        self._occluder_size = int(get("occluder_size", 16))
+
+        # the light doesn't move, so the lighting and ambient occlusion of the
+        # terrain are baked into a texture (see lightbake) sampled by the
+        # "_lit" variant of the shader. The bake is saved next to the height
+        # map. Not used with tiled maps
+        self._baked_light = bool(int(get("baked_light", 0))) and self._tiled_map is None
+        self._light_dir = tuple(float(v) for v in get("light_dir", "-0.5,0.1,1.0").split(","))
+        self._ambient = float(get("ambient", 0.35))
+
+        # size of the buffer shared by all the particle effects
+        self._max_particles = int(get("max_particles", 10000))
+        # draw the billboard effects in one call with a texture atlas
+        # (see ParticleController)
+        self._particle_atlas = bool(int(get("particle_atlas", 0)))
+
         self._textures = [self._texture_map, self._detail_map]
 
         for name, color in cfg.items("MapMarkerColors"):
@@ -128,6 +203,14 @@ class Map:
             return []
 
 
+    def getMaxParticles(self):
+        return self._max_particles
+
+
+    def usesParticleAtlas(self):
+        return self._particle_atlas
+
+
     def getPlayerInitialPosition(self):
         return self._map_locations["player"][0]
 
@@ -185,12 +268,61 @@ class Map:
 
         self.computeNormals()
 
+        # nothing to light without GL: don't bake (nor write the bake)
+        if self._baked_light and not self._no_gl:
+            self._light_map = loadOrBakeLightMap(R.resourcePath(self._height_map + ".light.npz"),
+                    self._map, self._normals, self._light_dir, self._ambient)
+
         if self._shader: #otherwise we assume it won't be displayed
             self.prepareTiles()
 
+            if self._light_map is not None:
+                self.prepareLightMap()
+
+        if self._compact:
+            self.compact()
+
+        self._pyramid = HeightPyramid(self._map, self._height_scale, self._height_offset)
+
         print "Loaded"
 
 
+    def loadTiledMap(self):
+        print "Loading tiled map..."
+        if not self._no_gl:
+            self.loadTextures()
+
+        tiled_file = TiledMapFile(R.resourcePath(self._tiled_map))
+
+        self._dimensions = tiled_file.getDimensions()
+        self._tile_size = tiled_file.getTileSize()
+        self._map_locations = tiled_file.getLocations()
+
+        self._tiles = TileCache(tiled_file, self._resident_tiles)
+
+        if self._shader:
+            self.prepareTiledGrid()
+
+        print "Loaded"
+
+
+    # writes the map (which must not be tiled) as a tiled map file
+    def saveTiledMap(self, filename, tile_size=200):
+        writeTiledMap(filename, self.getHeights(), self.getNormals(), self._map_locations, tile_size)
+
+
+    # starts loading the tiles around pos. Only needed for tiled maps
+    def update(self, pos):
+        if self._tiles is not None:
+            self._tiles.requestArea(pos[0], pos[1], self._tile_radius)
+
+
+    def destroy(self):
+        if self._tiles is not None:
+            self._tiles.finish()
+        self._tiles = None
+
+
     def processLocations(self, marks, colors):
         print "Fixing gaps..."
 
@@ -230,49 +362,130 @@ class Map:
 
 
 
+    # heights of the whole map, as floats. None for tiled maps
+    def getHeights(self):
+        if self._compact:
+            return self._map * N.float32(self._height_scale) + N.float32(self._height_offset)
+        return self._map
+
+
+    # None for tiled maps
     def getNormals(self):
+        if self._compact:
+            return octDecode(self._normals)
         return self._normals
 
 
+    # replaces the heights and normals by their compact versions
+    # (the heights are stored as offset + scale * uint16)
+    def compact(self):
+        zmin = float(self._map.min())
+        zmax = float(self._map.max())
+
+        self._height_offset = zmin
+        self._height_scale = (zmax - zmin) / 65535.0 if zmax > zmin else 1.0
+
+        self._map = N.array(N.round((self._map - zmin) / self._height_scale), dtype=N.uint16)
+        self._normals = octEncode(self._normals)
+
+
+    # (width, height) in vertices
+    def getDimensions(self):
+        return self._dimensions
+
+
+    # True where the normal of the vertices of the rows [y0,y1) is more
+    # horizontal than min_z. Tiled maps read one row of tiles at a time
+    def getSteepRows(self, y0, y1, min_z):
+        if self._compact:
+            return octDecode(self._normals[y0:y1])[:,:,2] < min_z
+
+        if self._tiles is None:
+            return self._normals[y0:y1,:,2] < min_z
+
+        w,h = self._dimensions
+        ts = self._tile_size
+        tiles_x, tiles_y = self._tiles.getFile().getTileCount()
+
+        y1 = min(y1, h)
+        mask = N.zeros((y1-y0, w), dtype=bool)
+
+        for ty in xrange(y0 // ts, min((y1-1) // ts + 1, tiles_y)):
+            # rows of the mask covered by this row of tiles
+            r0 = max(y0, ty*ts)
+            r1 = min(y1, ty*ts+ts+1)
+            for tx in xrange(tiles_x):
+                normals = self._tiles.peekTile(tx,ty)[1]
+                dest = mask[r0-y0:r1-y0, tx*ts:tx*ts+ts+1]
+                dest[:] = normals[r0-ty*ts:r1-ty*ts, 0:dest.shape[1], 2] < min_z
+
+        return mask
+
+
+    # boolean map of the points whose normal z is under min_z (too steep)
+    def getSteepMask(self, min_z):
+        return self.getSteepRows(0, self._dimensions[1], min_z)
+
+
     def getTotalPatchVertices(self, x0, y0, x1, y1):
         dx = x1-x0
         dy = y1-y0
         n = (dx * (2*dy-2) + (dy-2)*2)
         return n
 
-        # x1 and y1 are NOT included
+    # indices of a patch of dx*dy vertices whose top-left vertex is vertex 0.
+    # The strips of any patch of the same size are this template plus the
+    # index of the patch's top-left vertex
+    def getPatchTriStripsTemplate(self, dx, dy):
+        try:
+            return self._strip_templates[(dx,dy)]
+        except:
+            pass
+
+        w = self._dimensions[0]
+
+        # one row of the strip: zig-zag between the row and the one below,
+        # then two degenerate vertices to jump back to the left
+        row = N.empty(2*dx+2, dtype=N.int32)
+        row[0:2*dx:2] = N.arange(dx) # top
+        row[1:2*dx:2] = N.arange(dx) + w # bottom
+        row[2*dx] = w + dx-1 # degenerate vertex (down-left)
+        row[2*dx+1] = w # degenerate vertex (all the way left)
+
+        tmpl = (N.arange(dy-1, dtype=N.int32) * w)[:,None] + row[None,:]
+        tmpl = tmpl.ravel()[:-2] # the last row has no degenerate vertices
+
+        self._strip_templates[(dx,dy)] = tmpl
+        return tmpl
+
+
+    # x1 and y1 are NOT included
     def calcPatchTriStripsIndices(self, x0, y0, x1, y1):
         w = self._dimensions[0]
-        dx = x1-x0
-        dy = y1-y0
+        return self.getPatchTriStripsTemplate(x1-x0, y1-y0) + (w * y0 + x0)
+
 
-        idx = N.zeros( self.getTotalPatchVertices(x0,y0,x1,y1))
-
-        y_2 = y1-2
-        w_1 = w-1
-        dx_1 = dx-1
-        j = 0
-        p = w * y0 + x0
-        y = y0
-
-        while (True):
-            for x in xrange(dx):
-                idx[j] = p
-                j += 1
-                p+= w # move down
-                idx[j] = p
-                j += 1
-                p-= w_1 # move up-right
-            if y == y_2: break
-            p += w_1 # move down-left
-            idx[j] = p # degenerate vertex
-            j += 1
-            p -= dx_1 # move all the way left
-            idx[j] = p # degenerate vertex
-            j += 1
-            y += 1
-
-        return idx
+    # computes the indices of all patches at once. Returns the indices
+    # array plus a (total indices, first index) pair per patch
+    def calcAllPatchesTriStripsIndices(self, patches):
+        w = self._dimensions[0]
+
+        rects = N.array(patches, dtype=N.int32).reshape(-1,4)
+
+        counts = N.array([self.getTotalPatchVertices(*p) for p in patches], dtype=N.int32)
+        firsts = N.zeros(len(patches), dtype=N.int32)
+        firsts[1:] = N.cumsum(counts)[:-1]
+
+        indices = N.empty(int(counts.sum()), dtype=N.int32)
+
+        # every patch is its template (one per patch size, see
+        # getPatchTriStripsTemplate) moved to its corner, written straight
+        # into its slice of the buffer
+        for (x0,y0,x1,y1), first, count in zip(rects, firsts, counts):
+            tmpl = self.getPatchTriStripsTemplate(x1-x0, y1-y0)
+            N.add(tmpl, y0 * w + x0, out=indices[first:first+count])
+
+        return indices, N.column_stack((counts, firsts))
 
     # get the rects (extensions) of all patches (x0,y0,x1,y1)
     def computePatchRects(self, patch_w = 200, patch_h = 200):
@@ -293,9 +506,33 @@ class Map:
 
         return rects
 
+    # bounding box (min and max corners) of every patch
+    def computePatchBounds(self, patches):
+        self._patch_bounds = N.zeros((len(patches), 2, 3), dtype = "f")
+
+        for i, (x0,y0,x1,y1) in enumerate(patches):
+            pvals = self._map[y0:y1, x0:x1]
+            self._patch_bounds[i] = ((x0,y0,pvals.min()),(x1-1, y1-1,pvals.max()))
+
+
+    def prepareLightMap(self):
+        self._light_texture = Texture()
+        self._light_texture.setFromArray(self._light_map)
+        self._textures.append(self._light_texture.getBinder(3, self._shader.getUniformPos("light_map")))
+
+
+    # light baked for every point of the map (see lightbake), None if the
+    # map isn't using baked lighting
+    def getLightMap(self):
+        return self._light_map
+
+
     # TODO: create VBO and VAO in constructor
     def prepareTiles(self):
 
+        if self._instanced_grid:
+            return self.prepareGridMesh()
+
         self._vao = glGenVertexArray()
         glBindVertexArray(self._vao)
 
@@ -311,6 +548,19 @@ class Map:
 
         vertices[:,2] = self._map.ravel()
 
+        patches = self.computePatchRects()
+
+        self._total_patches  = len(patches)
+
+        print "total patches: ",self._total_patches
+
+        if self._lod_levels > 0:
+            vertices, indices = self.prepareLodPatches(patches, vertices)
+        else:
+            indices, self._patch_indices = self.calcAllPatchesTriStripsIndices(patches)
+
+        print "total indices: ",indices.shape[0]
+
         self._map_positions_vbo = vbo.VBO(vertices,usage=GL_STATIC_DRAW)
         self._map_positions_vbo.bind()
         self._map_positions_vbo.copy_data()
@@ -318,92 +568,343 @@ class Map:
         glEnableVertexAttribArray(self._shader.attr_position)
         glVertexAttribPointer(self._shader.attr_position, 3, GL_FLOAT, False, 0, None)
 
-        patches = self.computePatchRects()
+        self.computePatchBounds(patches)
 
-        self._total_patches  = len(patches)
+        #Create the index buffer object
+        self._indices_vbo = vbo.VBO(indices, target=GL_ELEMENT_ARRAY_BUFFER)
+
+
+        self._indices_vbo.bind()
+        self._indices_vbo.copy_data()
+
+        if self._lod_levels == 0:
+            # (total indices, byte offset of the first index) of every patch, laid
+            # out the way glMultiDrawElements wants them
+            self._patch_counts = N.ascontiguousarray(self._patch_indices[:,0], dtype=N.int32)
+            self._patch_index_offsets = N.ascontiguousarray(
+                    self._patch_indices[:,1] * ctypes.sizeof(ctypes.c_int32), dtype=N.uintp)
+
+        glBindVertexArray(0)
+
+
+    # alternative to the vertex buffer covering the whole map: all the patches
+    # are instances of the same grid of vertices. The vertex shader moves the
+    # grid to the patch origin and reads the heights from a texture
+    def prepareGridMesh(self, patch_w = 200, patch_h = 200):
+
+        self.createGridMesh(patch_w+1, patch_h+1)
+
+        patches = self.computePatchRects(patch_w, patch_h)
+        self._total_patches = len(patches)
+        self.computePatchBounds(patches)
 
         print "total patches: ",self._total_patches
 
-        total_indices = sum(map(lambda p:self.getTotalPatchVertices(*p), patches))
+        # per instance attribute, rewritten every frame with the visible patches
+        self._patch_origins = N.array([p[0:2] for p in patches], dtype="f")
+        self._origins_vbo = vbo.VBO(self._patch_origins, usage=GL_STREAM_DRAW)
+        self._origins_vbo.bind()
 
-        print "total indices: ",total_indices
+        loc = self._shader.getAttribPos("patch_origin", True)
+        glEnableVertexAttribArray(loc)
+        glVertexAttribPointer(loc, 2, GL_FLOAT, False, 0, None)
+        glVertexAttribDivisor(loc, 1)
 
-        indices = N.zeros(total_indices, dtype = N.int32) # make a large enough array
+        # texture0 and texture1 are the color and detail maps
+        self._height_texture = Texture(smoothing=False)
+        self._height_texture.setFromArray(self._map)
+        self._textures.append(self._height_texture.getBinder(2, self._shader.getUniformPos("height_map")))
 
-        self._patch_bounds = N.zeros((self._total_patches, 2, 3), dtype = "f")
-        self._patch_indices = N.zeros((self._total_patches, 2), dtype=N.int32)
+        glBindVertexArray(0)
 
-        i_pos = 0
-        i = 0
-        for x0,y0,x1,y1 in patches:
-            # append the indices of the patch to the list of indices
-            p_idx = self.calcPatchTriStripsIndices(x0,y0,x1,y1)
-            p_size = p_idx.shape[0]
-            indices[i_pos:i_pos+p_size]=p_idx
-            # compute the bounding box of the patch
-            pvals = self._map[y0:y1, x0:x1].ravel()
-
-            z0 = min(pvals)
-            z1 = max(pvals)
-            self._patch_bounds[i] = ((x0,y0,z0),(x1-1, y1-1,z1))
-            self._patch_indices[i] = (p_size, i_pos)  # (total indices, first index) of patch
-            # update the index offset
-            i_pos += p_size
-            i += 1
 
-        #Create the index buffer object
-        self._indices_vbo = vbo.VBO(indices, target=GL_ELEMENT_ARRAY_BUFFER)
+    # vertex and index buffers of a grid of gw x gh vertices, shared by all
+    # patches/tiles
+    def createGridMesh(self, gw, gh):
+
+        self._vao = glGenVertexArray()
+        glBindVertexArray(self._vao)
+
+        print "Creating grid VBO...", gw, gh
+
+        grid = cartesianProduct([N.arange(gh), N.arange(gw)])
+        swapColumns(grid,0,1) # x first
+        grid = N.array(grid, dtype=N.uint16)
 
+        self._map_positions_vbo = vbo.VBO(grid,usage=GL_STATIC_DRAW)
+        self._map_positions_vbo.bind()
+
+        glEnableVertexAttribArray(self._shader.attr_position)
+        glVertexAttribPointer(self._shader.attr_position, 2, GL_UNSIGNED_SHORT, False, 0, None)
 
+        # the vertices of the patches at the right and bottom borders that fall
+        # outside the map are clamped to its edge in the shader
+        indices = N.array(gridStrip(N.arange(gh), N.arange(gw), gw), dtype=N.uint16)
+        self._grid_indices_count = indices.shape[0]
+
+        self._indices_vbo = vbo.VBO(indices, target=GL_ELEMENT_ARRAY_BUFFER)
         self._indices_vbo.bind()
-        self._indices_vbo.copy_data()
 
-        for i in xrange(self._total_patches):
-            ofs = int(self._patch_indices[i][1]) * ctypes.sizeof(ctypes.c_int32)
-            self._patch_index_offsets.append(ctypes.c_void_p(ofs))
+
+    # every tile of a tiled map is drawn with the shared grid and its own
+    # height texture, created when the tile is first drawn
+    def prepareTiledGrid(self):
+        ts = self._tile_size
+        w,h = self._dimensions
+
+        self.createGridMesh(ts+1, ts+1)
+
+        # the patch origin is set for every tile, as a constant attribute
+        self._patch_origin_loc = self._shader.getAttribPos("patch_origin", True)
+        glDisableVertexAttribArray(self._patch_origin_loc)
 
         glBindVertexArray(0)
 
+        self._height_map_loc = self._shader.getUniformPos("height_map")
+        self._height_origin_loc = self._shader.getUniformPos("height_origin")
+
+        # the patches are the tiles. Their bounds come from the tile index
+        zmin, zmax = self._tiles.getFile().getHeightRanges()
+        ty, tx = N.mgrid[0:zmin.shape[0], 0:zmin.shape[1]]
+        x0 = tx.ravel() * ts
+        y0 = ty.ravel() * ts
+
+        self._total_patches = x0.shape[0]
+        self._patch_bounds = N.zeros((self._total_patches, 2, 3), dtype = "f")
+        self._patch_bounds[:,0,0] = x0
+        self._patch_bounds[:,0,1] = y0
+        self._patch_bounds[:,0,2] = zmin.ravel()
+        self._patch_bounds[:,1,0] = N.minimum(x0 + ts, w-1)
+        self._patch_bounds[:,1,1] = N.minimum(y0 + ts, h-1)
+        self._patch_bounds[:,1,2] = zmax.ravel()
+
+
+    # builds one strip per level of detail for every patch (see terrainlod).
+    # Adds the skirt vertices to the vertices array and returns it
+    # along with the indices of all the strips
+    def prepareLodPatches(self, patches, vertices):
+        w,h = self._dimensions
+        levels = self._lod_levels
+        n = len(patches)
+
+        self._lod_errors = N.array([patchLevelErrors(self._map[y0:y1,x0:x1], levels)
+                                        for x0,y0,x1,y1 in patches], dtype="f")
+
+        # the skirts must be deep enough to cover the largest crack
+        skirt_depth = self._lod_errors[:,-1].max() + 0.1
+
+        # skirt vertices: a lowered copy of the vertices along the columns
+        # and rows shared by the patches
+        border_x = sorted(set([p[0] for p in patches] + [p[2]-1 for p in patches]))
+        border_y = sorted(set([p[1] for p in patches] + [p[3]-1 for p in patches]))
+        skirt_col = dict((x,i) for i,x in enumerate(border_x))
+        skirt_row = dict((y,i) for i,y in enumerate(border_y))
+
+        col_base = w*h # first vertex of the column skirts
+        row_base = col_base + len(border_x)*h # first vertex of the row skirts
+
+        col_skirts = N.empty((len(border_x)*h, 3), dtype="f")
+        col_skirts[:,0] = N.repeat(border_x, h)
+        col_skirts[:,1] = N.tile(N.arange(h), len(border_x))
+        col_skirts[:,2] = self._map[:,border_x].T.ravel() - skirt_depth
+
+        row_skirts = N.empty((len(border_y)*w, 3), dtype="f")
+        row_skirts[:,0] = N.tile(N.arange(w), len(border_y))
+        row_skirts[:,1] = N.repeat(border_y, w)
+        row_skirts[:,2] = self._map[border_y,:].ravel() - skirt_depth
+
+        vertices = N.concatenate((vertices, col_skirts, row_skirts))
+
+        strips = []
+        counts = N.zeros((n, levels), dtype=N.int32)
+        firsts = N.zeros((n, levels), dtype=N.int32)
+        i_pos = 0
+
+        for i,(x0,y0,x1,y1) in enumerate(patches):
+            for k in xrange(levels):
+                rows = levelSamples(y1-y0, 1<<k) + y0
+                cols = levelSamples(x1-x0, 1<<k) + x0
+
+                top = ribbonStrip(y0*w + cols, row_base + skirt_row[y0]*w + cols)
+                bottom = ribbonStrip((y1-1)*w + cols, row_base + skirt_row[y1-1]*w + cols)
+                left = ribbonStrip(rows*w + x0, col_base + skirt_col[x0]*h + rows)
+                right = ribbonStrip(rows*w + x1-1, col_base + skirt_col[x1-1]*h + rows)
+
+                strip = joinStrips((gridStrip(rows, cols, w), top, right, bottom, left))
+
+                strips.append(strip)
+                counts[i,k] = strip.shape[0]
+                firsts[i,k] = i_pos
+                i_pos += strip.shape[0]
+
+        self._lod_counts = counts
+        self._lod_offsets = N.ascontiguousarray(firsts * ctypes.sizeof(ctypes.c_int32), dtype=N.uintp)
+
+        return vertices, N.concatenate(strips)
+
+
+    # level of detail to use for each of the given patches, seen from eye
+    def getPatchLevels(self, patches, eye, pixel_scale):
+        dist = distanceToBoxes(eye, self._patch_bounds[patches])
+        return selectPatchLevels(self._lod_errors[patches], dist, pixel_scale, self._lod_max_error)
+
     # evaluate the map at a given coordinate
     def __call__(self, x, y, with_normal=True):
-        m = self._map
-        n = self._normals
+        if self._tiles is None:
+            if self._compact:
+                return self.interpolateCompact(x, y, with_normal)
+            return self.interpolate(self._map, self._normals, x, y, with_normal)
+
+        # tiled map: evaluate within the tile that contains the point
+        ts = self._tile_size
+        tx = int(x) // ts
+        ty = int(y) // ts
+
+        tile = self._tiles.getTile(tx,ty)
+
+        if tile is None: # outside the map
+            if not with_normal:
+                return 0.0
+            return 0.0, N.array((0,0,1),dtype="float")
+
+        return self.interpolate(tile[0], tile[1], x - tx*ts, y - ty*ts, with_normal)
+
+
+    # first intersection of a ray with the terrain within max_dist.
+    # Returns (point, normal) or None
+    def raycast(self, origin, direction, max_dist):
+        origin = N.asarray(origin, dtype="f")
+        direction = N.asarray(direction, dtype="f")
+        l = math.sqrt(N.dot(direction, direction))
+        if l == 0:
+            return None
+        direction = direction / l
+
+        if self._pyramid is not None:
+            t = self._pyramid.raycast(origin, direction, max_dist)
+        else:
+            t = self.marchRay(origin, direction, max_dist)
+
+        if t is None:
+            return None
 
+        point = origin + direction * t
+        z, normal = self(point[0], point[1])
+
+        return point, normal
+
+
+    # raycast for tiled maps (there's no pyramid of the whole map): walks
+    # the ray in steps of half a cell
+    def marchRay(self, origin, direction, max_dist, step=0.5):
+        t = 0.0
+        while t <= max_dist:
+            p = origin + direction * t
+            if self(p[0], p[1], False) >= p[2]:
+                return t
+            t += step
+        return None
+
+
+    # the vertices (row, column) of the triangle of the map that contains
+    # the point (x,y), and their barycentric weights
+    def triangleAt(self, x, y):
         xf,xi = math.modf(x)
         yf,yi = math.modf(y)
+        xi = int(xi)
+        yi = int(yi)
+
+        if (xf > (1-yf)): # triangle of points [x,y+1], [x+1,y], [x+1,y+1]
+            return ((yi+1,xi+1), (yi,xi+1), (yi+1,xi)), (xf+yf-1, 1-yf, 1-xf)
+        else: # triangle of points [x,y], [x,y+1], [x+1,y]
+            return ((yi,xi), (yi,xi+1), (yi+1,xi)), (1-xf-yf, xf, yf)
+
 
+    # evaluate the heights m and normals n at a given coordinate
+    def interpolate(self, m, n, x, y, with_normal=True):
         try:
-            if (xf > (1-yf)): # triangle of points [x,y+1], [x+1,y], [x+1,y+1]
-                xf = 1-xf
-                yf = 1-yf
-                pos = (1-xf-yf) * m[yi+1,xi+1] + yf * m[yi,xi+1] + xf * m[yi+1,xi]
-                if not with_normal:
-                    return pos
-
-                norm = (1-xf-yf) * n[yi+1,xi+1] + yf * n[yi,xi+1] + xf * n[yi+1,xi]
-                #nx = -(m[yi+1,xi+1] - m[yi+1,xi])
-                #ny = -(m[yi+1,xi+1] - m[yi,xi+1])
-                #d = 1.0/math.sqrt(1.0 + nx*nx + ny*ny)
-
-                return pos, norm #N.array((nx*d, ny*d, d), dtype="f")
-
-            else: # triangle of points [x,y], [x,y+1], [x+1,y]
-                pos = (1-xf-yf) * m[yi,xi] + xf * m[yi,xi+1] + yf * m[yi+1,xi]
-                if not with_normal:
-                    return pos
-
-                norm = (1-xf-yf) * n[yi,xi] + xf * n[yi,xi+1] + yf * n[yi+1,xi]
-                #nx = (m[xi,yi] - m[yi,xi+1])
-                #ny = (m[xi,yi] - m[yi+1,xi])
-                #d = 1.0/math.sqrt(1.0 + nx*nx + ny*ny)
-
-                return pos, norm #N.array((nx*d, ny*d, d), dtype="f")
+            (a,b,c), (wa,wb,wc) = self.triangleAt(x,y)
+
+            pos = wa * m[a] + wb * m[b] + wc * m[c]
+            if not with_normal:
+                return pos
+
+            return pos, wa * n[a] + wb * n[b] + wc * n[c]
         except:
             if not with_normal:
                 return 0.0
             return 0.0, N.array((0,0,1),dtype="float")
 
 
+    # same as interpolate, decoding the heights and normals of a compact map
+    def interpolateCompact(self, x, y, with_normal=True):
+        m = self._map
+        n = self._normals
+        try:
+            (a,b,c), (wa,wb,wc) = self.triangleAt(x,y)
+
+            pos = (wa * m[a] + wb * m[b] + wc * m[c]) * self._height_scale + self._height_offset
+            if not with_normal:
+                return pos
+
+            na, nb, nc = octDecode(N.array((n[a], n[b], n[c])))
+            return pos, wa * na + wb * nb + wc * nc
+        except:
+            if not with_normal:
+                return 0.0
+            return 0.0, N.array((0,0,1),dtype="float")
+
+
+    # returns the indices of the patches whose bounding box intersects
+    # the frustum of the given projection x modelview matrix
+    def getVisiblePatches(self, view_proj_m):
+        planes = frustumPlanes(view_proj_m)
+        return N.where(aabbInFrustum(planes, self._patch_bounds))[0]
+
+
+    # number of patches drawn in the last frame
+    def getVisiblePatchesCount(self):
+        return self._visible_patches
+
+
+    # number of patches in the frustum hidden by the horizon in the last frame
+    def getOccludedPatchesCount(self):
+        return self._occluded_patches
+
+
+    # boxes whose minimum height is used to build the horizon
+    def getOccluders(self):
+        if self._occluders is None:
+            if self._pyramid is not None:
+                level = int(round(math.log(max(self._occluder_size, 1), 2)))
+                level = min(level, self._pyramid.getLevels()-1)
+                self._occluders = self._pyramid.getNodeBoxes(level)
+            else: # tiled map
+                self._occluders = self._patch_bounds
+
+        return self._occluders
+
+
+    # rebuilds the horizon from the occluders in the frustum
+    def updateHorizon(self, view_proj_m, eye):
+        occluders = self.getOccluders()
+        occluders = occluders[aabbInFrustum(frustumPlanes(view_proj_m), occluders)]
+        self._horizon = HorizonBuffer(view_proj_m, eye, occluders)
+
+
+    # boolean array, True for the boxes (n,2,3) hidden by the terrain in the
+    # last frame drawn
+    def getOccluded(self, bounds):
+        if self._horizon is None:
+            return N.zeros(len(bounds), dtype=bool)
+        return self._horizon.occluded(bounds)
+
+
+    # number of triangles drawn in the last frame
+    def getDrawnTrianglesCount(self):
+        return self._drawn_triangles
+
+
     @profile
     def draw(self, scene):
 
@@ -418,22 +919,92 @@ class Map:
 
         self._indices_vbo.bind()
 
-        for i in xrange(self._total_patches):
-            cnt = int(self._patch_indices[i][0])
-            glDrawElements(GL_TRIANGLE_STRIP,cnt,
-                            GL_UNSIGNED_INT, self._patch_index_offsets[i])
+        view_proj_m = scene.getViewProjectionMatrix()
+        visible = self.getVisiblePatches(view_proj_m)
+
+        if self._horizon_culling:
+            self.updateHorizon(view_proj_m, scene.getEyePosition())
+            hidden = self._horizon.occluded(self._patch_bounds[visible])
+            self._occluded_patches = int(hidden.sum())
+            visible = visible[~hidden]
+
+        self._visible_patches = len(visible)
+
+        if self._tiles is not None:
+            self.drawResidentTiles(visible)
+        elif self._instanced_grid:
+            self.drawGridInstances(visible)
+        else:
+            self.drawPatches(visible, scene)
+
         self._shader.end()
 
         glBindVertexArray(0)
 
 
+    def drawPatches(self, visible, scene):
+        if self._lod_levels > 0:
+            levels = self.getPatchLevels(visible, scene.getEyePosition(), scene.getPixelScale())
+            counts = self._lod_counts[visible, levels]
+            offsets = self._lod_offsets[visible, levels]
+        else:
+            counts = self._patch_counts[visible]
+            offsets = self._patch_index_offsets[visible]
+
+        # each strip of n indices has n-2 triangles (degenerate ones included)
+        self._drawn_triangles = int(counts.sum()) - 2*self._visible_patches
+
+        # all the visible patches in a single call
+        if self._visible_patches:
+            glMultiDrawElements(GL_TRIANGLE_STRIP, counts,
+                            GL_UNSIGNED_INT, offsets,
+                            self._visible_patches)
 
 
+    def drawGridInstances(self, visible):
+        n = self._visible_patches
 
+        self._drawn_triangles = (self._grid_indices_count - 2) * n
 
+        if not n:
+            return
 
+        origins = N.ascontiguousarray(self._patch_origins[visible])
 
+        self._origins_vbo.bind()
+        glBufferSubData(GL_ARRAY_BUFFER, 0, origins.nbytes, origins.ctypes.data_as(ctypes.c_void_p))
+
+        glDrawElementsInstanced(GL_TRIANGLE_STRIP, self._grid_indices_count,
+                                GL_UNSIGNED_SHORT, None, n)
+
+
+    # draws the visible tiles that are in memory. The rest are still loading
+    def drawResidentTiles(self, visible):
+        ts = self._tile_size
+        tiles_x = self._tiles.getFile().getTileCount()[0]
+        drawn = 0
+
+        for i in visible:
+            tx, ty = i % tiles_x, i // tiles_x
+            if not self._tiles.isResident(tx,ty):
+                continue
+
+            try:
+                texture = self._tile_textures[(tx,ty)]
+            except KeyError:
+                texture = self._tile_textures[(tx,ty)] = Texture(smoothing=False)
+                texture.setFromArray(self._tiles.getTile(tx,ty)[0])
 
+            texture.bind(2, self._height_map_loc)
+            glUniform2f(self._height_origin_loc, tx*ts, ty*ts)
+            glVertexAttrib2f(self._patch_origin_loc, tx*ts, ty*ts)
 
+            glDrawElements(GL_TRIANGLE_STRIP, self._grid_indices_count, GL_UNSIGNED_SHORT, None)
+            drawn += 1
 
+        self._drawn_triangles = (self._grid_indices_count - 2) * drawn
 
+        # release the textures of the tiles dropped from the cache
+        for key in self._tile_textures.keys():
+            if not self._tiles.isResident(*key):
+                del self._tile_textures[key]
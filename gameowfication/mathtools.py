@@ -139,6 +139,77 @@ def frustumProjMtx(fovy, near, far, aspect=0):
     w = h * aspect
     return T.clip_matrix(-w, w, -h, h, near, far, perspective=True)
 
+# extracts the 6 planes (left, right, bottom, top, near, far) of the frustum
+# defined by a projection x modelview matrix. Each row is (a,b,c,d) with the
+# normal pointing inwards: a point p is inside when a*px + b*py + c*pz + d >= 0
+def frustumPlanes(view_proj_m):
+    m = N.asarray(view_proj_m, dtype="f")
+    planes = N.array((
+        m[3] + m[0], m[3] - m[0],
+        m[3] + m[1], m[3] - m[1],
+        m[3] + m[2], m[3] - m[2]), dtype="f")
+
+    # normalize, so the plane equation gives actual distances
+    planes /= N.sqrt((planes[:,0:3]**2).sum(axis=1))[:,None]
+    return planes
+
+
+# tests a set of axis aligned boxes against the frustum planes.
+# bounds is an array of shape (n,2,3) holding the (min,max) corners of each box.
+# Returns an array of n booleans, False for boxes that are completely outside.
+# It's conservative: a few boxes near the frustum corners may be reported as
+# visible when they aren't
+def aabbInFrustum(planes, bounds):
+    bounds = N.asarray(bounds, dtype="f")
+    bmin = bounds[:,0,:]
+    bmax = bounds[:,1,:]
+
+    # for every plane take the corner of the box that is furthest along
+    # the plane normal. If even that one is behind the plane, the box is out
+    normals = planes[:,0:3]
+    pos = normals[None,:,:] >= 0  # (1,6,3)
+    far_corners = N.where(pos, bmax[:,None,:], bmin[:,None,:]) # (n,6,3)
+
+    dist = (far_corners * normals[None,:,:]).sum(axis=2) + planes[None,:,3]
+
+    return (dist >= 0).all(axis=1)
+
+
+# octahedral encoding of unit vectors (last axis of normals) as two int8
+def octEncode(normals):
+    n = N.asarray(normals, dtype="f")
+    n = n / N.abs(n).sum(axis=-1)[...,None]
+    x = n[...,0]
+    y = n[...,1]
+    z = n[...,2]
+
+    sx = N.where(x >= 0, 1.0, -1.0)
+    sy = N.where(y >= 0, 1.0, -1.0)
+
+    # the lower hemisphere is folded over the corners of the square
+    u = N.where(z < 0, (1.0 - N.abs(y)) * sx, x)
+    v = N.where(z < 0, (1.0 - N.abs(x)) * sy, y)
+
+    enc = N.empty(n.shape[:-1] + (2,), dtype=N.int8)
+    enc[...,0] = N.round(N.clip(u, -1, 1) * 127)
+    enc[...,1] = N.round(N.clip(v, -1, 1) * 127)
+    return enc
+
+
+def octDecode(enc):
+    e = N.asarray(enc, dtype="f") * (1.0/127)
+    u = e[...,0]
+    v = e[...,1]
+    z = 1.0 - N.abs(u) - N.abs(v)
+
+    t = N.maximum(-z, 0)
+    x = u - N.where(u >= 0, t, -t)
+    y = v - N.where(v >= 0, t, -t)
+
+    n = N.stack((x, y, z), axis=-1)
+    return n / N.sqrt((n*n).sum(axis=-1))[...,None]
+
+
 # seg1,2 are tuples/lists/arrays like so: (x0,y0,x1,y1)
 # returns None if no intersection occurs or if it occurs but lies outside
 # the segment and only_in_segment is true
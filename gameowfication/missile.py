@@ -25,10 +25,8 @@ SOFTWARE.
 
 import libs.transformations as T
 import resources as R
-from particles import ParticleGenerator
 from entities import Entity
 from mathtools import *
-import random
 
 
 
@@ -72,31 +70,8 @@ class Missile(Entity):
 
         Entity.setBounds(self,bounds)
 
-        self._trail= ParticleGenerator("billboard","puff.jpg")
-        self._trail.setEvolveTime(0.5)
-        self._trail.setAcceleration(0)
-        self._trail.setEasing(0.5, 0.5, 0.0, 0.05, 0.2)
-        self._trail.setBrightness(0.5)
-
-        pg = scene.getParticleManager()
-
-        def em(t):
-            while True:
-                dx = 2.*random.random()-1.
-                dy = 2.*random.random()-1.
-                dz = 2.*random.random()-1.
-
-                r = dx*dx+dy*dy+dz*dz
-
-                if r < 1.0:
-                    break
-
-            return self._pos,(dx*0.2,dy*0.2,dz*0.2)
-
-        self._trail.setEmitter(em)
-        self._trail.setMode("DYNAMIC")
-
-        pg.manageGenerator(self._trail)
+        self._trails = scene.getTrailRenderer()
+        self._trail = self._trails.newTrail() # None if there's no room
 
         self._last_z = 0
 
@@ -106,21 +81,22 @@ class Missile(Entity):
     def destroy(self):
         self._destroyed = True
         Entity.destroy(self)
-        if self._trail:
-            self._trail.destroy()
+        if self._trail is not None:
+            self._trails.closeTrail(self._trail)
             self._trail = None
 
 
     def explode(self):
         self.destroy()
-        p = ParticleGenerator("billboard","particle3.png")
+        pm = self._scene.getParticleManager()
+        p = pm.getGenerator("billboard","particle3.png")
         p.setPosition(self._pos)
         p.setEvolveTime(0.5)
         p.setAcceleration(0)
         p.setSpawnSpeed(100)
         p.setMode("ONCE")
 
-        self._scene.getParticleManager().manageGenerator(p)
+        pm.manageGenerator(p)
 
 
     def checkColliders(self, colliders):
@@ -138,6 +114,8 @@ class Missile(Entity):
         if self._t0 is None:
            self._t0 = time
 
+        old_pos = N.array(self._pos)
+
         if self._follow is not None and not self._follow.closing() :
 
             d = self._follow._pos - self._pos
@@ -157,14 +135,25 @@ class Missile(Entity):
             Entity.moveTo(self, self._pos + self._dir * self._speed) # also updates _pos
             self._dir += self._gravity
 
+        if self._trail is not None:
+            self._trails.addTrailPoint(self._trail, self._pos)
+
         self._xform = mmult(self._pos_m,self._scaling_m, T.quaternion_matrix(self._rotation))
         self._rotation = T.quaternion_multiply(self._d_rotation, self._rotation)
 
-        # hit the floor
-        if self._map(self._pos[0], self._pos[1], False) > self._pos[2]:
+        # hit the floor. Check the whole path travelled in this frame, so the
+        # missile can't go through thin ridges
+        step = self._pos - old_pos
+        hit = self._map.raycast(old_pos, step, T.vector_norm(step))
+        if hit is not None:
+            Entity.moveTo(self, hit[0])
             self.explode()
             return False # tell the scene the missile is toast
 
+        if self._map(self._pos[0], self._pos[1], False) > self._pos[2]:
+            self.explode()
+            return False
+
         return True
 
 
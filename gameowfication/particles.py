@@ -28,29 +28,153 @@ from profiler import profile
 from glcompat import *
 from gltools import *
 import resources as R
+from collections import OrderedDict
 import numpy as N
 import math
 import random
 import time
 
+# one record per particle. The 4 corners of the billboards are drawn as
+# instances of a fan of 4 vertices, the shader gets the corner from gl_VertexID
 _attrlist = [ # attribute name, floats used
-             ("angle",1),
              ("rand",1),
              ("age",1),
              ("center",3),
              ("speed",3)
            ]
 
-_fields_per_vertex = sum (a[1] for a in _attrlist)
+_fields_per_particle = sum (a[1] for a in _attrlist)
+
+_AGE = 1 # column of the age in the data records
+
+_BLOCK = 16 # smallest range of particles given to a generator
+
+# the billboard effects with these textures are all drawn at once, with the
+# textures in an atlas (see ParticleController.drawAtlas)
+_atlas_shader = "billboard"
+_atlas_textures = ("particle1.png", "particle2.png", "particle3.png",
+                   "particle4.png", "particle5.png", "puff.jpg")
+
+# layout of the tables read by billboard_atlas (see that shader)
+_TABLE_WIDTH = 1024
+_PARAM_ROWS = 256
+_PARAM_TEXELS = 8
+
+_no_shape = ((0.,0.,0.,0.),) * 3
 
 ONCE_MODE = 2
 DYNAMIC_MODE = 0
 LOOP_MODE = 1
 
+
+# Batched emitters: emitter(t0, dt, n) -> positions[n,3], speeds[n,3] for n
+# particles born at times t0, t0+dt, t0+2*dt...
+# position is read every time the emitter is called, so it can be an array
+# that is updated in place (e.g. the position of an entity)
+
+# n random vectors uniformly distributed in the volume between the spheres of
+# squared radius inner and 1 (same as rejection sampling the unit cube)
+def randomInShell(n, inner=0.0):
+    d = N.random.normal(size=(n,3))
+    d /= N.sqrt((d*d).sum(axis=1))[:,None]
+
+    rmin3 = inner ** 1.5
+    r = (rmin3 + N.random.random(n) * (1.0 - rmin3)) ** (1.0/3.0)
+    return d * r[:,None]
+
+
+# particles leaving position in random directions, with speeds up to speed
+# (plus velocity). With spread != 0 they start at position + spread * direction
+def shellEmitter(position, inner=0.5, speed=1.0, spread=0.0, velocity=(0.,0.,0.)):
+    velocity = N.array(velocity, dtype="f")
+    def emitter(t0, dt, n):
+        d = randomInShell(n, inner)
+        pos = N.asarray(position, dtype="f") + d * spread
+        return pos, d * speed + velocity
+
+    return emitter
+
+
+def sphereEmitter(position, speed=1.0, spread=0.0):
+    return shellEmitter(position, 0.0, speed, spread)
+
+
+# all the particles start at position with the same speed
+def pointEmitter(position, speed):
+    speed = N.array(speed, dtype="f")
+    def emitter(t0, dt, n):
+        return N.tile(N.asarray(position, dtype="f"), (n,1)), N.tile(speed, (n,1))
+
+    return emitter
+
+
+# turns an emitter(t) -> pos, speed into a batched one
+def batchEmitter(single_emitter):
+    def emitter(t0, dt, n):
+        pos = N.empty((n,3), dtype="f")
+        speed = N.empty((n,3), dtype="f")
+        for i in xrange(n):
+            pos[i], speed[i] = single_emitter(t0 + i*dt)
+        return pos, speed
+
+    return emitter
+
+
+# Shape emitters (see ParticleGenerator.setShapeEmitter) are evaluated by
+# the billboard shaders: the start state of every particle comes from its
+# rand field, its index and a seed. The functions below do the same as the
+# shaders, in numpy, so the effects can be checked without GL
+
+_U32 = N.uint32
+
+# integer hash (pcg), the same as hash() in billboard_v.shdr
+def shaderHash(x):
+    x = x * _U32(747796405) + _U32(2891336453)
+    x = ((x >> ((x >> _U32(28)) + _U32(4))) ^ x) * _U32(277803737)
+    return (x >> _U32(22)) ^ x
+
+
+# age, center and speed of the particles with the given rand fields and
+# indices (within their generator) for the uniforms of setShapeEmitter:
+# emitter_pos = position, spread; emitter_vel = velocity, speed;
+# emitter = start time, time between particles, inner, seed
+def shapeStartState(rand, index, emitter_pos, emitter_vel, emitter):
+    rand = N.asarray(rand, dtype="f")
+    index = N.asarray(index).astype(_U32)
+    emitter_pos = N.asarray(emitter_pos, dtype="f")
+    emitter_vel = N.asarray(emitter_vel, dtype="f")
+    start, dt, inner, seed = N.asarray(emitter, dtype="f")
+
+    with N.errstate(over="ignore"):
+        h = (rand - N.floor(rand)) * N.float32(16777216.0)
+        h = h.astype(_U32) ^ (index * _U32(2654435769)) ^ shaderHash(_U32(seed))
+
+        u = []
+        for i in xrange(3):
+            h = shaderHash(h)
+            u.append((h >> _U32(8)).astype("f") / N.float32(16777216.0))
+
+    z = 2.0 * u[0] - 1.0
+    phi = 2.0 * math.pi * u[1]
+    rxy = N.sqrt(N.maximum(1.0 - z*z, 0.0))
+    rmin3 = inner ** 1.5
+    r = N.maximum(rmin3 + u[2] * (1.0 - rmin3), 1e-9) ** (1.0/3.0)
+    d = N.column_stack((rxy * N.cos(phi), rxy * N.sin(phi), z)) * r[:,None]
+
+    age = -(start + index.astype("f") * dt)
+    center = emitter_pos[:3] + d * emitter_pos[3]
+    speed = emitter_vel[:3] + d * emitter_vel[3]
+
+    return age.astype("f"), center.astype("f"), speed.astype("f")
+
+
 # must be obtained with ParticleController.getGenerator
 class ParticleGenerator:
 
-        _uniforms = ("acceleration","growth","rotation","easing","params1")
+        _uniforms = ("acceleration","growth","rotation","easing","params1",
+                     "emitter_pos","emitter_vel","emitter")
+        _uniform_locs = {} # locations of _uniforms, by shader name
+        _recyclable = True # see ParticleController.getGenerator
 
         def __init__(self, shader_name, texture_name):
             self._shader_name = shader_name
@@ -67,16 +191,20 @@ class ParticleGenerator:
                     tloc = self._shader.getUniformPos("texture0")
                     self._tbinder = self._texture.getBinder(0, tloc) if tloc>-1 else None
 
-            self._tot_vert_gl = 0
-            self._ofs_gl = None
-
-            for uni in self._uniforms:
-                setattr(self, "_"+uni+"_uni", self._shader.getUniformPos(uni))
+            try:
+                self._uni_locs = self._uniform_locs[shader_name]
+            except KeyError:
+                self._uni_locs = tuple(self._shader.getUniformPos(uni) for uni in self._uniforms)
+                self._uniform_locs[shader_name] = self._uni_locs
 
             self.reset()
 
 
         def reset(self):
+            self._origin = None
+            self._lod = 1.0
+            self._culled = False
+            self.setPriority()
             self.setSpawnSpeed()
             self.setAcceleration()
             self.setEasing()
@@ -89,6 +217,10 @@ class ParticleGenerator:
 
         #----
 
+        def getPoolKey(self):
+            return self._shader_name, self._texture_name
+
+
         def getSlotId(self):
             return self._slot
 
@@ -133,37 +265,46 @@ class ParticleGenerator:
             self._evolve_speed = 1.0 / time
 
 
-        # can be a callable, in which case it's called repetitively (with "time" as parameter) to get
-        # a position for new particles
+        # without speed, particles go in random directions
         def setPosition(self, position = (0.,0.,0.), speed=None):
-            position = N.array(position,dtype="f")
             if speed is None:
-                def emitter(t):
-                    while True:
-                        dx = 2.*random.random()-1.
-                        dy = 2.*random.random()-1.
-                        dz = 2.*random.random()-1.
-
-                        r = dx*dx+dy*dy+dz*dz
-
-                        if r < 1.0:
-                            return position, (dx,dy,dz)
-
-                self._emitter = emitter
+                self.setShapeEmitter(position)
             else:
-                speed = N.array(speed,dtype="f")
-                def emitter(t):
-                    return position, speed
+                self.setShapeEmitter(position, speed=0.0, velocity=speed)
+
 
-                self._emitter = emitter
+        # particles leaving position in random directions, with speeds up to
+        # speed plus velocity (see shellEmitter). ONCE and LOOP effects with
+        # a shape emitter are computed by the shader: nothing is written
+        # to the particle buffer. DYNAMIC ones use an equivalent shellEmitter
+        def setShapeEmitter(self, position, inner=0.0, speed=1.0, spread=0.0, velocity=(0.,0.,0.)):
+            position = N.array(position,dtype="f")
+            velocity = N.array(velocity,dtype="f")
+            self._origin = position
+            self._emitter = shellEmitter(position, inner, speed, spread, velocity)
+            self._shape = (N.append(position, spread).astype("f"),
+                           N.append(velocity, speed).astype("f"), inner)
+            self._shape_start = None
 
         def setBrightness(self, b = 1.0):
             self._brightness = b
 
         # emitter must be a callable that:
         # pos, speed = emitter(time)
-        def setEmitter(self, emitter):
-            self._emitter = emitter
+        # or, if batched, one that follows the batched emitters protocol:
+        # positions, speeds = emitter(t0, dt, n) (see shellEmitter)
+        # origin is a position near the particles, used to give less detail
+        # to far away effects (see ParticleController.setCamera)
+        def setEmitter(self, emitter, batched=False, origin=None):
+            self._emitter = emitter if batched else batchEmitter(emitter)
+            self._origin = origin
+            self._shape = None
+            self._shape_start = None
+
+
+        # weight of the effect when the particle budget is exceeded
+        def setPriority(self, priority=1.0):
+            self._priority = priority
 
 
         # DYNAMIC particles are constantly being renewed
@@ -175,23 +316,81 @@ class ParticleGenerator:
             self._mode = {"DYNAMIC":DYNAMIC_MODE, "LOOP":LOOP_MODE, "ONCE":ONCE_MODE}[mode]
             self._max_particles = max_particles
 
+
+        # particles the generator needs room for. DYNAMIC generators keep
+        # about spawn speed particles alive (the speed is per particle life)
+        # and get room for all of them, as their detail changes while they
+        # run. ONCE and LOOP ones only need the particles of their detail
+        def getCapacityNeeded(self):
+            if self._mode == DYNAMIC_MODE:
+                return int(math.ceil(self._spawn_speed * 1.2)) + 1
+            return self.getDetailParticles()
+
+
+        # particles spawned by ONCE and LOOP generators at the current detail
+        def getDetailParticles(self):
+            return max(1, int(self._max_particles * self._lod))
+
+
+        #---- level of detail, set by the ParticleController
+
+        def getOrigin(self):
+            return self._origin
+
+
+        def getPriority(self):
+            return self._priority
+
+
+        # rough size of the effect, in world units
+        def getRadius(self):
+            return float(self._growth.max()) + 1.0
+
+
+        # scales the spawn speed of DYNAMIC generators. ONCE and LOOP ones
+        # spawn fewer particles if the detail is low when they start
+        def setLod(self, lod):
+            self._lod = lod
+
+
+        # culled generators aren't drawn
+        def setCulled(self, culled):
+            self._culled = culled
+
+
+        def isCulled(self):
+            return self._culled
+
+
+        # particles being displayed
+        def getLiveParticles(self):
+            if self._mode == DYNAMIC_MODE:
+                return (self._buffer_head - self._buffer_tail) % self._particles_per_generator
+            return self._instances
+
         #---- The following methods should only be called by the ParticleController
 
         # called by the controller when the Generator is attached to it.
+        # slot_number is the first particle of data_view in the controller
         def beginManaged(self,controller,slot_number, data_view):
             self._controller = controller
-            self._particles_per_generator = controller.getParticlesPerGenerator()
+            self._particles_per_generator = len(data_view)
             self._slot = slot_number
             self._data = data_view
             self._last_t = 0
             self._buffer_tail = self._buffer_head = 0
             self._to_spawn = 0
+            self._full_particles = self._max_particles # at full detail
+            if self._mode != DYNAMIC_MODE:
+                self._max_particles = self.getDetailParticles()
             self._max_particles = min(self._max_particles, self._particles_per_generator)
             self._wants2die = False
             self._is_managed = True
             self._update_fn = self.dynamicUpdate if self._mode==DYNAMIC_MODE else self.nonDynamicUpdate
             self._max_time = None
             self._time = None
+            self._first_instance = 0
+            self._instances = 0
 
 
         def destroy(self):
@@ -232,17 +431,24 @@ class ParticleGenerator:
             if self._mode == ONCE_MODE: # once:
                 cycles = 1
             else:
-                cycles = int(self._particles_per_generator / self._max_particles)
+                # the copies that fit in the block at full detail, so a lower
+                # detail doesn't fill the block back up
+                cycles = max(1, int(self._particles_per_generator / self._full_particles))
 
             t0,t1 = 0, cycles * self._max_particles
 
-            self.spawn(t0,t1 , self._time, 1.0 / self._max_particles)
-
             self._buffer_tail, self._buffer_head = t0,t1
 
             self.updateActiveParticleRange(t0,t1)
 
-            return t0,t1
+            if self._shape is not None: # the shader computes the particles
+                self._shape_start = (self._time, 1.0 / self._max_particles,
+                                     self._shape[2], random.randint(0, 1<<24))
+                return True
+
+            self.spawn(t0,t1 , self._time, 1.0 / self._max_particles)
+
+            return [(t0,t1)]
 
 
 
@@ -251,7 +457,7 @@ class ParticleGenerator:
             # returns:
             # True: no change
             # False: particle no longer needs to be managed
-            # (t0,t1) the range of particles that changed
+            # [(t0,t1),...] the ranges of particles that changed
 
             time = self._time
 
@@ -261,26 +467,23 @@ class ParticleGenerator:
 
             t0, t1 = self._buffer_tail, self._buffer_head
 
-            tail_moved = added_particles = False
-
-            # see if there are particles that died now
-            while self._data[t0*4,2]+self._time > 1.0: # field2 = age
-
-                tail_moved = True
-                t0 += 1
-                if t0 == max_s:
-                    t0 = 0
-                if t0 == t1:  # empty buffer
-                    break
-            self._buffer_tail = t0
+            added_particles = False
 
             tot_p = t1-t0 # total particles
 
             if tot_p < 0:
                 tot_p += max_s
 
+            # see if there are particles that died now
+            dead = self.countDead(t0, tot_p)
+            tail_moved = dead > 0
+            if tail_moved:
+                t0 = (t0 + dead) % max_s
+                tot_p -= dead
+            self._buffer_tail = t0
+
             # see if we need to spawn more particles
-            self._to_spawn += dt * self._spawn_speed
+            self._to_spawn += dt * self._spawn_speed * self._lod
 
 
             to_spawn = math.floor(self._to_spawn)
@@ -301,10 +504,10 @@ class ParticleGenerator:
                     self.spawn(s0, max_s, t, p_dt) # buffer wraps around
                     s1 -= max_s
                     self.spawn(0, s1, t+p_dt*(max_s - s0), p_dt)
-                    n0,n1 = 0, max_s # range of fields to update in the VBO
+                    added_particles = [(s0, max_s), (0, s1)] # ranges to update in the VBO
                 else:
                     self.spawn(s0, s1, t, p_dt)
-                    n0,n1 = s0,s1
+                    added_particles = [(s0, s1)]
 
                 t1 = s1 if s1 < max_s else 0 #new head
 
@@ -314,8 +517,6 @@ class ParticleGenerator:
                     if t0 == max_s:
                         t0 = 0
 
-                added_particles = n0,n1
-
             if added_particles or tail_moved:
                 self._buffer_tail, self._buffer_head = t0,t1
                 # compute range in buffer used by particles (may be split in two:
@@ -331,6 +532,26 @@ class ParticleGenerator:
             return True
 
 
+        # number of particles that are dead at the tail of the ring buffer
+        # (n particles from t0). They were spawned in order, so their ages
+        # decrease from the tail to the head and the dead ones come first:
+        # binary search them (a searchsorted on the ring, without copying
+        # the strided age column)
+        def countDead(self, t0, n):
+            max_s = self._particles_per_generator
+            limit = 1.0 - self._time # dead if age > limit
+
+            lo, hi = 0, n
+            while lo < hi:
+                mid = (lo + hi) >> 1
+                if self._data[(t0 + mid) % max_s, _AGE] > limit:
+                    lo = mid + 1
+                else:
+                    hi = mid
+
+            return lo
+
+
         def updateDying(self):
             if self._max_time is None:
                 self._max_time = self._time + 2.1
@@ -342,27 +563,19 @@ class ParticleGenerator:
 
 
 
+        # spawns the particles [s0,s1) of the slot (s1 <= particles per generator)
         def spawn(self, s0, s1, t, dt):
-            max_s = self._particles_per_generator
-            e = self._emitter
-
-            while s0 != s1:
-                if s0 == max_s:
-                    s0 = 0
-
-                pos,speed = e(t)
+            n = s1 - s0
+            if n <= 0:
+                return
 
-                # four vertices per particle
-                s = s0*4
-                i = 0
-                while i<4:
-                    self._data[s+i,3:6] = pos
-                    self._data[s+i,6:9] = speed
-                    self._data[s+i,2] = -t
-                    i+=1
+            pos, speed = self._emitter(t, dt, n)
 
-                s0 += 1
-                t += dt
+            # age, center, speed fields
+            fields = self._data[s0:s1]
+            fields[:,_AGE] = -(t + dt * N.arange(n))
+            fields[:,2:5] = pos
+            fields[:,5:8] = speed
 
 
         def updateActiveParticleRange(self, t0, t1):
@@ -375,186 +588,461 @@ class ParticleGenerator:
 
         def recomputeGlData(self):
             t0,t1 = self._active_particles_range
-            first_part = self._particles_per_generator * self._slot + t0
-            first_vert = first_part * 6
-
-            self._tot_vert_gl = (t1-t0) * 6
-            self._ofs_gl = ctypes.c_void_p(ctypes.sizeof(ctypes.c_uint16) * first_vert)
+            self._first_instance = self._slot + t0
+            self._instances = t1-t0
+
+
+        # emitter_pos, emitter_vel and emitter uniforms of the billboard
+        # shader (see shapeStartState). emitter is 0 if the particles
+        # come from the buffer
+        def getShapeUniforms(self):
+            if self._shape_start is None:
+                return _no_shape
+            return self._shape[0], self._shape[1], self._shape_start
+
+
+        # what the shader computes for the particles of a shape emitter:
+        # age, center and speed of every particle in the active range
+        def getShapeStartState(self):
+            t0, t1 = self._active_particles_range
+            rand = self._data[t0:t1, 0]
+            return shapeStartState(rand, N.arange(t1 - t0), *self.getShapeUniforms())
+
+
+        # the uniforms of the billboard shader packed for billboard_atlas:
+        # acceleration, growth, rotation, easing, params1, the range of
+        # particles to draw, 4 more floats and the shape emitter uniforms
+        # (out must have 32 floats)
+        def getShaderParams(self, out):
+            out[0:3] = self._accel
+            out[3:6] = self._growth
+            out[6:8] = self._rot
+            out[8:10] = self._easing
+            out[10:13] = self._time or 0.0, 1.0 if self._mode==LOOP_MODE else 0.0, self._brightness
+            if self._time and not self._culled:
+                out[13:15] = self._first_instance, self._first_instance + self._instances
+            else: # nothing to draw
+                out[13:15] = 0, 0
+            out[20:24], out[24:28], out[28:32] = self.getShapeUniforms()
 
 
         def draw(self):
             if not self._time:
                 return
-            # load uniforms (fields created dynamically in constructor)
-            glUniform3f(self._acceleration_uni, self._accel[0], self._accel[1], self._accel[2])
-            glUniform3f(self._growth_uni, self._growth[0], self._growth[1], self._growth[2])
-            glUniform2f(self._rotation_uni, self._rot[0], self._rot[1])
-            glUniform2f(self._easing_uni, self._easing[0], self._easing[1])
-            glUniform3f(self._params1_uni, self._time, 1.0 if self._mode==LOOP_MODE else 0.0, self._brightness)
-            #glUniform3f(self._params1_uni, self._time, 0.0, 1.0)
+            # load uniforms (locations cached per shader)
+            acceleration_uni, growth_uni, rotation_uni, easing_uni, params1_uni, \
+                emitter_pos_uni, emitter_vel_uni, emitter_uni = self._uni_locs
+            glUniform3f(acceleration_uni, self._accel[0], self._accel[1], self._accel[2])
+            glUniform3f(growth_uni, self._growth[0], self._growth[1], self._growth[2])
+            glUniform2f(rotation_uni, self._rot[0], self._rot[1])
+            glUniform2f(easing_uni, self._easing[0], self._easing[1])
+            glUniform3f(params1_uni, self._time, 1.0 if self._mode==LOOP_MODE else 0.0, self._brightness)
+            #glUniform3f(params1_uni, self._time, 0.0, 1.0)
+            emitter_pos, emitter_vel, emitter = self.getShapeUniforms()
+            glUniform4f(emitter_pos_uni, *emitter_pos)
+            glUniform4f(emitter_vel_uni, *emitter_vel)
+            glUniform4f(emitter_uni, *emitter)
             # draw the quads
-            glDrawElements(GL_TRIANGLES, self._tot_vert_gl, GL_UNSIGNED_SHORT, self._ofs_gl)
+            self._controller.drawInstances(self._shader, self._first_instance, self._instances)
+
+
+
+# merges the ranges (a,b) that overlap or are at most gap apart. The result
+# is sorted
+def mergeRanges(ranges, gap=0):
+    merged = []
+    for a,b in sorted(ranges):
+        if merged and a <= merged[-1][1] + gap:
+            merged[-1][1] = max(merged[-1][1], b)
+        else:
+            merged.append([a,b])
+
+    return [tuple(r) for r in merged]
+
+
+
+# Buddy allocator of ranges of particles. Hands out blocks of a power of two
+# particles (at least min_block, at most max_block), aligned to their size.
+# Freed blocks are merged back with their buddies.
+class BuddyAllocator:
+    def __init__(self, total, min_block=16, max_block=1024):
+        self._min_order = int(math.ceil(math.log(min_block, 2)))
+        self._max_order = int(math.log(max_block, 2))
+        self._free = [set() for i in xrange(self._max_order+1)] # offsets by order
+        self._allocated = {} # offset: order
+        self._free_particles = 0
+
+        # cover the total with the biggest aligned blocks that fit
+        ofs = 0
+        for order in xrange(self._max_order, self._min_order-1, -1):
+            size = 1 << order
+            while ofs + size <= total:
+                self._free[order].add(ofs)
+                ofs += size
+
+        self._free_particles = ofs
+
+
+    def orderFor(self, n):
+        order = self._min_order
+        while (1 << order) < n and order < self._max_order:
+            order += 1
+        return order
+
+
+    # offset of a block of at least n particles (max_block at most) or None
+    def allocate(self, n):
+        order = self.orderFor(n)
+
+        o = order
+        while o <= self._max_order and not self._free[o]:
+            o += 1
+
+        if o > self._max_order:
+            return None
+
+        ofs = self._free[o].pop()
+
+        # split it, keeping the lower half
+        while o > order:
+            o -= 1
+            self._free[o].add(ofs + (1 << o))
+
+        self._allocated[ofs] = order
+        self._free_particles -= 1 << order
+        return ofs
+
+
+    def free(self, ofs):
+        order = self._allocated.pop(ofs)
+        self._free_particles += 1 << order
+
+        while order < self._max_order:
+            buddy = ofs ^ (1 << order)
+            if buddy not in self._free[order]:
+                break
+            self._free[order].remove(buddy)
+            ofs = min(ofs, buddy)
+            order += 1
+
+        self._free[order].add(ofs)
+
+
+    def blockSize(self, ofs):
+        return 1 << self._allocated[ofs]
+
+
+    def getFreeParticles(self):
+        return self._free_particles
 
 
 
 class ParticleController:
-    def __init__(self, max_particles=10000): # max: 10900
-        self._max_particles_per_generator = 100
+    # with no_gl only the data records are kept (nothing can be drawn).
+    # There's no index buffer, so max_particles is only limited by memory
+    # (32 bytes per particle)
+    # with single_draw, the effects that use the billboard shader and one of
+    # the _atlas_textures are drawn with a single call. It's off by default:
+    # the call draws every slot up to the last generator and the shader reads
+    # the parameters of every particle from a texture, which can cost more
+    # than the calls it saves (see tests/bench_particle_draw.py)
+    def __init__(self, max_particles=10000, no_gl=False, single_draw=False):
+        self._max_particles_per_generator = 1024
         self._max_particles = max_particles
-        max_generators = max_particles / self._max_particles_per_generator
-        self._free_slots = set(range(max_generators))
-        self._lru_slots = []
-        self._generators = [None] * max_generators
+        self._allocator = BuddyAllocator(max_particles, _BLOCK, self._max_particles_per_generator)
+        # managed generators by their first particle, least recently added first
+        self._generators = OrderedDict()
         self._vao = {} # all used VAO indexed by shader
 
-        self._data = N.zeros((self._max_particles*4, _fields_per_vertex),dtype="f")
-        self._batches = []
+        self._data = N.zeros((self._max_particles, _fields_per_particle),dtype="f")
+        # managed generators by (shader name, texture name), each an
+        # OrderedDict by first particle. _batch_order (the keys, sorted so
+        # that every shader is bound once) is rebuilt by refreshBatches
+        self._batches = {}
+        self._batch_order = []
+        self._batches_dirty = False
         # uniforms: accel x,y,z, time
+        self._no_gl = no_gl
 
-        self.initBuffers()
+        # finished generators, by (shader name, texture name), to be reused
+        # by getGenerator
+        self._pool = {}
+        self._max_pooled = 32
 
-    def getParticlesPerGenerator(self):
-        return self._max_particles_per_generator
+        # level of detail and budget (see setCamera, setBudget)
+        self._eye = None
+        self._pixel_scale = 1.0
+        self._full_detail_pixels = 100.0 # effects this big on screen get all their particles
+        self._min_lod = 0.1
+        self._budget = max_particles
+        self._eviction_order = [] # (first particle, generator), highest priority first
+        self._stats = {"live":0, "culled":0, "evicted":0}
+        self._evicted = 0
 
-    def initBuffers(self):
+        # changed ranges closer than this (in particles) are uploaded at once
+        self._merge_gap = _BLOCK
+        self._uploaded_bytes = 0
+
+        # generators drawn with the atlas, by first particle
+        self._atlas = None
+        self._atlas_generators = OrderedDict()
+        self._atlas_dirty = False
+
+        self.initData()
+        if not no_gl:
+            self.initBuffers()
+            if single_draw:
+                self.initAtlas()
 
-        tot_indices = self._max_particles*6
-
-        indices = N.zeros(tot_indices, dtype=N.uint16)
-
-        # set up the indices (we won't need to change these anymore)
-        i = 0
-        j = 0
-        while i < tot_indices:
-            indices[i] = j
-            indices[i+1] = j+1
-            indices[i+2] = j+2
-            indices[i+3] = j+0
-            indices[i+4] = j+2
-            indices[i+5] = j+3
-            j+=4; i+=6
-        # set up the corner angles in the self._data
-        j = 0
-        angle = [i*math.pi/2. + math.pi/4. for i in range(4)]
-        for i in xrange(self._max_particles):
-            # corners
-            self._data[j][0] = angle[0]
-            self._data[j+1][0] = angle[1]
-            self._data[j+2][0] = angle[2]
-            self._data[j+3][0] = angle[3]
-            # random/particle ido
-            r = (i % self._max_particles_per_generator) + random.random()
-            self._data[j][1] = r
-            self._data[j+1][1] = r
-            self._data[j+2][1] = r
-            self._data[j+3][1] = r
-            j+= 4
+    # the records of all the particles (one row per particle, see _attrlist)
+    def getData(self):
+        return self._data
 
+
+    def initData(self):
+        # random/particle id (within the smallest blocks)
+        self._data[:,0] = N.arange(self._max_particles) % _BLOCK + N.random.random(self._max_particles)
+
+
+    def initBuffers(self):
         self._data_vbo = vbo.VBO(self._data.flatten(), GL_STREAM_DRAW)
         self._data_vbo.bind()
-        self._indices_vbo = vbo.VBO(indices.flatten(), GL_DYNAMIC_DRAW, target=GL_ELEMENT_ARRAY_BUFFER)
-        self._indices_vbo.bind()
 
+        # glDrawArraysInstancedBaseInstance needs GL 4.2. Otherwise the
+        # attributes are pointed to the first particle of every draw
+        self._base_instance = bool(glDrawArraysInstancedBaseInstance)
 
 
-    # upload changed data to the VBO
-    def loadGeneratorData(self, g, n0, n1):
-        # n0,n1 are in the range [0..0..self._max_particles_per_generator]
-        # indicate the range of particles that the generator updated
 
-        snum = g.getSlotId()
+    def initAtlas(self):
+        self._atlas = TextureAtlas(_atlas_textures)
+        self._atlas_program = R.getShaderProgram(_atlas_shader + "_atlas")
+        self._atlas_vao = self.getVAO(self._atlas_program)
 
-        s0 = self._max_particles_per_generator * snum
+        blocks = (self._max_particles + _BLOCK - 1) / _BLOCK
 
-        n0p = (s0+n0) * _fields_per_vertex
-        n1p = (s0+n1) * _fields_per_vertex
+        # generator (param row) that owns every block, -1 if none. The row of
+        # a generator is the block of its first particle
+        self._block_table = N.zeros(((blocks + _TABLE_WIDTH - 1) / _TABLE_WIDTH, _TABLE_WIDTH), dtype="f")
+        self._block_table[:] = -1
+        self._block_table_tex = Texture(smoothing=False)
+        self._block_table_tex.setFromArray(self._block_table)
 
+        self._params = N.zeros(((blocks + _PARAM_ROWS - 1) / _PARAM_ROWS, _PARAM_ROWS * _PARAM_TEXELS, 4), dtype="f")
+        self._params_tex = Texture(smoothing=False)
+        self._params_tex.setFromArray(self._params)
+
+        getpos = self._atlas_program.getUniformPos
+        self._atlas_binders = (
+            self._atlas.getBinder(0, getpos("texture0")),
+            self._params_tex.getBinder(1, getpos("params")),
+            self._block_table_tex.getBinder(2, getpos("block_table")))
 
-        #self._data_vbo.bind() already bound when calling this
 
-        #
+    # True if the generator is drawn by drawAtlas
+    def usesAtlas(self, g):
+        return (self._atlas is not None and g.getShader().getName() == _atlas_shader
+                and self._atlas.hasTexture(g.getTextureName()))
 
 
-        ptr = self._data[(s0+n0)*4:(s0+n1)*4].ravel().ctypes.data_as(ctypes.c_void_p)
+    # updates the blocks owned by the generators drawn with the atlas
+    def refreshAtlas(self):
+        table = self._block_table.ravel()
+        table[:] = -1
+
+        for s0, g in self._atlas_generators.iteritems():
+            b0 = s0 / _BLOCK
+            table[b0:b0 + self._allocator.blockSize(s0) / _BLOCK] = b0
+
+        self._block_table_tex.updateFromArray(self._block_table)
+
+
+    # draws all the particles of the generators that use the atlas at once
+    def drawAtlas(self, scene):
+        if not self._atlas_generators:
+            return
+
+        params = self._params.reshape(-1, _PARAM_TEXELS * 4)
+        last = 0
+        for s0, g in self._atlas_generators.iteritems():
+            row = params[s0 / _BLOCK]
+            g.getShaderParams(row)
+            row[16:20] = self._atlas.getRect(g.getTextureName())
+            last = max(last, s0 + self._allocator.blockSize(s0))
+
+        # only the texture rows up to the last generator
+        rows = (last - 1) / _BLOCK / _PARAM_ROWS + 1
+        self._params_tex.updateFromArray(self._params[:rows])
+
+        shader = self._atlas_program
+        shader.begin()
+        scene.uploadMatrices(shader)
+        for b in self._atlas_binders: b()
+
+        glBindVertexArray(self._atlas_vao)
+        glDrawArraysInstanced(GL_TRIANGLE_FAN, 0, 4, last)
+        glBindVertexArray(0)
+        shader.end()
+
+
+    # upload the records of the particles [p0,p1) to the VBO
+    def uploadRange(self, p0, p1):
+        #self._data_vbo.bind() already bound when calling this
+
+        ptr = self._data[p0:p1].ctypes.data_as(ctypes.c_void_p)
 
         glBufferSubData(
             GL_ARRAY_BUFFER,
-            n0p*4*ctypes.sizeof(ctypes.c_float), # because there are 4 vertices per particle
-            (n1-n0)*4*_fields_per_vertex*ctypes.sizeof(ctypes.c_float),
+            p0*_fields_per_particle*ctypes.sizeof(ctypes.c_float),
+            (p1-p0)*_fields_per_particle*ctypes.sizeof(ctypes.c_float),
             ptr
         )
 
         # this shit doesn't work everywhere
-        # self._data_vbo[n0p*4:n1p*4] = self._data[(s0+n0)*4:(s0+n1)*4].flatten()
+        # self._data_vbo[n0p:n1p] = self._data[p0:p1].flatten()
 
 
+    # bytes of particle data sent to the VBO in the last update
+    def getUploadedBytes(self):
+        return self._uploaded_bytes
 
 
-    def manageGenerator(self, g):
-        if len(self._free_slots)==0:
-            snum = self._lru_slots.pop(0)
-            g = self._generators[snum]
-            g.endManaged()
-        else:
-            snum = self._free_slots.pop()
+    # a generator for the given shader and texture, reset to its defaults.
+    # Recycles generators that finished (see update), so the caller must not
+    # use the generator once it's done, unless keep is True: then it's never
+    # recycled and can be used (e.g. destroyed) at any time
+    def getGenerator(self, shader_name, texture_name, keep=False):
+        try:
+            g = self._pool[(shader_name, texture_name)].pop()
+            g.reset()
+        except (KeyError, IndexError):
+            g = ParticleGenerator(shader_name, texture_name)
+        g._recyclable = not keep
+        return g
 
-        s0 = self._max_particles_per_generator * snum
-        s1 = s0 + self._max_particles_per_generator
 
+    def recycleGenerator(self, g):
+        if not g._recyclable: # its owner still has it
+            return
+        pool = self._pool.setdefault(g.getPoolKey(), [])
+        if len(pool) < self._max_pooled:
+            pool.append(g)
 
-        g.beginManaged(self, snum, self._data[s0*4:s1*4])
 
-        self._generators[snum] = g
+    # the camera position and the size in pixels of one unit at distance 1
+    # (see Scene.getPixelScale), used to lower the detail of far effects
+    def setCamera(self, eye, pixel_scale):
+        self._eye = N.array(eye, dtype="f")
+        self._pixel_scale = pixel_scale
 
-        self._lru_slots.append(snum) # we use a list because we want temporal ordering
 
-        self.refreshBatches()
+    # maximum particles displayed at once. The ones of the effects with the
+    # lowest priority (see computePriorities) are culled
+    def setBudget(self, max_live):
+        self._budget = max_live
 
 
-    def refreshBatches(self):
-        self._batches = []
-        glist = filter(None, self._generators[:])
+    # live and culled particles in the last update, and generators evicted
+    # to make room for new ones between the last update and the one before
+    def getStats(self):
+        return self._stats
 
-        if not glist:
-            return
 
-        glist.sort() # sorts by 1)shader, 2)texture
+    # priority (priority of the generator x size on screen) and level of
+    # detail (0..1) of the generators
+    def computePriorities(self, generators):
+        prio = N.array([g.getPriority() for g in generators], dtype="f")
+        if self._eye is None:
+            return prio, N.ones(len(generators), dtype="f")
 
-        shader_name = glist[0].getShader().getName()
-        new_shader_name = shader_name
-        last_texture = None
-        shader = None
-        used_vaos = set()
+        origins = N.array([self._eye if g.getOrigin() is None else g.getOrigin() for g in generators], dtype="f").reshape(-1,3)
+        radius = N.array([g.getRadius() for g in generators], dtype="f")
 
-        groups = []
-        for g in glist:
+        dist = N.sqrt(((origins - self._eye)**2).sum(axis=1))
+        pixels = radius * self._pixel_scale / N.maximum(dist, 1.0)
 
-            shader = g.getShader()
+        lod = N.clip(pixels / self._full_detail_pixels, self._min_lod, 1.0)
+        return prio * pixels, lod
 
-            new_shader_name = shader.getName()
 
-            used_vaos.add(new_shader_name)
+    # removes the generator with the lowest priority (as of the last update)
+    # or the oldest if none is known. Returns False if there was none
+    def evictGenerator(self):
+        while self._eviction_order:
+            s0, g = self._eviction_order.pop()
+            if self._generators.get(s0) is g:
+                del self._generators[s0]
+                break
+        else:
+            if not self._generators:
+                return False
+            s0, g = self._generators.popitem(last=False)
+
+        g.endManaged()
+        self.removeFromBatch(s0, g)
+        self._allocator.free(s0)
+        self._evicted += 1
+        return True
+
+
+    def manageGenerator(self, g):
+        if self._eye is not None:
+            g.setLod(self.computePriorities([g])[1][0])
+
+        s0 = self._allocator.allocate(g.getCapacityNeeded())
+
+        # make room dropping the least important generators
+        while s0 is None and self.evictGenerator():
+            s0 = self._allocator.allocate(g.getCapacityNeeded())
+
+        if s0 is None: # the buffer can't hold it
+            return
+
+        s1 = s0 + self._allocator.blockSize(s0)
+
+        g.beginManaged(self, s0, self._data[s0:s1])
 
-            if new_shader_name!= shader_name:
-                vao = self.getVAO(shader)
-                self._batches.append((shader, groups, vao))
-                shader_name = new_shader_name
-                groups = []
-                last_texture = None
+        self._generators[s0] = g
+        self.addToBatch(s0, g)
 
-            texture = g.getTextureName()
 
-            do_load_texture = bool(texture != last_texture and texture)
+    def addToBatch(self, s0, g):
+        if self.usesAtlas(g):
+            self._atlas_generators[s0] = g
+            self._atlas_dirty = True
+            return
+
+        key = g.getPoolKey()
+        try:
+            self._batches[key][s0] = g
+        except KeyError:
+            self._batches[key] = OrderedDict([(s0, g)])
+            self._batches_dirty = True
+
+
+    def removeFromBatch(self, s0, g):
+        if self._atlas_generators.pop(s0, None) is not None:
+            self._atlas_dirty = True
+            return
 
-            groups.append( (g, do_load_texture) )
+        key = g.getPoolKey()
+        batch = self._batches[key]
+        del batch[s0]
+        if not batch:
+            del self._batches[key]
+            self._batches_dirty = True
 
-            if texture:
-                last_texture = texture
 
-        if groups:
-            vao = self.getVAO(shader)
-            self._batches.append((shader, groups, vao))
+    # brings the batch order and the atlas block table up to date. Called
+    # once per frame by draw, however many generators were added or removed
+    def refreshBatches(self):
+        if self._batches_dirty:
+            self._batch_order = sorted(self._batches.keys())
+            self._batches_dirty = False
 
+        if self._atlas_dirty:
+            self.refreshAtlas()
+            self._atlas_dirty = False
 
 
 
@@ -577,20 +1065,15 @@ class ParticleController:
 
         self._data_vbo.bind()
 
-        stride = _fields_per_vertex*ctypes.sizeof(ctypes.c_float)
-        ofs = 0
-
         for attrname, floats in _attrlist:
             loc = shader.getAttribPos(attrname)
 
             if loc == -1: continue
 
             glEnableVertexAttribArray(loc)
-            glVertexAttribPointer(loc, floats,  GL_FLOAT, False, stride, ctypes.c_void_p(ofs))
+            glVertexAttribDivisor(loc, 1) # one record per instance (particle)
 
-            ofs += ctypes.sizeof(ctypes.c_float) * floats
-
-        self._indices_vbo.bind()
+        self.pointAttributes(shader, 0)
 
         glBindVertexArray(0)
         shader.end()
@@ -598,35 +1081,100 @@ class ParticleController:
         return vao
 
 
+    # points the attributes of the shader (in the bound VAO) to the records
+    # starting at the given particle
+    def pointAttributes(self, shader, first):
+        stride = _fields_per_particle*ctypes.sizeof(ctypes.c_float)
+        ofs = first * stride
+
+        for attrname, floats in _attrlist:
+            loc = shader.getAttribPos(attrname)
+
+            if loc != -1:
+                glVertexAttribPointer(loc, floats,  GL_FLOAT, False, stride, ctypes.c_void_p(ofs))
+
+            ofs += ctypes.sizeof(ctypes.c_float) * floats
+
+
+    # draws the billboards of the particles [first, first+count)
+    def drawInstances(self, shader, first, count):
+        if self._base_instance:
+            glDrawArraysInstancedBaseInstance(GL_TRIANGLE_FAN, 0, 4, count, first)
+        else:
+            self.pointAttributes(shader, first)
+            glDrawArraysInstanced(GL_TRIANGLE_FAN, 0, 4, count)
+
+
 
     @profile
     def update(self, time):
         to_remove = []
-        added = False
-
-        self._data_vbo.bind()
+        dirty = [] # ranges of particles changed in the data records
 
-        for snum in self._lru_slots:
-            g = self._generators[snum]
+        for s0, g in self._generators.items():
             keep = g.update(time)
 
             if keep is False: # the generator is done. Remove it
                 g.endManaged()
-                self._generators[snum] = None
-                to_remove.append(snum)
+                to_remove.append(s0)
             elif keep is True: # nothing changed
                 pass
             else: # particles added
-                self.loadGeneratorData(g, keep[0], keep[1])
-                added = True
+                dirty += [(s0+n0, s0+n1) for n0,n1 in keep]
 
-        if added:
-            self._data_vbo.copy_data()
+        ranges = mergeRanges(dirty, self._merge_gap)
+        self._uploaded_bytes = sum(p1-p0 for p0,p1 in ranges) * _fields_per_particle * ctypes.sizeof(ctypes.c_float)
+
+        if ranges and not self._no_gl:
+            self._data_vbo.bind()
+            for p0,p1 in ranges:
+                self.uploadRange(p0, p1)
 
         if to_remove:
-            self._lru_slots = [s for s in self._lru_slots if s not in to_remove]
-            self._free_slots.update(to_remove)
-            self.refreshBatches()
+            for s0 in to_remove:
+                # only the generators that finish by themselves are recycled:
+                # the evicted ones may still be used by their owners
+                g = self._generators.pop(s0)
+                self.removeFromBatch(s0, g)
+                self.recycleGenerator(g)
+                self._allocator.free(s0)
+
+        self.applyBudget()
+
+
+    # sets the level of detail of every generator and culls the least
+    # important ones that don't fit in the budget
+    def applyBudget(self):
+        slots = self._generators.keys()
+        generators = self._generators.values()
+        self._stats = {"live":0, "culled":0, "evicted":self._evicted}
+        self._evicted = 0
+
+        if not generators:
+            self._eviction_order = []
+            return
+
+        prio, lod = self.computePriorities(generators)
+        live = N.array([g.getLiveParticles() for g in generators])
+
+        order = N.argsort(-prio, kind="mergesort") # stable, older first
+
+        # the most important first, skipping the ones that don't fit
+        culled = N.zeros(len(generators), dtype=bool)
+        room = self._budget
+        for i in order:
+            if live[i] > room:
+                culled[i] = True
+            else:
+                room -= live[i]
+
+        for g, l, c in zip(generators, lod, culled):
+            g.setLod(l)
+            g.setCulled(c)
+
+        self._eviction_order = [(slots[i], generators[i]) for i in order]
+        self._stats["live"] = int(live[~culled].sum())
+        self._stats["culled"] = int(live[culled].sum())
 
 
 
@@ -641,17 +1189,27 @@ class ParticleController:
 
     @profile
     def draw(self, scene):
+        self.refreshBatches()
 
         shader = None
-        for shader, groups, vao in self._batches:
-            shader.begin()
+        for key in self._batch_order:
+            batch = self._batches[key].values()
 
-            scene.uploadMatrices(shader)
-            glBindVertexArray(vao)
-            #self._indices_vbo.bind()
-            for g, bind_texture in groups:
-                if bind_texture: g.bindTexture()
-                g.draw()
+            if key[0] != (shader and shader.getName()):
+                if shader: shader.end()
+                shader = batch[0].getShader()
+                vao = self.getVAO(shader) # before begin: newVAO ends the shader
+                shader.begin()
+
+                scene.uploadMatrices(shader)
+                glBindVertexArray(vao)
+
+            batch[0].bindTexture()
+            for g in batch:
+                if not g.isCulled():
+                    g.draw()
 
         glBindVertexArray(0)
         if shader: shader.end()
+
+        self.drawAtlas(scene)
@@ -192,28 +192,32 @@ class Router:
         self.processAll(walkable_position, levels)
 
 
-    def getBlockingMap(self, max_angle=30.0, threshold=3):
-        normals = self._map.getNormals()
-        assert(normals is not None)
-
+    # 1 where at least threshold of the 3x3 vertices around are steep. The
+    # map is read a band of rows at a time (plus the rows above and below),
+    # so only the result is as big as the map
+    def getBlockingMap(self, max_angle=30.0, threshold=3, band=256):
         min_z = math.cos(max_angle / 180.0 * math.pi)
 
-        n = normals[:,:,2]
+        w,h = self._map.getDimensions()
+        blocking = N.empty((h,w), dtype=N.uint8)
+
+        for y0 in xrange(0, h, band):
+            y1 = min(y0 + band, h)
 
-        n = N.piecewise(n, [n<min_z,n>=min_z], [1,0])
+            # steep vertices of the band with a border of one vertex
+            # (the border outside the map isn't steep)
+            a, b = max(y0-1, 0), min(y1+1, h)
+            steep = N.zeros((y1-y0+2, w+2), dtype=N.uint8)
+            steep[a-y0+1:b-y0+1, 1:w+1] = self._map.getSteepRows(a, b, min_z)
 
-        n1 = N.roll(n, 1,0)
-        n2 = N.roll(n, -1,0)
-        n3 = N.roll(n, 1,1)
-        n4 = N.roll(n, 1,1)
-        n5 = N.roll(n1,  1,1)
-        n6 = N.roll(n1, -1,1)
-        n7 = N.roll(n2,  1,1)
-        n8 = N.roll(n2, -1,1)
+            n = N.zeros((y1-y0, w), dtype=N.uint8)
+            for dy in (0,1,2):
+                for dx in (0,1,2):
+                    n += steep[dy:dy+y1-y0, dx:dx+w]
 
-        n = n+n1+n2+n3+n4+n5+n6+n7+n8
+            blocking[y0:y1] = n >= threshold
 
-        return N.piecewise(n, [n<threshold,n>=threshold], [0,1])
+        return blocking
 
 
     def processAll(self, walkable_position=None, levels=6):
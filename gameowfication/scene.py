@@ -42,6 +42,7 @@ class Scene:
 
         self._perspective_m = frustumProjMtx(60, 0.5, 500.0)
         vpw, vph = getViewportSize()
+        self._viewport_size = vpw, vph
         self._ortho_m = T.clip_matrix(0, vpw, vph, 0, -1, 1)#  0.,0.,.,1.,-1.,1.,False)
         self._modelview_m_stack = []
 
@@ -65,6 +66,20 @@ class Scene:
         raise RuntimeError("Call a subclass method")
 
 
+    def getViewProjectionMatrix(self):
+        return N.dot(self._projection_m, self._modelview_m)
+
+
+    # position of the camera in world coordinates
+    def getEyePosition(self):
+        return N.linalg.inv(self._modelview_m)[0:3,3]
+
+
+    # size in pixels of an object 1 unit wide seen from a distance of 1 unit
+    def getPixelScale(self):
+        return self._viewport_size[1] * 0.5 * self._projection_m[1,1]
+
+
     def freezeLight(self):
         self._light_m = N.linalg.inv(self._modelview_m[0:3,0:3])
 
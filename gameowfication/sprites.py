@@ -30,11 +30,137 @@ import math
 import libs.transformations as T
 from gltools import *
 #from OpenGL.arrays import vbo
-from libs.sortedcontainers.sortedlist import SortedList
 
 
 _floats_per_vertex = 6
 
+# with more dirty rectangles than this, their bounding box is uploaded
+_max_dirty_rects = 32
+
+
+# joins the rectangles (x,y,w,h) that are side by side in the same row
+# (e.g. the tiles of a sprite in a shelf)
+def mergeRects(rects):
+    rects = sorted(set(rects), key=lambda r: (r[1], r[3], r[0]))
+    merged = []
+    for r in rects:
+        if merged:
+            x,y,w,h = merged[-1]
+            if y == r[1] and h == r[3] and r[0] <= x + w:
+                merged[-1] = (x, y, max(x + w, r[0] + r[2]) - x, h)
+                continue
+        merged.append(r)
+    return merged
+
+
+# smallest rectangle containing all the given ones
+def boundingRect(rects):
+    x0 = min(r[0] for r in rects)
+    y0 = min(r[1] for r in rects)
+    x1 = max(r[0] + r[2] for r in rects)
+    y1 = max(r[1] + r[3] for r in rects)
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+# Places the tiles of the sprites in the texture pages. The tiles are at most
+# tile_size x tile_size, the pieces at the right and bottom of a sprite are
+# smaller. Every page is filled from the top with shelves as wide as the page
+# and as high as a height class (a multiple of min_height). A shelf is split
+# in slots of tile_size width, all of them for tiles of its class. Freed
+# slots are kept by class, so allocating and freeing is O(1)
+#
+# A tile is (page, (ty,tx), quad number, (w,h)). The quads of the tiles
+# of a page are numbered from page * getQuadsPerPage()
+class TileAllocator:
+    def __init__(self, page_size=1024, tile_size=64, min_height=16):
+        self._page_size = page_size
+        self._tile_size = tile_size
+        self._min_height = min_height
+        self._classes = tile_size / min_height
+        self._slots_per_shelf = page_size / tile_size
+        self._quads_per_page = self._slots_per_shelf * (page_size / min_height)
+
+        self._free_slots = [[] for i in xrange(self._classes)] # (page, (ty,tx)) by class
+        self._pages = 0
+        self._page_top = page_size # first row not taken by shelves in the last page
+        self._free_quads = [] # by page, freed quad numbers
+        self._used_quads = [] # by page, quads ever handed out
+
+        self._used_pixels = 0
+        self._reserved_pixels = 0 # in the shelves
+
+
+    def getQuadsPerPage(self):
+        return self._quads_per_page
+
+
+    def getPages(self):
+        return self._pages
+
+
+    # quads to draw for the page: the ones above weren't ever used
+    def getUsedQuads(self, page):
+        return self._used_quads[page]
+
+
+    def allocate(self, w, h):
+        cls = (h + self._min_height - 1) / self._min_height - 1
+        free = self._free_slots[cls]
+
+        if not free:
+            self.newShelf(cls)
+
+        page, pos = free.pop()
+
+        quads = self._free_quads[page]
+        if quads:
+            quad = quads.pop()
+        else:
+            quad = page * self._quads_per_page + self._used_quads[page]
+            self._used_quads[page] += 1
+
+        self._used_pixels += w * h
+        return (page, pos, quad, (w,h))
+
+
+    def free(self, tile):
+        page, pos, quad, (w,h) = tile
+        cls = (h + self._min_height - 1) / self._min_height - 1
+
+        self._free_slots[cls].append((page, pos))
+        self._free_quads[page].append(quad)
+        self._used_pixels -= w * h
+
+
+    # adds a shelf for the tiles of the class, in a new page if it
+    # doesn't fit in the last one
+    def newShelf(self, cls):
+        shelf_h = (cls + 1) * self._min_height
+
+        if self._page_top + shelf_h > self._page_size:
+            self._pages += 1
+            self._page_top = 0
+            self._free_quads.append([])
+            self._used_quads.append(0)
+
+        page, ty = self._pages - 1, self._page_top
+        self._page_top += shelf_h
+        self._reserved_pixels += shelf_h * self._page_size
+
+        # the leftmost slots are given first
+        ts = self._tile_size
+        self._free_slots[cls].extend((page, (ty, tx)) for tx in xrange(self._page_size - ts, -1, -ts))
+
+
+    # used: fraction of the pages covered by tiles
+    # reserved: fraction taken by shelves (used or free)
+    def getOccupancy(self):
+        total = float(max(self._pages, 1) * self._page_size ** 2)
+        return {"pages": self._pages,
+                "used": self._used_pixels / total,
+                "reserved": self._reserved_pixels / total}
+
+
 class SpriteTexture:
     def __init__(self, surface_size):
         self._surface = pygame.Surface((surface_size,surface_size), flags=pygame.SRCALPHA)
@@ -50,9 +176,13 @@ class SpriteTexture:
 
     # note vbo_index is the GLOBAL TILE NUMBER
     # that is, not numbered within the texture
-    def setTainted(self, img = False, vbo_index=None):
+    # rect (x,y,w,h) is the part of the image that changed (all if None)
+    def setTainted(self, img = False, vbo_index=None, rect=None):
         if img:
             self._img_tainted = True
+            if rect is None:
+                rect = (0, 0, self._surface.get_width(), self._surface.get_height())
+            self._dirty_rects.append(rect)
         if vbo_index is not None:
             self._vbo_change_low = min(self._vbo_change_low, vbo_index)
             self._vbo_change_high = max(self._vbo_change_high, vbo_index+1)
@@ -60,6 +190,7 @@ class SpriteTexture:
 
     def reset(self):
         self._img_tainted = False
+        self._dirty_rects = []
 
         self._vbo_change_low = 1000000
         self._vbo_change_high = 0
@@ -74,10 +205,22 @@ class SpriteTexture:
         return t
 
 
+    # uploads the changed parts of the image. Returns the bytes sent
     def updateGlTexture(self):
-        if self._img_tainted:
-            self._texture.update(self._surface)
-            self._img_tainted = False
+        if not self._img_tainted:
+            return 0
+
+        rects = mergeRects(self._dirty_rects)
+        if len(rects) > _max_dirty_rects:
+            rects = [boundingRect(rects)]
+
+        sent = 0
+        for r in rects:
+            sent += self._texture.updateRect(self._surface, r)
+
+        self._img_tainted = False
+        self._dirty_rects = []
+        return sent
 
 
     def bind(self, loc):
@@ -90,17 +233,17 @@ class SpriteManager:
         self._tile_size = tile_size
         self._texture_size = 1024
         self._max_textures = 5
-        self._tile_rows_in_texture = self._texture_size / tile_size
-        self._free_tiles = SortedList()
+        self._tiles = TileAllocator(self._texture_size, tile_size)
         self._textures = []
-        self._total_tiles = 0
         self._sprites = {}
         self._top_sprite_id = 0
-        self._total_tiles_per_texture = int(self._tile_rows_in_texture**2)
-        self._vbo_index_bytes_per_texture = self._total_tiles_per_texture * 6 * _floats_per_vertex * ctypes.sizeof(ctypes.c_uint16)
+        self._total_tiles_per_texture = self._tiles.getQuadsPerPage()
+        self._vbo_index_bytes_per_texture = self._total_tiles_per_texture * 6 * ctypes.sizeof(ctypes.c_uint16)
 
         self._max_tiles = self._total_tiles_per_texture *self._max_textures
 
+        self._uploaded_bytes = 0 # texture bytes sent in the last draw
+
         self.initBuffers()
 
 
@@ -156,39 +299,41 @@ class SpriteManager:
         glBindVertexArray(0)
 
 
-    # creates a new texture and pushes all new tiles
-    # into the _free_tiles list
-
     def newTexture(self):
-        texture_surface_id = len(self._textures)
-
         texture = SpriteTexture(self._texture_size)
 
         self._textures.append(texture) #[texture_surf, texture,False,0,0])
 
-        ty = 0
-        for y in xrange(self._tile_rows_in_texture):
-            tx = 0
-            for x in xrange(self._tile_rows_in_texture): #  #cols = #rows
-                self._free_tiles.add((texture_surface_id, (ty,tx), self._total_tiles))
-                tx += self._tile_size
-                self._total_tiles += 1
-            ty += self._tile_size
 
+    # a tile for a piece of w x h pixels (at most tile_size x tile_size)
+    def getFreeTile(self, w, h):
+        tile = self._tiles.allocate(w, h)
 
-    def getFreeTile(self):
-        try:
-            tile = self._free_tiles.pop(0)
-        except:
-            self.newTexture() # create more tiles
-            tile = self._free_tiles.pop(0)
+        while tile[0] >= len(self._textures): # the allocator opened a page
+            self.newTexture()
 
         return tile
 
 
+    def freeTile(self, tile):
+        self.setTileAlpha(tile, 0) # this disables the rendering of the tile
+        self._tiles.free(tile)
+
+
+    # texture bytes uploaded by the last draw
+    def getUploadedBytes(self):
+        return self._uploaded_bytes
+
+
+    # pages: atlas textures, used: fraction of them covered by sprites,
+    # reserved: fraction given to shelves of tiles
+    def getOccupancy(self):
+        return self._tiles.getOccupancy()
+
+
 
     def setTileAlpha(self, tile, alpha):
-        texture_surf_id, tile_pos, tile_num = tile
+        texture_surf_id, tile_pos, tile_num, size = tile
 
         d = self._data[4*tile_num:4*tile_num+4]
         d[0:4,5] = alpha
@@ -197,26 +342,25 @@ class SpriteManager:
 
 
     def setTileGraphics(self, tile, src_tile_coord, surf, alpha):
-        texture_surf_id, (ty,tx), tile_num = tile
+        texture_surf_id, (ty,tx), tile_num, (tw,th) = tile
 
         src_x = src_tile_coord[0] * self._tile_size
         src_y = src_tile_coord[1] * self._tile_size
-        ts = self._tile_size
 
         # blit texture onto it
 
         tex = self._textures[texture_surf_id]
         texture_surf = tex.getSurface()# texture surface
 
-        texture_surf.fill((0,0,0,0), rect=(tx,ty,ts,ts) )
-        texture_surf.blit(surf, (tx,ty), area=(src_x,src_y,ts,ts))
+        texture_surf.fill((0,0,0,0), rect=(tx,ty,tw,th) )
+        texture_surf.blit(surf, (tx,ty), area=(src_x,src_y,tw,th))
 
 
         # setup the vbo data
         u0 = float(tx) / self._texture_size
-        u1 = float(tx+ts) / self._texture_size
+        u1 = float(tx+tw) / self._texture_size
         v0 = 1.0-float(ty) / self._texture_size
-        v1 = 1.0-float(ty+ts) / self._texture_size
+        v1 = 1.0-float(ty+th) / self._texture_size
 
 
         d = self._data[4*tile_num:4*tile_num+4]
@@ -225,16 +369,19 @@ class SpriteManager:
         d[2][3:6] = (u1,v1, alpha)
         d[3][3:6] = (u1,v0, alpha)
 
-        tex.setTainted(img=True, vbo_index=tile_num)
+        tex.setTainted(img=True, vbo_index=tile_num, rect=(tx,ty,tw,th))
 
 
     def setTileTransform(self, tile, src_tile_coord, transform_info):
-        texture_surf_id, tile_pos, tile_num = tile
+        texture_surf_id, tile_pos, tile_num, (tw,th) = tile
 
         dx,dy,p0,px,py = transform_info
 
-        x0 = dx * src_tile_coord[0]
-        y0 = dy * src_tile_coord[1]
+        # the tile covers tw x th pixels of the sprite
+        x0 = dx * src_tile_coord[0] * self._tile_size
+        y0 = dy * src_tile_coord[1] * self._tile_size
+        dx *= tw
+        dy *= th
 
         d = self._data[4*tile_num:4*tile_num+4]
         vx = px - p0
@@ -250,12 +397,9 @@ class SpriteManager:
         self._textures[texture_surf_id].setTainted(vbo_index=tile_num)
 
 
+    # dx, dy: fractions of the sprite per pixel
     def getTransformInfo(self, surf_w, surf_h, xform,centered):
 
-        ts = self._tile_size
-        tiles_w = int(math.ceil(float(surf_w)/ts))
-        tiles_h = int(math.ceil(float(surf_h)/ts))
-
         p0 = N.array((0,0,0),dtype="f")
         px = N.array((surf_w,0,0),dtype="f")
         py = N.array((0,surf_h,0),dtype="f")
@@ -274,8 +418,8 @@ class SpriteManager:
             py = N.dot(xr,py)+xt
 
 
-        dx = 1.0/tiles_w
-        dy = 1.0/tiles_h
+        dx = 1.0/surf_w
+        dy = 1.0/surf_h
 
 
         return dx,dy,p0,px,py
@@ -297,7 +441,7 @@ class SpriteManager:
 
         for y in xrange(tiles_y):
             for x in xrange(tiles_x):
-                tile = self.getFreeTile()
+                tile = self.getFreeTile(min(ts, w - x*ts), min(ts, h - y*ts))
                 self.setTileGraphics(tile, (x,y), surface, alpha )
                 self.setTileTransform(tile, (x,y), transform_info )
                 sprite_tiles.append(tile)
@@ -327,8 +471,7 @@ class SpriteManager:
             return
 
         for tile in s[0]: # iterate over the tiles in the sprite
-            self.setTileAlpha(tile, 0) # this disables the rendering of the sprite
-            self._free_tiles.add(tile)
+            self.freeTile(tile)
 
         del self._sprites[sid]
 
@@ -379,8 +522,7 @@ class SpriteManager:
         sprite_tiles,(w,h),alpha,xform,centered  = s
 
         for tile in sprite_tiles: # iterate over the tiles in the sprite
-            self._free_tiles.add(tile)
-            self.setTileAlpha(tile, 0) # this disables the rendering of the sprite
+            self.freeTile(tile)
 
 
         s = self._newSpriteHlp(surface, alpha, xform, centered)
@@ -400,8 +542,9 @@ class SpriteManager:
         glBindVertexArray(self._vao)
         ofs = 0
         self._indices_vbo.bind()
-        for t in self._textures:
-            t.updateGlTexture()
+        self._uploaded_bytes = 0
+        for page, t in enumerate(self._textures):
+            self._uploaded_bytes += t.updateGlTexture()
 
             if t.isVboTainted():
                 fac = _floats_per_vertex * 4 * fsize # bytes/quad
@@ -416,7 +559,8 @@ class SpriteManager:
 
             t.bind(self._texture_loc)
 
-            glDrawElements(GL_TRIANGLES,self._total_tiles_per_texture*6, GL_UNSIGNED_SHORT, ctypes.c_void_p(ofs))
+            # only up to the last quad used in the page
+            glDrawElements(GL_TRIANGLES,self._tiles.getUsedQuads(page)*6, GL_UNSIGNED_SHORT, ctypes.c_void_p(ofs))
 
             ofs += self._vbo_index_bytes_per_texture
 
@@ -24,7 +24,6 @@ SOFTWARE.
 
 
 from entities import Entity
-from particles import ParticleGenerator
 import libs.transformations as T
 from mathtools import *
 import resources as R
@@ -65,10 +64,11 @@ class TargetPoint(Entity):
 
 
     def close(self):
-        pg = ParticleGenerator("billboard","particle2.png")
+        pm = self._scene.getParticleManager()
+        pg = pm.getGenerator("billboard","particle2.png")
         pg.setMode("ONCE")
         pg.setPosition(self._pos)
-        self._scene.getParticleManager().manageGenerator(pg)
+        pm.manageGenerator(pg)
         self._closing = True
 
 
@@ -0,0 +1,121 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+# Helpers for the geomipmapped terrain. Each patch has one triangle strip
+# per level of detail k, which only uses every 2^k-th row and column of the
+# height map. Cracks between patches at different levels are hidden with
+# skirts: strips hanging down from the border of every patch.
+#
+# Nothing here needs a GL context.
+
+import numpy as N
+
+
+# the coordinates 0, step, 2*step... always including the last one (n-1)
+def levelSamples(n, step):
+    return N.append(N.arange(0, n-1, step), n-1).astype(N.int32)
+
+
+# triangle strip covering the grid of vertices at the given (absolute)
+# rows and columns of a map that is w vertices wide.
+# Rows are joined with degenerate vertices
+def gridStrip(rows, cols, w):
+    nc = cols.shape[0]
+    top = rows[:-1,None] * w + cols[None,:]
+    bottom = rows[1:,None] * w + cols[None,:]
+
+    strip = N.empty((rows.shape[0]-1, 2*nc+2), dtype=N.int32)
+    strip[:,0:2*nc:2] = top
+    strip[:,1:2*nc:2] = bottom
+    strip[:,2*nc] = bottom[:,-1] # degenerate vertex (end of the row)
+    strip[:,2*nc+1] = bottom[:,0] # degenerate vertex (beginning of next row)
+
+    return strip.ravel()[:-2] # the last row has no degenerate vertices
+
+
+# a strip zig-zagging between two lines of vertices (used for the skirts)
+def ribbonStrip(line1, line2):
+    return N.column_stack((line1, line2)).ravel().astype(N.int32)
+
+
+# concatenates several strips into one, adding degenerate vertices between them
+def joinStrips(strips):
+    parts = []
+    for s in strips:
+        if parts:
+            parts.append(N.array((parts[-1][-1], s[0]), dtype=N.int32))
+        parts.append(s)
+    return N.concatenate(parts)
+
+
+# linear interpolation of the values at the (sorted) coordinates coords
+# along the last axis of values, evaluated at 0..n-1
+def _lerpLastAxis(values, coords, n):
+    p = N.arange(n)
+    j = N.clip(N.searchsorted(coords, p, "right")-1, 0, coords.shape[0]-2)
+    t = (p - coords[j]) / N.array(coords[j+1] - coords[j], dtype="f")
+    return values[...,j] * (1.0-t) + values[...,j+1] * t
+
+
+# maximum vertical error of every level of detail of a patch, given the
+# heights of all its vertices. Levels are made monotonic (a coarser level
+# is never reported as more accurate than a finer one)
+def patchLevelErrors(heights, levels):
+    h,w = heights.shape
+    errors = N.zeros(levels, dtype="f")
+
+    for k in xrange(1,levels):
+        step = 1 << k
+        rows = levelSamples(h, step)
+        cols = levelSamples(w, step)
+        coarse = heights[rows][:,cols]
+
+        # rebuild the full resolution patch from the coarse vertices
+        approx = _lerpLastAxis(coarse, cols, w) # along x
+        approx = _lerpLastAxis(approx.T, rows, h).T # along y
+
+        errors[k] = N.abs(heights - approx).max()
+
+    return N.maximum.accumulate(errors)
+
+
+# distances from a point to a set of axis aligned boxes (n,2,3).
+# It's 0 for boxes containing the point
+def distanceToBoxes(pos, bounds):
+    pos = N.asarray(pos, dtype="f")
+    d = N.maximum(bounds[:,0,:] - pos, 0) + N.maximum(pos - bounds[:,1,:], 0)
+    return N.sqrt((d*d).sum(axis=1))
+
+
+# picks the coarsest level for every patch whose error, projected to the
+# screen, stays under max_pixel_error.
+# errors: (n, levels) geometric errors as returned by patchLevelErrors
+# distances: (n,) distance from the camera to every patch
+# pixel_scale: size in pixels of one world unit at distance 1
+def selectPatchLevels(errors, distances, pixel_scale, max_pixel_error):
+    scale = pixel_scale / N.maximum(distances, 1e-3)
+    screen_errors = errors * scale[:,None]
+    # errors grow with the level, so the good levels are all at the beginning
+    return (screen_errors <= max_pixel_error).sum(axis=1) - 1
@@ -0,0 +1,286 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+# Tiled height maps, for terrains that don't fit in memory.
+#
+# The tiles live in a single file, memory mapped when reading:
+#
+#   header: magic, version, map width, height, tile size, tiles across, tiles down
+#   tile index: for every tile (row by row) the offsets of its heights and
+#               normals and its minimum and maximum heights
+#   map locations (pickled)
+#   tile data: heights (t+1,t+1) float32 followed by normals (t+1,t+1,3) float32
+#
+# Each tile holds tile_size+1 vertices per side, sharing the last row and column
+# with its neighbours, so the map can be interpolated within a single tile.
+# The tiles at the right and bottom borders are padded with the edge values.
+
+import Queue
+import threading
+import struct
+import cPickle
+from collections import OrderedDict
+import numpy as N
+
+
+_MAGIC = "NYDTILES"
+_VERSION = 1
+_header_fmt = "<8s6I"
+
+_index_dtype = N.dtype([
+    ("heights", "<u8"), # byte offset of the heights
+    ("normals", "<u8"), # byte offset of the normals
+    ("zmin", "<f4"),
+    ("zmax", "<f4")])
+
+
+def _align(n, alignment=16):
+    return (n + alignment-1) // alignment * alignment
+
+
+def writeTiledMap(filename, heights, normals, locations, tile_size=200):
+    h,w = heights.shape
+    ts = tile_size
+
+    # the grid of a tile is drawn with 16 bit indices
+    if (ts+1)*(ts+1) > 65536:
+        raise ValueError("Tile size too large: %s"%ts)
+    tiles_x = max(1, (w-2) // ts + 1)
+    tiles_y = max(1, (h-2) // ts + 1)
+
+    # pad so all tiles have the same size
+    pad = ((0, tiles_y*ts+1 - h), (0, tiles_x*ts+1 - w))
+    heights = N.pad(N.asarray(heights, dtype="<f4"), pad, "edge")
+    normals = N.pad(N.asarray(normals, dtype="<f4"), pad + ((0,0),), "edge")
+
+    locations = cPickle.dumps(locations, 2)
+
+    index = N.zeros(tiles_x*tiles_y, dtype=_index_dtype)
+    index_start = struct.calcsize(_header_fmt)
+    data_start = _align(index_start + index.nbytes + 8 + len(locations))
+
+    heights_bytes = (ts+1) * (ts+1) * 4
+    tile_bytes = heights_bytes * 4
+
+    ofs = data_start
+    for ty in xrange(tiles_y):
+        for tx in xrange(tiles_x):
+            tile = heights[ty*ts:ty*ts+ts+1, tx*ts:tx*ts+ts+1]
+            index[ty*tiles_x+tx] = (ofs, ofs+heights_bytes, tile.min(), tile.max())
+            ofs += tile_bytes
+
+    with open(filename, "wb") as f:
+        f.write(struct.pack(_header_fmt, _MAGIC, _VERSION, w, h, ts, tiles_x, tiles_y))
+        f.write(index.tostring())
+        f.write(struct.pack("<Q", len(locations)))
+        f.write(locations)
+        f.seek(data_start)
+
+        for ty in xrange(tiles_y):
+            for tx in xrange(tiles_x):
+                f.write(heights[ty*ts:ty*ts+ts+1, tx*ts:tx*ts+ts+1].tostring())
+                f.write(normals[ty*ts:ty*ts+ts+1, tx*ts:tx*ts+ts+1].tostring())
+
+
+class TiledMapFile:
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            header = f.read(struct.calcsize(_header_fmt))
+            magic, version, w, h, ts, tiles_x, tiles_y = struct.unpack(_header_fmt, header)
+
+            if magic != _MAGIC or version != _VERSION:
+                raise ValueError("Not a tiled map (version %s): %s"%(_VERSION, filename))
+
+            self._index = N.fromstring(f.read(tiles_x*tiles_y*_index_dtype.itemsize), dtype=_index_dtype)
+            loc_size, = struct.unpack("<Q", f.read(8))
+            self._locations = cPickle.loads(f.read(loc_size))
+
+        self._dimensions = w,h
+        self._tile_size = ts
+        self._tiles_x = tiles_x
+        self._tiles_y = tiles_y
+
+        # nothing is read until a tile is accessed
+        self._data = N.memmap(filename, dtype="<f4", mode="r")
+
+
+    def getDimensions(self):
+        return self._dimensions
+
+
+    def getTileSize(self):
+        return self._tile_size
+
+
+    def getTileCount(self):
+        return self._tiles_x, self._tiles_y
+
+
+    def getLocations(self):
+        return self._locations
+
+
+    # the (min,max) heights of every tile, as two arrays (tiles_y, tiles_x)
+    def getHeightRanges(self):
+        shape = self._tiles_y, self._tiles_x
+        return self._index["zmin"].reshape(shape), self._index["zmax"].reshape(shape)
+
+
+    def hasTile(self, tx, ty):
+        return 0 <= tx < self._tiles_x and 0 <= ty < self._tiles_y
+
+
+    # returns copies (in memory) of the heights and normals of the tile
+    def readTile(self, tx, ty):
+        n = self._tile_size+1
+        entry = self._index[ty*self._tiles_x + tx]
+
+        h0 = int(entry["heights"]) // 4
+        n0 = int(entry["normals"]) // 4
+
+        heights = N.array(self._data[h0:h0+n*n]).reshape(n,n)
+        normals = N.array(self._data[n0:n0+n*n*3]).reshape(n,n,3)
+
+        return heights, normals
+
+
+
+# Keeps up to max_resident tiles in memory, dropping the least recently used
+# ones. Tiles can be requested in advance (they're read by a background thread)
+# or synchronously with getTile
+
+class TileCache:
+    def __init__(self, tiled_file, max_resident=64):
+        self._file = tiled_file
+        self._max_resident = max_resident
+
+        self._tiles = OrderedDict() # least recently used first
+        self._pending = set()
+        self._lock = threading.Lock()
+
+        self._to_load = Queue.Queue()
+        self._do_end = False
+
+        self._thread = threading.Thread(target = self._worker)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def getFile(self):
+        return self._file
+
+
+    # returns (heights, normals) of the tile, reading it if needed.
+    # None if the tile is outside the map
+    def getTile(self, tx, ty):
+        key = tx,ty
+        with self._lock:
+            try:
+                tile = self._tiles.pop(key)
+                self._tiles[key] = tile # now it's the most recently used
+                return tile
+            except KeyError:
+                pass
+
+        if not self._file.hasTile(tx,ty):
+            return None
+
+        tile = self._file.readTile(tx,ty)
+        self._store(key, tile)
+        return tile
+
+
+    # like getTile, but doesn't store the tile if it wasn't resident
+    # (for one-off passes over the whole map)
+    def peekTile(self, tx, ty):
+        with self._lock:
+            try:
+                return self._tiles[(tx,ty)]
+            except KeyError:
+                pass
+        return self._file.readTile(tx,ty)
+
+
+    def isResident(self, tx, ty):
+        return (tx,ty) in self._tiles
+
+
+    def getResidentTiles(self):
+        with self._lock:
+            return self._tiles.keys()
+
+
+    # makes sure the tiles within radius (in tiles) of the map position are
+    # loaded, the closest ones first. Returns immediately
+    def requestArea(self, x, y, radius):
+        ts = self._file.getTileSize()
+        cx = int(x) // ts
+        cy = int(y) // ts
+
+        around = [(tx,ty) for ty in xrange(cy-radius, cy+radius+1)
+                            for tx in xrange(cx-radius, cx+radius+1)
+                            if self._file.hasTile(tx,ty)]
+        around.sort(key=lambda t:abs(t[0]-cx)+abs(t[1]-cy))
+
+        with self._lock:
+            # the farthest first, so the closest end up as the most recently used
+            for key in reversed(around):
+                try:
+                    self._tiles[key] = self._tiles.pop(key)
+                except KeyError:
+                    pass
+
+            for key in around:
+                if key not in self._tiles and key not in self._pending:
+                    self._pending.add(key)
+                    self._to_load.put(key)
+
+
+    def _store(self, key, tile):
+        with self._lock:
+            self._tiles.pop(key, None)
+            self._tiles[key] = tile
+            self._pending.discard(key)
+
+            while len(self._tiles) > self._max_resident:
+                self._tiles.popitem(last=False)
+
+
+    def finish(self):
+        self._do_end = True
+        self._thread.join()
+
+
+    def _worker(self):
+        while not self._do_end:
+            try:
+                key = self._to_load.get(True,0.5)
+                if key not in self._tiles:
+                    self._store(key, self._file.readTile(*key))
+                else:
+                    with self._lock:
+                        self._pending.discard(key)
+            except Queue.Empty:
+                pass
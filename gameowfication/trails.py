@@ -0,0 +1,157 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 Guillermo Romero Franco (AKA Gato)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+from profiler import profile
+from glcompat import *
+from gltools import *
+import resources as R
+import numpy as N
+
+
+# Trails left by the projectiles, drawn as ribbons that face the camera.
+# The recent positions of every trail are kept in a ring, one row per trail
+# of a float texture shared by all of them:
+# texel 0: index of the newest point, number of points
+# texels 1..length: x, y, z, time the point was added
+# Every frame the used rows are uploaded at once and all the trails are
+# drawn with a single call (one instance per trail, see trail_v.shdr)
+class TrailRenderer:
+
+    def __init__(self, max_trails=128, length=32, no_gl=False):
+        self._max_trails = max_trails
+        self._length = length
+        self._no_gl = no_gl
+
+        self._points = N.zeros((max_trails, length+1, 4), dtype="f")
+
+        self._free = range(max_trails) # free rows, lowest last
+        self._free.reverse()
+        self._live = set() # rows in use (open or fading out)
+        self._closed = {} # closed rows, fading out
+        self._used = 0 # rows uploaded and drawn: highest live row + 1
+
+        self._time = 0
+        self.setLook()
+
+        if not no_gl:
+            self.initGl()
+
+
+    def initGl(self):
+        self._shader = R.getShaderProgram("trail")
+        self._texture = Texture(smoothing=False)
+        self._texture.setFromArray(self._points)
+        self._binder = self._texture.getBinder(0, self._shader.getUniformPos("points"))
+        self._params_uni = self._shader.getUniformPos("params")
+        self._brightness_uni = self._shader.getUniformPos("brightness")
+        self._length_uni = self._shader.getUniformPos("trail_length")
+        self._vao = glGenVertexArray() # no attributes, but one must be bound
+
+
+    # lifetime in ms of every point, width of the ribbon when the point
+    # is added and when it fades out
+    def setLook(self, lifetime=500.0, start_width=0.05, end_width=0.2, brightness=0.5):
+        self._lifetime = lifetime
+        self._widths = start_width, end_width
+        self._brightness = brightness
+
+
+    # a new, empty trail. None if they are all in use
+    def newTrail(self):
+        if not self._free:
+            if not self._closed:
+                return None
+            # reuse the trail that has faded out the most
+            oldest = min(self._closed, key=lambda row: self._closed[row])
+            self.freeTrail(oldest)
+
+        row = self._free.pop()
+        self._points[row] = 0
+        self._live.add(row)
+        self._used = max(self._used, row + 1)
+        return row
+
+
+    # adds the newest point of the trail
+    def addTrailPoint(self, trail, pos):
+        info = self._points[trail, 0]
+        head = (int(info[0]) + 1) % self._length
+        self._points[trail, head + 1, 0:3] = pos
+        self._points[trail, head + 1, 3] = self._time
+        info[0] = head
+        info[1] = min(info[1] + 1, self._length)
+
+
+    # no more points will be added. The trail fades out and is freed
+    def closeTrail(self, trail):
+        info = self._points[trail, 0]
+        newest = self._points[trail, int(info[0]) + 1, 3] if info[1] else self._time
+        self._closed[trail] = newest
+
+
+    def freeTrail(self, trail):
+        del self._closed[trail]
+        self._live.remove(trail)
+        self._points[trail] = 0
+
+        # keep the lowest rows first, so the used rows stay packed
+        self._free.append(trail)
+        self._free.sort(reverse=True)
+        self._used = max(self._live) + 1 if self._live else 0
+
+
+    def getLiveTrails(self):
+        return len(self._live)
+
+
+    # called once per frame before adding the points
+    def update(self, time):
+        self._time = time
+
+        expired = [t for t, newest in self._closed.iteritems() if time - newest > self._lifetime]
+        for t in expired:
+            self.freeTrail(t)
+
+
+    @profile
+    def draw(self, scene):
+        if not self._used:
+            return
+
+        # the points are only in the rows below _used
+        self._texture.updateFromArray(self._points[:self._used])
+
+        shader = self._shader
+        shader.begin()
+        scene.uploadMatrices(shader)
+        self._binder()
+        glUniform4f(self._params_uni, self._time, self._lifetime, self._widths[0], self._widths[1])
+        glUniform1f(self._brightness_uni, self._brightness)
+        glUniform1i(self._length_uni, self._length)
+
+        glBindVertexArray(self._vao)
+        glDrawArraysInstanced(GL_TRIANGLE_STRIP, 0, self._length * 2, self._used)
+        glBindVertexArray(0)
+        shader.end()
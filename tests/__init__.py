@@ -0,0 +1,11 @@
+# The modules of the game import each other by name, so the tests need the
+# package directory in the path. Run them from the root of the repository:
+#
+#   python -m unittest discover -s tests -t .
+
+import os
+import sys
+
+_game_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gameowfication")
+if _game_dir not in sys.path:
+    sys.path.insert(0, _game_dir)
@@ -0,0 +1,72 @@
+# Draw calls and time of ParticleController.draw with the billboard effects
+# drawn one by one (single_draw=False) and all at once with the texture atlas
+# (see ParticleController.drawAtlas). Opens a window, so it needs a display.
+# On software renderers (llvmpipe) the atlas can be slower: the vertex
+# shader, run on the CPU, reads the parameters of every particle from a
+# texture, and that costs more than the draw calls it saves
+#
+#   python -m tests.bench_particle_draw
+
+import time
+
+import pygame
+import numpy as N
+
+import tests
+import particles as P
+from glcompat import *
+from scene import Scene
+
+
+_draw_calls = [0]
+
+def counted(fn):
+    def call(*args):
+        _draw_calls[0] += 1
+        return fn(*args)
+    return call
+
+P.glDrawArraysInstanced = counted(P.glDrawArraysInstanced)
+P.glDrawArraysInstancedBaseInstance = counted(P.glDrawArraysInstancedBaseInstance)
+
+
+def bench(scene, effects, single_draw, frames=50):
+    rnd = N.random.RandomState(1)
+    c = P.ParticleController(effects * 64, single_draw=single_draw)
+    for i in xrange(effects):
+        g = c.getGenerator("billboard", P._atlas_textures[i % len(P._atlas_textures)])
+        g.setSpawnSpeed(40)
+        g.setPosition(rnd.uniform((-20,-15,-60), (20,15,-30)))
+        c.manageGenerator(g)
+
+    for t in xrange(16, 1000, 16):
+        c.update(t)
+    c.draw(scene)
+    glFinish()
+
+    _draw_calls[0] = 0
+    t0 = time.time()
+    for i in xrange(frames):
+        glClear(GL_COLOR_BUFFER_BIT)
+        c.draw(scene)
+    glFinish()
+    t1 = time.time()
+
+    print "%4d effects  %-8s %5d draw calls/frame  %6.2f ms/frame" % (
+        effects, "atlas" if single_draw else "separate", _draw_calls[0] / frames, (t1-t0) * 1000.0 / frames)
+
+
+if __name__ == "__main__":
+    pygame.init()
+    pygame.display.set_mode((800,600), pygame.OPENGL|pygame.DOUBLEBUF)
+    glViewport(0,0,800,600)
+    glEnable(GL_BLEND)
+    glBlendFunc(GL_SRC_ALPHA, GL_ONE)
+
+    scene = Scene()
+    scene.init()
+    scene.freezeLight()
+
+    for effects in (10, 100, 500):
+        bench(scene, effects, False)
+        bench(scene, effects, True)
@@ -0,0 +1,34 @@
+# Startup cost of the particle records: the old per-particle loop that
+# filled the rand column against ParticleController.initData, and the whole
+# (headless) controller, for buffers of several sizes
+#
+#   python -m tests.bench_particles
+
+import random
+import time
+
+import tests
+import particles as P
+
+
+def loopInitData(data):
+    for i in xrange(len(data)):
+        data[i][0] = (i % P._BLOCK) + random.random()
+
+
+def bench(size):
+    t0 = time.time()
+    c = P.ParticleController(size, no_gl=True)
+    t1 = time.time()
+    loopInitData(c.getData())
+    t2 = time.time()
+    c.initData()
+    t3 = time.time()
+
+    print "%8d particles  controller %7.3fs  rand loop %7.3fs  numpy %7.3fs  x%.0f" % (
+        size, t1-t0, t2-t1, t3-t2, (t2-t1) / max(t3-t2, 1e-6))
+
+
+if __name__ == "__main__":
+    for size in (10000, 100000, 1000000):
+        bench(size)
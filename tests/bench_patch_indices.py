@@ -0,0 +1,30 @@
+# Startup cost of the terrain strip indices: the old per-index loop against
+# Map.calcAllPatchesTriStripsIndices, for the patches of maps of several sizes
+#
+#   python -m tests.bench_patch_indices
+
+import time
+
+import tests
+from tests.headless import headlessMap
+from tests.test_patch_indices import loopTriStripsIndices
+
+
+def bench(size):
+    m = headlessMap(size=(size,size))
+    patches = m.computePatchRects()
+
+    t0 = time.time()
+    for rect in patches:
+        loopTriStripsIndices(size, *rect)
+    t1 = time.time()
+    m.calcAllPatchesTriStripsIndices(patches)
+    t2 = time.time()
+
+    print "%5dx%-5d %3d patches  loop %7.3fs  numpy %7.3fs  x%.0f" % (
+        size, size, len(patches), t1-t0, t2-t1, (t1-t0) / max(t2-t1, 1e-6))
+
+
+if __name__ == "__main__":
+    for size in (401, 1001, 2001):
+        bench(size)
@@ -0,0 +1,49 @@
+# Objects of the game for the tests, built without GL nor data files
+
+import types
+
+import numpy as N
+
+from map import Map
+
+
+# a Map that skips __init__ (it reads the map files and needs GL), with only
+# the attributes the tests use:
+# heights: (h,w) heights, plain or quantized (see Map.compact)
+# normals: (h,w,3) normals, or (h,w,2) octahedral with compact
+# size: (w,h) in vertices, if there are no heights
+# tiles: TileCache of a tiled map (see tiledmap), with tiles of tile_size
+# Any other attribute is given by name, e.g. _lod_levels=5
+def headlessMap(heights=None, normals=None, size=None, tiles=None, tile_size=None, **attributes):
+    m = types.InstanceType(Map)
+
+    if size is None and heights is not None:
+        size = heights.shape[1], heights.shape[0]
+    if size is None and tiles is not None:
+        size = tiles.getFile().getDimensions()
+
+    m._dimensions = size
+    m._map = heights
+    m._normals = normals
+    m._compact = False
+    m._height_scale = 1.0
+    m._height_offset = 0.0
+    m._tiles = tiles
+    m._tile_size = tile_size
+    m._strip_templates = {}
+
+    for name, value in attributes.iteritems():
+        setattr(m, name, value)
+
+    return m
+
+
+# a smooth, deterministic (h,w) height map, between about -15 and 15
+def smoothHeights(w, h, seed=3):
+    rnd = N.random.RandomState(seed)
+    y, x = N.mgrid[0:h, 0:w].astype("f")
+    z = N.zeros((h,w), dtype="f")
+    for i in xrange(6):
+        fx, fy, ph = rnd.uniform(0.01, 0.2, 3)
+        z += rnd.uniform(1, 5) * N.sin(x*fx + y*fy + ph*10)
+    return z
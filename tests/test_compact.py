@@ -0,0 +1,102 @@
+import unittest
+
+import numpy as N
+
+from mathtools import octEncode, octDecode
+from tests.headless import headlessMap, smoothHeights
+
+
+def randomNormals(count, seed=2):
+    n = N.random.RandomState(seed).normal(size=(count,3))
+    return n / N.sqrt((n*n).sum(axis=1))[:,None]
+
+
+def angles(a, b):
+    return N.degrees(N.arccos(N.clip((a*b).sum(axis=-1), -1, 1)))
+
+
+class OctahedralTest(unittest.TestCase):
+
+    def testRoundTrip(self):
+        n = randomNormals(20000)
+        enc = octEncode(n)
+        self.assertEqual(enc.dtype, N.int8)
+        self.assertEqual(enc.shape, (20000,2))
+
+        dec = octDecode(enc)
+        self.assertTrue(N.allclose((dec*dec).sum(axis=1), 1, atol=1e-5))
+        self.assertTrue(angles(n, dec).max() < 1.0) # 8 bit per coordinate
+
+    def testAxes(self):
+        axes = N.array([(1,0,0), (-1,0,0), (0,1,0), (0,-1,0), (0,0,1), (0,0,-1)], dtype="f")
+        self.assertTrue(N.allclose(octDecode(octEncode(axes)), axes, atol=1e-6))
+
+    def testShape(self):
+        n = randomNormals(12).reshape(3,4,3)
+        self.assertEqual(octEncode(n).shape, (3,4,2))
+        self.assertTrue(angles(n, octDecode(octEncode(n))).max() < 1.0)
+
+
+
+class CompactMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.heights = smoothHeights(60, 40)
+        grad = N.gradient(self.heights)
+        mag = 1.0/N.sqrt(grad[0]*grad[0] + grad[1]*grad[1] + 1.0)
+        self.normals = N.array([-grad[1]*mag, -grad[0]*mag, mag]).transpose(1,2,0)
+
+        self.map = headlessMap(self.heights, self.normals)
+        self.map.compact()
+        self.map._compact = True
+
+
+    def testStorage(self):
+        self.assertEqual(self.map._map.dtype, N.uint16)
+        self.assertEqual(self.map._normals.dtype, N.int8)
+        self.assertEqual(self.map._map.nbytes + self.map._normals.nbytes, 60*40*4)
+
+
+    def testHeightError(self):
+        scale = self.map._height_scale
+        self.assertAlmostEqual(scale, (self.heights.max() - self.heights.min()) / 65535.0)
+
+        error = N.abs(self.map.getHeights() - self.heights)
+        # half a step, plus float32 rounding of heights of about 10
+        self.assertTrue(error.max() <= scale/2 + 1e-5, error.max())
+        self.assertAlmostEqual(self.map.getHeights().min(), self.heights.min(), 5)
+        self.assertAlmostEqual(self.map.getHeights().max(), self.heights.max(), 5)
+
+
+    def testNormalError(self):
+        self.assertTrue(angles(self.map.getNormals(), self.normals).max() < 1.0)
+
+
+    def testInterpolation(self):
+        whole = headlessMap(self.heights, self.normals)
+        rnd = N.random.RandomState(4)
+        for x,y in rnd.uniform((0,0), (58.9,38.9), size=(100,2)):
+            z1, n1 = self.map.interpolateCompact(x,y)
+            z2, n2 = whole.interpolate(self.heights, self.normals, x, y)
+            self.assertTrue(abs(z1 - z2) <= self.map._height_scale/2 + 1e-5)
+            self.assertTrue(N.abs(n1 - n2).max() < 0.02)
+
+
+    def testSteepRows(self):
+        whole = headlessMap(self.heights, self.normals)
+        # the angle error moves only the normals right at the limit
+        mismatch = (self.map.getSteepRows(0, 40, 0.9) != whole.getSteepRows(0, 40, 0.9)).sum()
+        self.assertTrue(mismatch <= 60*40 // 100, mismatch)
+
+
+    def testFlat(self):
+        m = headlessMap(N.zeros((5,5), dtype="f") + 3, N.zeros((5,5,3)) + (0,0,1))
+        m.compact()
+        m._compact = True
+        self.assertEqual(m._height_scale, 1.0)
+        self.assertTrue((m.getHeights() == 3).all())
+
+
+
+if __name__ == "__main__":
+    unittest.main()
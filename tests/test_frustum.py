@@ -0,0 +1,89 @@
+import unittest
+
+import numpy as N
+
+from mathtools import frustumProjMtx, lookAtMtx, frustumPlanes, aabbInFrustum
+from tests.headless import headlessMap
+
+
+# camera at eye looking at target (z up), 60 degrees, square viewport
+def viewProj(eye, target, near=1.0, far=500.0):
+    eye = N.array(eye, dtype="f")
+    target = N.array(target, dtype="f")
+    return N.dot(frustumProjMtx(60.0, near, far, 1.0), lookAtMtx(eye, target, N.array((0,0,1), dtype="f")))
+
+
+# True for the points (n,3) inside the clip volume
+def pointsInside(view_proj_m, points):
+    p = N.dot(N.column_stack((points, N.ones(len(points)))), view_proj_m.T)
+    w = p[:,3:4]
+    return (w[:,0] > 0) & (N.abs(p[:,0:3]) <= w).all(axis=1)
+
+
+def box(center, size):
+    c = N.array(center, dtype="f")
+    return N.array((c - size, c + size), dtype="f")
+
+
+class FrustumTest(unittest.TestCase):
+
+    def setUp(self):
+        self.m = viewProj((0,0,10), (100,0,10))
+        self.planes = frustumPlanes(self.m)
+
+
+    def testPlanesAreNormalized(self):
+        self.assertTrue(N.allclose(N.sqrt((self.planes[:,0:3]**2).sum(axis=1)), 1.0, atol=1e-5))
+
+
+    def testSimpleCases(self):
+        bounds = N.array((
+            box((50,0,10), 1), # in front
+            box((-50,0,10), 1), # behind
+            box((50,200,10), 1), # far to the left
+            box((50,0,-200), 1), # far below
+            box((800,0,10), 1), # beyond the far plane
+            box((0,0,10), 1), # around the eye (crosses the near plane)
+            box((50,29,10), 2), # straddles the side plane (tan(30)*50 = 28.9)
+        ))
+        visible = aabbInFrustum(self.planes, bounds)
+        self.assertEqual(list(visible), [True, False, False, False, False, True, True])
+
+
+    def testNeverCullsVisibleBoxes(self):
+        # boxes with any sampled point inside the frustum must be kept
+        rnd = N.random.RandomState(7)
+        centers = rnd.uniform((-100,-300,-200), (600,300,200), size=(400,3))
+        sizes = rnd.uniform(0.5, 40, size=(400,3))
+        bounds = N.array((centers - sizes, centers + sizes)).transpose(1,0,2).astype("f")
+
+        visible = aabbInFrustum(self.planes, bounds)
+
+        t = N.linspace(0, 1, 6)
+        grid = N.array(N.meshgrid(t, t, t)).reshape(3,-1).T
+        culled_right = 0
+        for b, v in zip(bounds, visible):
+            inside = pointsInside(self.m, b[0] + grid * (b[1] - b[0])).any()
+            if inside:
+                self.assertTrue(v, "culled a visible box %s" % (b,))
+            elif not v:
+                culled_right += 1
+
+        self.assertTrue(culled_right > 200) # it does cull
+
+
+    def testMapVisiblePatches(self):
+        m = headlessMap(_patch_bounds=N.array([box((x,y,0), 9) for y in xrange(-95,100,20) for x in xrange(-95,100,20)], dtype="f"))
+
+        visible = m.getVisiblePatches(viewProj((0,-1,250), (0,0,0)))
+        self.assertEqual(len(visible), 100) # looking down, all of them
+
+        visible = m.getVisiblePatches(viewProj((0,0,10), (100,0,10)))
+        centers = m._patch_bounds[visible].mean(axis=1)
+        self.assertTrue(0 < len(visible) < 100)
+        self.assertTrue((centers[:,0] > -20).all()) # nothing behind the camera
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+
+import numpy as N
+
+from heightpyramid import HeightPyramid
+from tests.headless import smoothHeights
+
+
+# heights of the triangulated map at the points (x,y), like Map.interpolate
+def surface(m, x, y):
+    xi = N.floor(x).astype(int)
+    yi = N.floor(y).astype(int)
+    xf = x - xi
+    yf = y - yi
+    upper = xf > 1 - yf
+    lower = ~upper
+
+    z = N.empty(x.shape)
+    z[lower] = ((1-xf-yf) * m[yi,xi] + xf * m[yi,xi+1] + yf * m[yi+1,xi])[lower]
+    z[upper] = ((xf+yf-1) * m[yi+1,xi+1] + (1-yf) * m[yi,xi+1] + (1-xf) * m[yi+1,xi])[upper]
+    return z
+
+
+# first distance where the ray is at or below the surface, in tiny steps
+def fineMarch(m, origin, direction, max_dist, step=0.005):
+    h,w = m.shape
+    t = N.arange(0, max_dist, step)
+    p = origin + direction * t[:,None]
+    inside = (p[:,0] >= 0) & (p[:,0] < w-1) & (p[:,1] >= 0) & (p[:,1] < h-1)
+    t, p = t[inside], p[inside]
+    below = N.nonzero(surface(m, p[:,0], p[:,1]) >= p[:,2])[0]
+    if len(below) == 0:
+        return None
+    return t[below[0]]
+
+
+def rays(count, size, seed=7):
+    rnd = N.random.RandomState(seed)
+    w,h = size
+    origins = N.column_stack((rnd.uniform(0, w, count), rnd.uniform(0, h, count), rnd.uniform(20, 40, count)))
+    targets = N.column_stack((rnd.uniform(0, w, count), rnd.uniform(0, h, count), rnd.uniform(-10, 10, count)))
+    directions = targets - origins
+    return origins, directions / N.sqrt((directions**2).sum(axis=1))[:,None]
+
+
+class HeightPyramidTest(unittest.TestCase):
+
+    def setUp(self):
+        self.heights = smoothHeights(97, 70).astype("f8")
+
+
+    def testLevels(self):
+        p = HeightPyramid(self.heights)
+        self.assertEqual(p.getLevels(), 8) # 96x69 cells -> 1x1
+        self.assertEqual(p.getLevel(p.getLevels()-1)[1].shape, (1,1))
+        self.assertAlmostEqual(p.getLevel(7)[0][0,0], self.heights.min())
+        self.assertAlmostEqual(p.getLevel(7)[1][0,0], self.heights.max())
+
+        # every node box holds the vertices under it
+        for level in (0, 2, 5):
+            for (x0,y0,z0), (x1,y1,z1) in p.getNodeBoxes(level)[::7]:
+                v = self.heights[int(y0):int(y1)+1, int(x0):int(x1)+1]
+                self.assertTrue(v.min() >= z0 - 1e-4 and v.max() <= z1 + 1e-4)
+
+
+    def testRaycastAsFineMarch(self):
+        p = HeightPyramid(self.heights)
+        origins, directions = rays(150, (96, 69))
+
+        same = hits = 0
+        for o, d in zip(origins, directions):
+            t = p.raycast(o, d, 150.0)
+            expected = fineMarch(self.heights, o, d, 150.0)
+            if t is not None:
+                hits += 1
+                # the pyramid hit is on the surface
+                x, y, z = o + d*t
+                self.assertAlmostEqual(surface(self.heights, N.array([x]), N.array([y]))[0], z, 3)
+            if t is None and expected is None:
+                same += 1
+            elif t is not None and expected is not None and abs(t - expected) < 0.02:
+                same += 1
+
+        # the march can step over a corner the ray only grazes
+        self.assertTrue(hits > 100, hits)
+        self.assertTrue(same >= 147, same)
+
+
+    def testQuantized(self):
+        lo, hi = self.heights.min(), self.heights.max()
+        scale = (hi - lo) / 65535.0
+        q = N.round((self.heights - lo) / scale).astype(N.uint16)
+
+        p = HeightPyramid(q, scale, lo)
+        exact = HeightPyramid(q * scale + lo)
+        for o, d in zip(*rays(50, (96, 69), seed=8)):
+            t1 = p.raycast(o, d, 150.0)
+            t2 = exact.raycast(o, d, 150.0)
+            self.assertEqual(t1 is None, t2 is None)
+            if t1 is not None:
+                self.assertAlmostEqual(t1, t2, 4)
+
+
+    def testMisses(self):
+        p = HeightPyramid(self.heights)
+        top = self.heights.max() + 1
+        self.assertEqual(p.raycast((10, 10, top), (1, 0.3, 0), 200.0), None) # level above the map
+        self.assertEqual(p.raycast((-5, 10, 5), (-1, 0, -0.1), 200.0), None) # away from it
+        self.assertEqual(p.raycast((10, 10, top), (0, 0, 0), 200.0), None)
+        self.assertEqual(p.raycast((10, 10, top + 50), (0, 0, -1), 10.0), None) # too short
+
+        t = p.raycast((10.5, 20.25, top + 50), (0, 0, -1), 200.0)
+        self.assertAlmostEqual(top + 50 - t, surface(self.heights, N.array([10.5]), N.array([20.25]))[0], 4)
+
+
+
+if __name__ == "__main__":
+    unittest.main()
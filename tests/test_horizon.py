@@ -0,0 +1,97 @@
+import unittest
+
+import numpy as N
+
+from heightpyramid import HeightPyramid
+from horizon import HorizonBuffer, projectBoxCorners
+from tests.test_frustum import viewProj
+
+
+# a valley (z = 0) closed by a ridge of height 20 along x = 40..48, with
+# hills behind it
+def ridgeHeights():
+    y, x = N.mgrid[0:129, 0:129].astype("f")
+    z = N.where((x >= 40) & (x <= 48), 20.0, 0.0)
+    z += N.where(x > 48, 8 + 6 * N.sin(x * 0.3) * N.cos(y * 0.2), 0.0)
+    return z.astype("f")
+
+
+class ProjectionTest(unittest.TestCase):
+
+    def testCorners(self):
+        m = viewProj((0,0,10), (100,0,10))
+        bounds = N.array((((20,-5,0), (30,5,4)),), dtype="f")
+
+        x, y, w = projectBoxCorners(m, bounds)
+        self.assertEqual(x.shape, (1,8))
+        for i, c in enumerate(((20,-5,0), (30,-5,0), (20,5,0), (30,5,0), (20,-5,4), (30,-5,4), (20,5,4), (30,5,4))):
+            p = N.dot(m, c + (1,))
+            self.assertAlmostEqual(x[0,i], p[0]/p[3], 5)
+            self.assertAlmostEqual(y[0,i], p[1]/p[3], 5)
+            self.assertAlmostEqual(w[0,i], p[3], 4)
+
+        # only the top corners, at the given height
+        x2, y2, w2 = projectBoxCorners(m, bounds, N.array((4,)))
+        self.assertEqual(x2.shape, (1,4))
+        self.assertTrue(N.allclose(x2, x[:,4:], atol=1e-6))
+        self.assertTrue(N.allclose(y2, y[:,4:], atol=1e-6))
+
+
+
+class HorizonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.heights = ridgeHeights()
+        self.pyramid = HeightPyramid(self.heights)
+        self.boxes = self.pyramid.getNodeBoxes(2) # 4x4 cells
+        self.eye = N.array((4, 64, 6), dtype="f")
+        self.m = viewProj(self.eye, (100, 64, 6))
+
+        horizon = HorizonBuffer(self.m, self.eye, self.pyramid.getNodeBoxes(3))
+        self.occluded = horizon.occluded(self.boxes)
+        self.horizon = horizon
+
+
+    # True if the ray from the eye to every point hits the terrain first
+    def hidden(self, points):
+        for p in points:
+            d = p - self.eye
+            l = N.sqrt(N.dot(d,d))
+            t = self.pyramid.raycast(self.eye, d / l, l)
+            if t is None or t > l - 0.05:
+                return False
+        return True
+
+
+    def testRidgeHides(self):
+        behind = self.boxes[:,0,0] >= 52
+        in_front = self.boxes[:,1,0] <= 40
+        self.assertTrue(self.occluded[behind].sum() > 50)
+        self.assertFalse(self.occluded[in_front].any())
+        self.assertTrue(self.horizon.getOccludersCount() > 0)
+
+
+    def testSound(self):
+        # every corner and the center of the top of an occluded box is hidden
+        # by the terrain
+        for (x0,y0,z0), (x1,y1,z1) in self.boxes[self.occluded]:
+            points = N.array([(x,y,z1) for x in (x0,x1) for y in (y0,y1)] + [((x0+x1)/2, (y0+y1)/2, z1)], dtype="f")
+            self.assertTrue(self.hidden(points), (x0,y0,x1,y1))
+
+
+    def testBehindTheEye(self):
+        # boxes behind (or around) the camera are never culled
+        boxes = N.array((((-20,60,0), (-10,70,5)), ((0,60,0), (8,70,5))), dtype="f")
+        self.assertFalse(self.horizon.occluded(boxes).any())
+
+
+    def testNoOccluders(self):
+        h = HorizonBuffer(self.m, self.eye, N.zeros((0,2,3)))
+        self.assertEqual(h.getOccludersCount(), 0)
+        self.assertFalse(h.occluded(self.boxes).any())
+        self.assertTrue(N.isneginf(h.getHorizon()).all())
+
+
+
+if __name__ == "__main__":
+    unittest.main()
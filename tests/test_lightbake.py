@@ -0,0 +1,132 @@
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as N
+
+import lightbake
+from lightbake import horizonTangents, ambientOcclusion, shadowMask, bakeLightMap, loadOrBakeLightMap
+
+
+# a step 5 high along the x axis: z = 0 for x < 10, 5 from there on
+def stepHeights(w=64, h=8):
+    z = N.zeros((h,w), dtype="f")
+    z[:,10:] = 5
+    return z
+
+
+def flatNormals(heights):
+    n = N.zeros(heights.shape + (3,), dtype="f")
+    n[...,2] = 1
+    return n
+
+
+class HorizonTangentsTest(unittest.TestCase):
+
+    def testStep(self):
+        z = stepHeights()
+        t = horizonTangents(z, 0.0) # looking along +x
+        self.assertEqual(t.shape, z.shape)
+
+        # the step is at the distances 1, 2, 4... from these points
+        self.assertAlmostEqual(t[3,9], 5.0)
+        self.assertAlmostEqual(t[3,8], 2.5)
+        self.assertAlmostEqual(t[3,6], 1.25)
+        self.assertAlmostEqual(t[3,0], 5/16.0) # 32 away it's 5 too, but flatter
+        self.assertTrue((t[:,10:] == 0).all()) # the top sees nothing higher
+
+        # looking back from the top all is lower
+        self.assertTrue((horizonTangents(z, math.pi) == 0).all())
+
+    def testFlat(self):
+        z = N.zeros((16,16), dtype="f") + 7
+        for a in (0, 1, 2.5, 4):
+            self.assertTrue((horizonTangents(z, a) == 0).all())
+
+
+
+class LightTest(unittest.TestCase):
+
+    def testFlat(self):
+        z = N.zeros((16,16), dtype="f")
+        self.assertTrue(N.allclose(ambientOcclusion(z), 1))
+        self.assertTrue(N.allclose(shadowMask(z, (1,0,0.2)), 1))
+
+        # only the diffuse lighting is left
+        l = N.array((1,0,1)) / math.sqrt(2)
+        light = bakeLightMap(z, flatNormals(z), (1,0,1), ambient=0.35)
+        self.assertEqual(light.dtype, N.float32)
+        self.assertTrue(N.allclose(light, 0.35 + 0.65 * l[2], atol=1e-5))
+
+    def testShadow(self):
+        z = stepHeights()
+        # low light from +x: the step shades the ground in front of it
+        s = shadowMask(z, (1,0,0.2))
+        self.assertTrue((s[:,6:10] == 0).all())
+        self.assertTrue((s[:,10:] == 1).all())
+        self.assertTrue((s[:,0] == 0).all()) # 16 away the step is still over 0.2
+
+        # light from the other side (or from above) reaches everything
+        self.assertTrue((shadowMask(z, (-1,0,0.2)) == 1).all())
+        self.assertTrue((shadowMask(z, (0,0,1)) == 1).all())
+
+    def testAmbientOcclusion(self):
+        ao = ambientOcclusion(stepHeights())
+        self.assertTrue(N.allclose(ao[:,12:], 1)) # the top
+        self.assertTrue((ao[:,9] < ao[:,6]).all()) # darker closer to the step
+        self.assertTrue((ao[:,6] < ao[:,0]).all())
+        self.assertTrue((ao[:,0:10] < 1).all())
+        self.assertTrue((ao >= 0).all())
+
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "test.light.npz")
+        self.bakes = 0
+
+        bake = lightbake.bakeLightMap
+        def counting(*args):
+            self.bakes += 1
+            return bake(*args)
+        lightbake.bakeLightMap = counting
+        self.bake = bake
+
+    def tearDown(self):
+        lightbake.bakeLightMap = self.bake
+        shutil.rmtree(self.dir)
+
+    def testKey(self):
+        z = stepHeights()
+        n = flatNormals(z)
+
+        first = loadOrBakeLightMap(self.filename, z, n, (1,0,1))
+        self.assertTrue(os.path.exists(self.filename))
+        again = loadOrBakeLightMap(self.filename, z, n, (1,0,1))
+        self.assertEqual(self.bakes, 1)
+        self.assertTrue((first == again).all())
+
+        # any change in the heights or the parameters bakes it again
+        loadOrBakeLightMap(self.filename, z, n, (1,0,2))
+        self.assertEqual(self.bakes, 2)
+        z[3,3] = 1
+        loadOrBakeLightMap(self.filename, z, n, (1,0,2))
+        self.assertEqual(self.bakes, 3)
+        loadOrBakeLightMap(self.filename, z, n, (1,0,2), directions=8)
+        self.assertEqual(self.bakes, 4)
+        loadOrBakeLightMap(self.filename, z, n, (1,0,2), directions=8)
+        self.assertEqual(self.bakes, 4)
+
+    def testUnwritable(self):
+        z = stepHeights()
+        light = loadOrBakeLightMap(os.path.join(self.dir, "missing", "x.npz"), z, flatNormals(z), (1,0,1))
+        self.assertEqual(light.shape, z.shape)
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,443 @@
+import types
+import unittest
+
+import numpy as N
+
+import particles as P
+
+
+# a generator that doesn't need GL (no shader nor texture)
+def headlessGenerator(mode="DYNAMIC", max_particles=100):
+    g = types.InstanceType(P.ParticleGenerator)
+    g._shader_name = "billboard"
+    g._texture_name = "test.png"
+    g.reset()
+    g.setMode(mode, max_particles)
+    return g
+
+
+class ParticleRecordsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.c = P.ParticleController(1000, no_gl=True)
+
+
+    def testLayout(self):
+        # one record per particle: rand, age, center, speed
+        self.assertEqual(P._fields_per_particle, 8)
+        self.assertEqual(self.c.getData().shape, (1000, 8))
+        self.assertEqual(self.c.getData().dtype, N.float32)
+
+        # the integer part of rand is the index within the smallest block
+        rand = self.c.getData()[:,0]
+        self.assertTrue((N.floor(rand) == N.arange(1000) % P._BLOCK).all())
+        self.assertTrue(N.unique(rand - N.floor(rand)).size > 990)
+
+
+    def testSpawnWritesOneRecordPerParticle(self):
+        g = headlessGenerator()
+        g.setSpawnSpeed(50)
+        g.setEmitter(P.pointEmitter((1,2,3), (4,5,6)), batched=True)
+        self.c.manageGenerator(g)
+        s0 = g.getSlotId()
+        before = self.c.getData().copy()
+
+        self.c.update(1000)
+        self.assertEqual(self.c.getUploadedBytes(), 0) # the first update only starts it
+
+        self.c.update(2000) # half a particle life: 25 particles
+        self.assertEqual(g.getLiveParticles(), 25)
+        self.assertEqual(self.c.getUploadedBytes(), 25 * 8 * 4)
+
+        data = self.c.getData()
+        spawned = data[s0:s0+25]
+        self.assertTrue((spawned[:,2:5] == (1,2,3)).all())
+        self.assertTrue((spawned[:,5:8] == (4,5,6)).all())
+        self.assertTrue((N.diff(spawned[:,P._AGE]) < 0).all()) # the oldest first
+        self.assertTrue((spawned[:,0] == before[s0:s0+25,0]).all()) # rand is kept
+
+        # nothing else is touched
+        self.assertTrue((data[:s0] == before[:s0]).all())
+        self.assertTrue((data[s0+25:] == before[s0+25:]).all())
+
+        self.c.update(2000) # no time passed
+        self.assertEqual(self.c.getUploadedBytes(), 0)
+
+
+    def testLoop(self):
+        # LOOP effects fill their block with copies of their particles once
+        g = headlessGenerator("LOOP", 40)
+        g.setEmitter(P.pointEmitter((0,0,0), (0,0,1)), batched=True)
+        self.c.manageGenerator(g)
+        self.c.update(1000)
+        self.c.update(1100)
+        self.assertEqual(self.c.getUploadedBytes(), 40 * 8 * 4) # the block (64) holds one copy
+
+        self.c.update(1200)
+        self.assertEqual(self.c.getUploadedBytes(), 0)
+
+
+    def testShapeEmitter(self):
+        # computed by the shader: nothing is written nor uploaded
+        g = headlessGenerator("ONCE", 50)
+        g.setShapeEmitter((1,1,1), speed=2.0)
+        self.c.manageGenerator(g)
+        before = self.c.getData().copy()
+
+        self.c.update(1000)
+        self.c.update(1100)
+        self.assertEqual(self.c.getUploadedBytes(), 0)
+        self.assertTrue((self.c.getData() == before).all())
+        self.assertEqual(g.getLiveParticles(), 50)
+
+
+class ShapeEmitterTest(unittest.TestCase):
+
+    def setUp(self):
+        c = P.ParticleController(64, no_gl=True)
+        self.rand = c.getData()[:,0]
+        self.index = N.arange(64)
+        # position, spread; velocity, speed; start, dt, inner, seed
+        self.uniforms = ((1,2,3,0.5), (0,0,4,2.0), (0.25, 0.01, 0.36, 1234))
+
+
+    def testAges(self):
+        age, center, speed = P.shapeStartState(self.rand, self.index, *self.uniforms)
+        self.assertEqual(age.shape, (64,))
+        self.assertTrue(N.allclose(age, -(0.25 + self.index * 0.01), atol=1e-6))
+
+
+    def testOffsets(self):
+        age, center, speed = P.shapeStartState(self.rand, self.index, *self.uniforms)
+        self.assertEqual(center.shape, (64,3))
+
+        # the offsets from the emitter are in the shell between the spheres of
+        # radius inner**0.5 and 1, scaled by spread (center) and speed (speed)
+        r = N.sqrt(((center - (1,2,3))**2).sum(axis=1)) / 0.5
+        self.assertTrue((r >= 0.6 - 1e-4).all() and (r <= 1 + 1e-4).all())
+        v = N.sqrt(((speed - (0,0,4))**2).sum(axis=1)) / 2.0
+        self.assertTrue(N.allclose(r, v, atol=1e-4)) # the same directions
+
+        # spread all over the shell, not only some of it
+        d = (center - (1,2,3)) / 0.5
+        self.assertTrue((d.min(axis=0) < -0.5).all() and (d.max(axis=0) > 0.5).all())
+
+
+    def testSeed(self):
+        a = P.shapeStartState(self.rand, self.index, *self.uniforms)
+        b = P.shapeStartState(self.rand.copy(), self.index, *self.uniforms)
+        for x, y in zip(a, b):
+            self.assertTrue((x == y).all())
+
+        # another seed moves the particles but not their ages
+        other = self.uniforms[:2] + ((0.25, 0.01, 0.36, 99),)
+        c = P.shapeStartState(self.rand, self.index, *other)
+        self.assertTrue((a[0] == c[0]).all())
+        self.assertFalse(N.allclose(a[1], c[1]))
+
+
+    def testGenerator(self):
+        c = P.ParticleController(256, no_gl=True)
+        g = headlessGenerator("ONCE", 50)
+        g.setShapeEmitter((1,2,3), inner=0.36, speed=2.0, spread=0.5, velocity=(0,0,4))
+        c.manageGenerator(g)
+        c.update(1000)
+        c.update(1100)
+
+        t0, t1 = g._active_particles_range
+        age, center, speed = g.getShapeStartState()
+        self.assertEqual(len(age), 50)
+        emitter = g.getShapeUniforms()[2]
+        expected = P.shapeStartState(c.getData()[t0:t1,0], N.arange(50), (1,2,3,0.5), (0,0,4,2.0), emitter)
+        self.assertTrue((center == expected[1]).all())
+        self.assertTrue(N.allclose(age, -(emitter[0] + N.arange(50) * 0.02), atol=1e-6))
+
+
+class BuddyAllocatorTest(unittest.TestCase):
+
+    def testSplit(self):
+        a = P.BuddyAllocator(1024, 16, 1024)
+        self.assertEqual(a.getFreeParticles(), 1024)
+
+        self.assertEqual(a.allocate(10), 0)
+        self.assertEqual(a.blockSize(0), 16)
+        self.assertEqual(a.getFreeParticles(), 1008)
+        # the 1024 block was split into the halves 16, 32, 64... 512
+        self.assertEqual([sorted(f) for f in a._free[4:]],
+                         [[16], [32], [64], [128], [256], [512], []])
+
+        self.assertEqual(a.allocate(17), 32) # takes the free 32
+        self.assertEqual(a.blockSize(32), 32)
+
+
+    def testMergeOnFree(self):
+        a = P.BuddyAllocator(1024, 16, 1024)
+        blocks = [a.allocate(n) for n in (16, 16, 100, 30, 200)]
+        for ofs in blocks:
+            a.free(ofs)
+        self.assertEqual(a.getFreeParticles(), 1024)
+        self.assertEqual(a._free[10], set([0]))
+        self.assertFalse(any(a._free[:10]))
+
+        # a block only merges with its own buddy
+        x, y, z = a.allocate(16), a.allocate(16), a.allocate(16)
+        a.free(y)
+        a.free(z)
+        self.assertEqual(a._free[4], set([16])) # 0 is still taken
+        self.assertTrue(32 in a._free[5]) # merged with 48
+        a.free(x)
+        self.assertEqual(a._free[10], set([0]))
+
+
+    def testAlignment(self):
+        a = P.BuddyAllocator(4096, 16, 1024)
+        rnd = N.random.RandomState(3)
+        used = N.zeros(4096, dtype=int)
+        for n in rnd.randint(1, 1100, 40):
+            ofs = a.allocate(n)
+            if ofs is None:
+                continue
+            size = a.blockSize(ofs)
+            self.assertEqual(ofs % size, 0)
+            self.assertTrue(size >= min(n, 1024))
+            used[ofs:ofs+size] += 1
+        self.assertTrue(used.max() <= 1) # no overlaps
+        self.assertEqual(a.getFreeParticles(), 4096 - used.sum())
+
+
+    def testNotPowerOfTwo(self):
+        a = P.BuddyAllocator(1000, 16, 256)
+        # 3 x 256 + 128 + 64 + 32 = 992: the last 8 are too few for a block
+        self.assertEqual(a.getFreeParticles(), 992)
+        blocks = []
+        ofs = a.allocate(16)
+        while ofs is not None:
+            blocks.append(ofs)
+            ofs = a.allocate(16)
+        self.assertEqual(len(blocks), 62)
+        self.assertTrue(max(blocks) + 16 <= 1000)
+
+
+    def testExhaustion(self):
+        a = P.BuddyAllocator(128, 16, 64)
+        self.assertEqual(a.allocate(500), 0) # no more than max_block
+        self.assertEqual(a.blockSize(0), 64)
+        self.assertEqual(a.allocate(64), 64)
+        self.assertEqual(a.allocate(16), None)
+        a.free(0)
+        self.assertEqual(a.allocate(16), 0)
+
+
+
+class EvictionTest(unittest.TestCase):
+
+    def dynamicGenerator(self, priority=1.0):
+        g = headlessGenerator()
+        g.setSpawnSpeed(40) # needs 49 particles: a block of 64
+        g.setPriority(priority)
+        g.setEmitter(P.pointEmitter((0,0,0), (0,0,1)), batched=True)
+        return g
+
+
+    def testMakesRoom(self):
+        c = P.ParticleController(128, no_gl=True)
+        a, b = self.dynamicGenerator(), self.dynamicGenerator()
+        c.manageGenerator(a)
+        c.manageGenerator(b)
+        self.assertEqual(sorted(c._generators.keys()), [0, 64])
+
+        # the oldest goes, and its block is given to the new one
+        d = self.dynamicGenerator()
+        c.manageGenerator(d)
+        self.assertFalse(a._is_managed)
+        self.assertEqual(c._generators.values(), [b, d])
+        self.assertEqual(d.getSlotId(), 0)
+
+        c.update(1000)
+        self.assertEqual(c.getStats()["evicted"], 1)
+        c.update(1100)
+        self.assertEqual(c.getStats()["evicted"], 0)
+
+
+    def testLowestPriorityFirst(self):
+        c = P.ParticleController(192, no_gl=True)
+        low, high, mid = self.dynamicGenerator(1.0), self.dynamicGenerator(5.0), self.dynamicGenerator(2.0)
+        for g in (high, low, mid):
+            c.manageGenerator(g)
+        c.update(1000) # computes the priorities
+
+        c.manageGenerator(self.dynamicGenerator())
+        self.assertFalse(low._is_managed)
+        self.assertTrue(high._is_managed and mid._is_managed)
+
+        # and a generator that is larger than the whole buffer gets nothing
+        big = self.dynamicGenerator()
+        big.setSpawnSpeed(5000)
+        c2 = P.ParticleController(48, no_gl=True)
+        c2.manageGenerator(big)
+        self.assertEqual(c2._generators, {})
+
+
+# the scan countDead replaced: walks the tail while the particles are dead
+def linearDead(data, t0, n, time):
+    dead = 0
+    while dead < n and data[(t0 + dead) % len(data), P._AGE] + time > 1.0:
+        dead += 1
+    return dead
+
+
+class CountDeadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.c = P.ParticleController(64, no_gl=True)
+        self.g = headlessGenerator()
+        self.c.manageGenerator(self.g)
+        self.data = self.c.getData()
+
+
+    # n particles from t0 spawned dt apart, the first at time 0
+    def fill(self, t0, n, dt):
+        for i in xrange(n):
+            self.data[(t0 + i) % 64, P._AGE] = -i * dt
+
+
+    def check(self, t0, n, time):
+        self.g._time = time
+        dead = self.g.countDead(t0, n)
+        self.assertEqual(dead, linearDead(self.data, t0, n, time))
+        return dead
+
+
+    def testWrapped(self):
+        self.fill(50, 40, 0.05)
+        # alive if time - spawn time < 1: the ones spawned after time - 1
+        self.assertEqual(self.check(50, 40, 1.52), 11) # 50..60
+        self.assertEqual(self.check(50, 40, 1.82), 17) # over the end of the ring
+        self.assertEqual(self.check(50, 40, 2.12), 23)
+
+    def testFull(self):
+        self.fill(10, 63, 0.01)
+        for time in (0.5, 1.0, 1.005, 1.2, 1.62, 1.63, 5.0):
+            self.check(10, 63, time)
+        self.assertEqual(self.check(10, 63, 5.0), 63)
+        self.assertEqual(self.check(10, 63, 0.5), 0)
+
+    def testEmpty(self):
+        self.fill(0, 64, 0.0) # all would be dead, but the ring is empty
+        self.assertEqual(self.check(20, 0, 3.0), 0)
+
+    def testRandom(self):
+        rnd = N.random.RandomState(9)
+        for i in xrange(200):
+            t0, n = rnd.randint(0, 64), rnd.randint(0, 64)
+            self.fill(t0, n, rnd.uniform(0.001, 0.1))
+            self.check(t0, n, rnd.uniform(0, 5))
+
+
+class NoVBO:
+    def bind(self):
+        pass
+
+
+class UploadRangesTest(unittest.TestCase):
+
+    def testMergeRanges(self):
+        self.assertEqual(P.mergeRanges([]), [])
+        self.assertEqual(P.mergeRanges([(30,40), (0,10), (5,20)]), [(0,20), (30,40)])
+        self.assertEqual(P.mergeRanges([(0,10), (10,20)]), [(0,20)]) # touching
+        self.assertEqual(P.mergeRanges([(0,10), (20,30)], gap=10), [(0,30)])
+        self.assertEqual(P.mergeRanges([(0,10), (21,30)], gap=10), [(0,10), (21,30)])
+        self.assertEqual(P.mergeRanges([(0,50), (10,20)]), [(0,50)]) # inside
+
+
+    def testWrappedAndNeighbours(self):
+        c = P.ParticleController(128, no_gl=True)
+        for i in xrange(2):
+            g = headlessGenerator()
+            g.setSpawnSpeed(40) # 20 particles every half life, in blocks of 64
+            g.setEmitter(P.pointEmitter((0,0,0), (0,0,1)), batched=True)
+            c.manageGenerator(g)
+
+        # record the uploads instead of sending them to GL
+        uploads = []
+        c._no_gl = False
+        c._data_vbo = NoVBO()
+        c.uploadRange = lambda p0, p1: uploads.append((p0, p1))
+
+        for t in (1000, 2000, 3000, 4000):
+            c.update(t)
+        self.assertEqual(uploads[-2:], [(40, 60), (104, 124)]) # too far to merge
+        del uploads[:]
+
+        # the heads wrap: (60,64) and (0,16) in both. The ends of the first
+        # and the start of the second are merged, the wrapped parts aren't
+        c.update(5000)
+        self.assertEqual(uploads, [(0, 16), (60, 80), (124, 128)])
+        self.assertEqual(c.getUploadedBytes(), (16 + 20 + 4) * 8 * 4)
+
+
+class BudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.c = P.ParticleController(1024, no_gl=True)
+
+
+    def generator(self, position=(0,0,0), priority=1.0):
+        g = headlessGenerator()
+        g.setSpawnSpeed(40) # 20 particles every half life
+        g.setPriority(priority)
+        g.setPosition(position) # radius 1.2 with the default easing
+        return g
+
+
+    def testLodByDistance(self):
+        gens = [self.generator((0, d, 0)) for d in (0.5, 6, 12, 1000)]
+        prio, lod = self.c.computePriorities(gens)
+        self.assertTrue((lod == 1).all()) # no camera yet
+        self.assertTrue((prio == 1).all())
+
+        self.c.setCamera((0,0,0), 500.0) # 600 pixels per unit of radius at 1
+        prio, lod = self.c.computePriorities(gens)
+        self.assertTrue(N.allclose(lod, (1.0, 1.0, 0.5, 0.1))) # clamped at both ends
+        self.assertTrue(N.allclose(prio, (600, 100, 50, 0.6)))
+
+
+    def testLowerDetailSpawnsLess(self):
+        self.c.setCamera((0,0,0), 500.0)
+        near, far = self.generator((0,1,0)), self.generator((0,12,0))
+        for g in (near, far):
+            self.c.manageGenerator(g)
+        for t in (1000, 2000, 3000):
+            self.c.update(t)
+        self.assertEqual(near.getLiveParticles(), 40)
+        self.assertEqual(far.getLiveParticles(), 20)
+
+
+    def testBudget(self):
+        low, high, mid = self.generator(priority=1.0), self.generator(priority=5.0), self.generator(priority=2.0)
+        for g in (low, high, mid):
+            self.c.manageGenerator(g)
+        self.c.setBudget(45)
+
+        self.c.update(1000)
+        self.c.update(2000) # 20 particles each
+        self.assertEqual([g.isCulled() for g in (low, high, mid)], [True, False, False])
+        self.assertEqual(self.c.getStats(), {"live":40, "culled":20, "evicted":0})
+
+        # the least important go first when making room too
+        self.assertEqual([g for s0, g in self.c._eviction_order], [high, mid, low])
+
+        self.c.setBudget(30) # only the most important fits
+        self.c.update(2500)
+        self.assertEqual([g.isCulled() for g in (low, high, mid)], [True, False, True])
+        self.assertEqual(self.c.getStats()["culled"], 2 * 30)
+        self.assertEqual(self.c.getStats()["live"], 30)
+
+        self.c.setBudget(1000)
+        self.c.update(2600)
+        self.assertFalse(any(g.isCulled() for g in (low, high, mid)))
+
+
+
+if __name__ == "__main__":
+    unittest.main()
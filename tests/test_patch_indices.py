@@ -0,0 +1,71 @@
+import unittest
+
+import numpy as N
+
+from tests.headless import headlessMap
+
+
+# the strips as Map.calcPatchTriStripsIndices built them before they were
+# vectorized: one index at a time
+def loopTriStripsIndices(w, x0, y0, x1, y1):
+    dx = x1-x0
+    dy = y1-y0
+
+    idx = N.zeros(dx * (2*dy-2) + (dy-2)*2)
+
+    y_2 = y1-2
+    w_1 = w-1
+    dx_1 = dx-1
+    j = 0
+    p = w * y0 + x0
+    y = y0
+
+    while (True):
+        for x in xrange(dx):
+            idx[j] = p
+            j += 1
+            p+= w # move down
+            idx[j] = p
+            j += 1
+            p-= w_1 # move up-right
+        if y == y_2: break
+        p += w_1 # move down-left
+        idx[j] = p # degenerate vertex
+        j += 1
+        p -= dx_1 # move all the way left
+        idx[j] = p # degenerate vertex
+        j += 1
+        y += 1
+
+    return idx
+
+
+class PatchIndicesTest(unittest.TestCase):
+
+    def testSamePatchAsLoop(self):
+        for w,h,rect in ((10,10,(0,0,10,10)), (37,23,(5,3,20,23)),
+                         (201,201,(0,0,201,201)), (450,300,(200,200,401,300)),
+                         (64,64,(62,0,64,64))):
+            m = headlessMap(size=(w,h))
+            expected = loopTriStripsIndices(w, *rect)
+            got = m.calcPatchTriStripsIndices(*rect)
+            self.assertEqual(got.shape, expected.shape)
+            self.assertTrue((got == expected).all(), "patch %s of a %dx%d map" % (rect, w, h))
+
+
+    def testAllPatchesAsLoop(self):
+        m = headlessMap(size=(450,330))
+        patches = m.computePatchRects()
+
+        indices, ranges = m.calcAllPatchesTriStripsIndices(patches)
+
+        for rect, (count, first) in zip(patches, ranges):
+            expected = loopTriStripsIndices(450, *rect)
+            self.assertEqual(count, expected.shape[0])
+            self.assertTrue((indices[first:first+count] == expected).all(), "patch %s" % (rect,))
+        self.assertEqual(indices.shape[0], ranges[:,0].sum())
+
+
+
+if __name__ == "__main__":
+    unittest.main()
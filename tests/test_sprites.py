@@ -0,0 +1,174 @@
+import types
+import unittest
+
+import pygame
+
+import gltools
+from gltools import Texture
+from sprites import TileAllocator, SpriteTexture, mergeRects, boundingRect, _max_dirty_rects
+
+
+class TileAllocatorTest(unittest.TestCase):
+
+    def setUp(self):
+        # 16 slots per shelf, shelves 16, 32, 48 or 64 high
+        self.a = TileAllocator(page_size=1024, tile_size=64, min_height=16)
+
+
+    def testShelves(self):
+        self.assertEqual(self.a.getQuadsPerPage(), 16 * 64)
+        self.assertEqual(self.a.getPages(), 0)
+
+        # the first shelf is as high as the tile class, and filled from the left
+        self.assertEqual(self.a.allocate(64, 64), (0, (0,0), 0, (64,64)))
+        self.assertEqual(self.a.allocate(40, 50), (0, (0,64), 1, (40,50)))
+        # a lower tile opens a lower shelf under it
+        self.assertEqual(self.a.allocate(30, 10), (0, (64,0), 2, (30,10)))
+        self.assertEqual(self.a.allocate(64, 16), (0, (64,64), 3, (64,16)))
+
+        tiles = [self.a.allocate(64, 64) for i in xrange(14)]
+        self.assertEqual(tiles[-1][1], (0, 15*64)) # the first shelf is full
+        self.assertEqual(self.a.allocate(64, 64)[1], (80, 0)) # next shelf
+        self.assertEqual(self.a.getUsedQuads(0), 19)
+
+
+    def testPages(self):
+        tiles = [self.a.allocate(64, 64) for i in xrange(16 * 16)] # a full page
+        self.assertEqual(self.a.getPages(), 1)
+        self.assertEqual(len(set(t[1] for t in tiles)), 256)
+
+        page, pos, quad, size = self.a.allocate(64, 64)
+        self.assertEqual((page, pos, quad), (1, (0,0), 1024))
+        self.assertEqual(self.a.getPages(), 2)
+        self.assertEqual(self.a.getUsedQuads(1), 1)
+
+
+    def testFree(self):
+        a, b = self.a.allocate(64, 64), self.a.allocate(64, 60)
+        self.a.free(a)
+        # the slot and quad are given again, nothing new is used
+        c = self.a.allocate(50, 64)
+        self.assertEqual(c[0:3], a[0:3])
+        self.assertEqual(self.a.getUsedQuads(0), 2)
+
+        # a slot is only reused by tiles of its height class
+        self.a.free(b)
+        d = self.a.allocate(64, 20)
+        self.assertNotEqual(d[1], b[1])
+        self.assertEqual(d[2], b[2]) # quads aren't tied to a class
+
+
+    def testOccupancy(self):
+        self.assertEqual(self.a.getOccupancy(), {"pages": 0, "used": 0.0, "reserved": 0.0})
+
+        t = self.a.allocate(64, 32)
+        self.a.allocate(32, 32)
+        page = 1024.0 * 1024
+        occ = self.a.getOccupancy()
+        self.assertEqual(occ["pages"], 1)
+        self.assertAlmostEqual(occ["used"], (64*32 + 32*32) / page)
+        self.assertAlmostEqual(occ["reserved"], 32 * 1024 / page) # one shelf
+
+        self.a.free(t)
+        self.assertAlmostEqual(self.a.getOccupancy()["used"], 32*32 / page)
+        self.assertAlmostEqual(self.a.getOccupancy()["reserved"], 32 * 1024 / page)
+
+
+class DirtyRectsTest(unittest.TestCase):
+
+    def testMerge(self):
+        # the tiles of a sprite side by side in a shelf become one
+        self.assertEqual(mergeRects([(64,0,64,32), (0,0,64,32), (128,0,20,32)]), [(0,0,148,32)])
+        # overlapping, repeated and touching ones too
+        self.assertEqual(mergeRects([(0,0,10,8), (5,0,10,8), (5,0,10,8), (15,0,5,8)]), [(0,0,20,8)])
+
+        # but not the ones apart, in other rows or of other heights
+        self.assertEqual(mergeRects([(0,0,10,8), (11,0,10,8)]), [(0,0,10,8), (11,0,10,8)])
+        self.assertEqual(mergeRects([(0,0,10,8), (10,8,10,8)]), [(0,0,10,8), (10,8,10,8)])
+        self.assertEqual(mergeRects([(0,0,10,8), (10,0,10,16)]), [(0,0,10,8), (10,0,10,16)])
+        self.assertEqual(mergeRects([]), [])
+
+    def testBounding(self):
+        self.assertEqual(boundingRect([(10,20,5,5), (0,40,8,2), (30,0,1,1)]), (0,0,31,42))
+        self.assertEqual(boundingRect([(3,4,5,6)]), (3,4,5,6))
+
+
+
+# records the rectangles uploaded instead of sending them to GL
+class RectRecorder:
+    def __init__(self):
+        self.rects = []
+
+    def updateRect(self, surf, rect):
+        self.rects.append(rect)
+        return rect[2] * rect[3] * 4
+
+
+class SpriteUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.t = types.InstanceType(SpriteTexture)
+        self.t._surface = pygame.Surface((256,256), flags=pygame.SRCALPHA)
+        self.t._texture = RectRecorder()
+        self.t.reset()
+
+
+    def testOnlyChangedRects(self):
+        self.assertEqual(self.t.updateGlTexture(), 0) # nothing changed
+
+        self.t.setTainted(img=True, rect=(0,0,64,32))
+        self.t.setTainted(img=True, rect=(64,0,64,32))
+        self.t.setTainted(img=True, rect=(0,128,16,16))
+        self.assertEqual(self.t.updateGlTexture(), (128*32 + 16*16) * 4)
+        self.assertEqual(self.t._texture.rects, [(0,0,128,32), (0,128,16,16)])
+        self.assertEqual(self.t.updateGlTexture(), 0)
+
+    def testManyRects(self):
+        # too many rectangles: their bounding box is sent at once
+        for i in xrange(_max_dirty_rects + 1):
+            self.t.setTainted(img=True, rect=(i*4, i*2, 2, 2))
+        self.t.updateGlTexture()
+        self.assertEqual(self.t._texture.rects, [(0, 0, 130, 66)])
+
+    def testAll(self):
+        self.t.setTainted(img=True)
+        self.assertEqual(self.t.updateGlTexture(), 256*256*4)
+
+
+
+class UpdateRectTest(unittest.TestCase):
+
+    def setUp(self):
+        # record the calls to GL
+        self.calls = []
+        self.saved = gltools.glBindTexture, gltools.glTexSubImage2D
+        gltools.glBindTexture = lambda *args: None
+        gltools.glTexSubImage2D = lambda *args: self.calls.append(args)
+
+    def tearDown(self):
+        gltools.glBindTexture, gltools.glTexSubImage2D = self.saved
+
+
+    def testFlippedRows(self):
+        surf = pygame.Surface((32,64), flags=pygame.SRCALPHA)
+        for y in xrange(64):
+            surf.fill((y, 0, 0, 255), (0, y, 32, 1)) # the red of a row is its y
+
+        tex = types.InstanceType(Texture)
+        tex._id = 0
+        tex._height = 64
+
+        sent = tex.updateRect(surf, (8, 10, 4, 3))
+        self.assertEqual(sent, 4 * 3 * 4)
+
+        (target, level, x, y, w, h, fmt, kind, data), = self.calls
+        # GL rows go up from the bottom: the rows 10..12 of the surface are
+        # the rows 53..51 of the texture
+        self.assertEqual((x, y, w, h), (8, 64 - 10 - 3, 4, 3))
+        self.assertEqual([ord(data[i * 16]) for i in xrange(3)], [12, 11, 10])
+        self.assertEqual(len(data), sent)
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+
+import numpy as N
+
+from terrainlod import *
+from tests.headless import headlessMap, smoothHeights
+from tests.test_patch_indices import loopTriStripsIndices
+
+
+# triangles of a strip, skipping the degenerate ones
+def stripTriangles(strip):
+    tris = N.column_stack((strip[:-2], strip[1:-1], strip[2:]))
+    ok = (tris[:,0] != tris[:,1]) & (tris[:,1] != tris[:,2]) & (tris[:,0] != tris[:,2])
+    return tris[ok]
+
+
+def headlessLodMap(heights, levels, patch=32):
+    h,w = heights.shape
+    m = headlessMap(heights, _lod_levels=levels, _lod_max_error=2.0)
+    patches = m.computePatchRects(patch, patch)
+
+    vertices = N.column_stack((N.tile(N.arange(w), h), N.repeat(N.arange(h), w), heights.ravel())).astype("f")
+    vertices, indices = m.prepareLodPatches(patches, vertices)
+
+    m._patch_bounds = N.array([((x0,y0,heights[y0:y1,x0:x1].min()), (x1-1,y1-1,heights[y0:y1,x0:x1].max()))
+                                    for x0,y0,x1,y1 in patches], dtype="f")
+    return m, patches, vertices, indices
+
+
+class LevelsTest(unittest.TestCase):
+
+    def testLevelSamples(self):
+        self.assertEqual(list(levelSamples(9, 4)), [0,4,8])
+        self.assertEqual(list(levelSamples(10, 4)), [0,4,8,9])
+        self.assertEqual(list(levelSamples(5, 1)), [0,1,2,3,4])
+
+
+    def testFullLevelIsThePlainStrip(self):
+        w = 50
+        strip = gridStrip(N.arange(3, 20), N.arange(7, 40), w)
+        self.assertTrue((strip == loopTriStripsIndices(w, 7, 3, 40, 20)).all())
+
+
+    def testCoarseStripCoversThePatch(self):
+        w = 40
+        rows = levelSamples(33, 4)
+        cols = levelSamples(21, 4) + 5
+        tris = stripTriangles(gridStrip(rows, cols, w))
+
+        # only sampled vertices, and twice as many triangles as cells
+        self.assertTrue(N.in1d(tris % w, cols).all())
+        self.assertTrue(N.in1d(tris // w, rows).all())
+        self.assertEqual(len(tris), 2 * (len(rows)-1) * (len(cols)-1))
+
+
+    def testErrors(self):
+        y, x = N.mgrid[0:17, 0:17].astype("f")
+        self.assertTrue(N.allclose(patchLevelErrors(x*0.5 + y*2.0 + 1, 4), 0, atol=1e-5)) # a plane
+
+        spike = N.zeros((17,17), dtype="f")
+        spike[5,7] = 3.0 # dropped by every coarser level
+        self.assertTrue(N.allclose(patchLevelErrors(spike, 4), (0, 3, 3, 3)))
+
+        errors = patchLevelErrors(smoothHeights(33, 33), 5)
+        self.assertEqual(errors[0], 0)
+        self.assertTrue((N.diff(errors) >= 0).all())
+
+
+    def testSelection(self):
+        errors = N.array(((0, 0.5, 1, 4), (0, 0.5, 1, 4), (0, 0.5, 1, 4), (0, 2, 3, 5)), dtype="f")
+        dist = N.array((10, 100, 1000, 1000), dtype="f")
+        # 2 pixels max at a pixel scale of 400: 0.05 units at 10, 0.5 at 100, 5 at 1000
+        self.assertEqual(list(selectPatchLevels(errors, dist, 400.0, 2.0)), [0, 1, 3, 3])
+
+        self.assertTrue(N.allclose(distanceToBoxes((0,0,0), N.array((((1,1,1),(2,2,2)), ((-1,-1,-1),(1,1,1))), dtype="f")), (N.sqrt(3), 0)))
+
+
+
+class MapLodTest(unittest.TestCase):
+
+    def setUp(self):
+        self.heights = smoothHeights(257, 257)
+        self.m, self.patches, self.vertices, self.indices = headlessLodMap(self.heights, 5)
+
+
+    def testIndicesAndSkirts(self):
+        m = self.m
+        self.assertTrue(self.indices.max() < len(self.vertices))
+        self.assertEqual(m._lod_counts.sum(), len(self.indices))
+
+        # the skirts hang below the map by more than the largest error
+        h,w = self.heights.shape
+        skirts = self.vertices[w*h:]
+        x = skirts[:,0].astype(int)
+        y = skirts[:,1].astype(int)
+        depth = self.heights[y,x] - skirts[:,2]
+        self.assertTrue(N.allclose(depth, depth[0]))
+        self.assertTrue(depth[0] > m._lod_errors.max())
+
+
+    def testTrianglesDropWithDistance(self):
+        m = self.m
+        patches = N.arange(len(self.patches))
+        def triangles(levels):
+            total = 0
+            for i,k in zip(patches, levels):
+                f = int(m._lod_offsets[i,k]) // 4 # bytes to indices
+                total += len(stripTriangles(self.indices[f:f+int(m._lod_counts[i,k])]))
+            return total
+
+        near = m.getPatchLevels(patches, (128,128,10), 400.0)
+        far = m.getPatchLevels(patches, (128,128,3000), 400.0)
+
+        self.assertTrue((far >= near).all())
+        self.assertEqual(near.min(), 0) # full detail under the camera
+        self.assertTrue(triangles(far) * 10 <= triangles(N.zeros(len(patches), dtype=int)))
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as N
+
+from tiledmap import writeTiledMap, TiledMapFile, TileCache
+from tests.headless import headlessMap, smoothHeights
+
+
+class TiledMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "test.tiles")
+
+        self.heights = smoothHeights(75, 50)
+        normals = N.random.RandomState(1).normal(size=(50,75,3)).astype("f")
+        self.normals = normals / N.sqrt((normals**2).sum(axis=2))[:,:,None]
+
+        writeTiledMap(self.filename, self.heights, self.normals, {"base":[(3,4)]}, tile_size=16)
+        self.file = TiledMapFile(self.filename)
+        self.caches = []
+
+
+    def tearDown(self):
+        for c in self.caches:
+            c.finish()
+        self.file = None
+        shutil.rmtree(self.dir)
+
+
+    def newCache(self, max_resident):
+        c = TileCache(self.file, max_resident)
+        self.caches.append(c)
+        return c
+
+
+    def testRoundTrip(self):
+        f = self.file
+        self.assertEqual(f.getDimensions(), (75,50))
+        self.assertEqual(f.getTileCount(), (5,4))
+        self.assertEqual(f.getLocations(), {"base":[(3,4)]})
+
+        zmin, zmax = f.getHeightRanges()
+        ts = 16
+        for ty in xrange(4):
+            for tx in xrange(5):
+                heights, normals = f.readTile(tx,ty)
+                self.assertEqual(heights.shape, (ts+1,ts+1))
+
+                # the part inside the map is the same, the rest repeats the edges
+                h = self.heights[ty*ts:ty*ts+ts+1, tx*ts:tx*ts+ts+1]
+                n = self.normals[ty*ts:ty*ts+ts+1, tx*ts:tx*ts+ts+1]
+                self.assertTrue((heights[0:h.shape[0], 0:h.shape[1]] == h).all())
+                self.assertTrue((normals[0:n.shape[0], 0:n.shape[1]] == n).all())
+                self.assertTrue((heights[h.shape[0]:] == heights[h.shape[0]-1]).all())
+
+                self.assertAlmostEqual(zmin[ty,tx], heights.min(), 5)
+                self.assertAlmostEqual(zmax[ty,tx], heights.max(), 5)
+
+        self.assertFalse(f.hasTile(5,0))
+        self.assertFalse(f.hasTile(0,-1))
+
+
+    def testLeastRecentlyUsed(self):
+        c = self.newCache(3)
+        for t in ((0,0), (1,0), (2,0)):
+            c.getTile(*t)
+        c.getTile(0,0) # now (1,0) is the oldest
+        c.getTile(3,0)
+        self.assertEqual(sorted(c.getResidentTiles()), [(0,0), (2,0), (3,0)])
+
+        c.peekTile(4,0) # read but not kept
+        self.assertFalse(c.isResident(4,0))
+        self.assertTrue(c.getTile(7,7) is None)
+
+
+    def testRequestArea(self):
+        c = self.newCache(9)
+        c.requestArea(40, 20, 1) # tile (2,1) and its neighbours
+        expected = sorted((tx,ty) for ty in (0,1,2) for tx in (1,2,3))
+
+        t0 = time.time()
+        while sorted(c.getResidentTiles()) != expected and time.time() - t0 < 5:
+            time.sleep(0.01)
+        self.assertEqual(sorted(c.getResidentTiles()), expected)
+
+
+    def testMapInterpolation(self):
+        tiled = headlessMap(tiles=self.newCache(4), tile_size=16)
+        whole = headlessMap(self.heights, self.normals)
+
+        rnd = N.random.RandomState(5)
+        for x,y in rnd.uniform((0,0), (73.9,48.9), size=(200,2)):
+            z1, n1 = tiled(x,y)
+            z2, n2 = whole(x,y)
+            self.assertAlmostEqual(z1, z2, 4)
+            self.assertTrue(N.allclose(n1, n2, atol=1e-5))
+
+        self.assertEqual(tiled(-20, 5, False), 0.0) # outside
+
+
+
+if __name__ == "__main__":
+    unittest.main()
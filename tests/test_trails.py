@@ -0,0 +1,101 @@
+import unittest
+
+import numpy as N
+
+from trails import TrailRenderer
+
+
+# the points of a trail, newest first, as the shader walks the ring
+def trailPoints(r, trail):
+    info = r._points[trail, 0]
+    head, count = int(info[0]), int(info[1])
+    rows = [(head - i) % r._length + 1 for i in xrange(count)]
+    return r._points[trail, rows]
+
+
+class TrailRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.r = TrailRenderer(max_trails=4, length=8, no_gl=True)
+
+
+    def add(self, trail, first, n):
+        for i in xrange(first, first + n):
+            self.r.update(i * 10)
+            self.r.addTrailPoint(trail, (i, 0, 0))
+
+
+    def testSegments(self):
+        t = self.r.newTrail()
+        self.assertEqual(int(self.r._points[t,0,1]), 0)
+
+        self.add(t, 0, 5)
+        points = trailPoints(self.r, t)
+        self.assertEqual(len(points), 5) # 4 segments
+        self.assertEqual(list(points[:,0]), [4, 3, 2, 1, 0])
+        self.assertEqual(list(points[:,3]), [40, 30, 20, 10, 0]) # the time of each
+
+
+    def testWrap(self):
+        t = self.r.newTrail()
+        self.add(t, 0, 13) # 5 more than fit
+        info = self.r._points[t,0]
+        self.assertEqual(int(info[1]), 8) # never more than the length
+        self.assertEqual(int(info[0]), 13 % 8) # the first point went to slot 1
+
+        # the newest 8 are kept, the oldest overwritten
+        self.assertEqual(list(trailPoints(self.r, t)[:,0]), range(12, 4, -1))
+        self.assertEqual(sorted(self.r._points[t,1:,0]), range(5, 13))
+
+
+    def testTrailsAreSeparate(self):
+        a, b = self.r.newTrail(), self.r.newTrail()
+        self.add(a, 0, 3)
+        self.add(b, 100, 10)
+        self.assertEqual(list(trailPoints(self.r, a)[:,0]), [2, 1, 0])
+        self.assertEqual(len(trailPoints(self.r, b)), 8)
+
+
+
+class TrailRowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.r = TrailRenderer(max_trails=3, length=4, no_gl=True)
+        self.r.setLook(lifetime=100.0)
+
+
+    def testFadeAndFree(self):
+        a, b = self.r.newTrail(), self.r.newTrail()
+        self.assertEqual((a, b), (0, 1))
+        self.assertEqual(self.r._used, 2)
+
+        self.r.update(50)
+        self.r.addTrailPoint(b, (1,2,3))
+        self.r.closeTrail(b)
+        self.r.update(140)
+        self.assertEqual(self.r.getLiveTrails(), 2) # still fading
+        self.r.update(151)
+        self.assertEqual(self.r.getLiveTrails(), 1)
+        self.assertEqual(self.r._used, 1) # only the rows up to the last live one
+        self.assertTrue((self.r._points[b] == 0).all())
+
+        self.assertEqual(self.r.newTrail(), 1) # the lowest free row
+
+
+    def testReuseTheOldest(self):
+        rows = [self.r.newTrail() for i in xrange(3)]
+        self.assertEqual(self.r.newTrail(), None) # all open
+
+        for t, row in zip((10, 5, 20), rows):
+            self.r.update(t)
+            self.r.addTrailPoint(row, (0,0,0))
+            self.r.closeTrail(row)
+
+        # the one that faded the most (its newest point is the oldest)
+        self.assertEqual(self.r.newTrail(), rows[1])
+        self.assertEqual(self.r.getLiveTrails(), 3)
+
+
+
+if __name__ == "__main__":
+    unittest.main()